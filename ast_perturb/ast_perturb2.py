@@ -7,8 +7,10 @@ import random, pprint
 from threading import Thread
 from dataclasses import dataclass
 from collections import defaultdict
-import os, io, ast, _ast, copy, json, string
-from ast_perturb.ast_unparse37 import Unparser
+import os, io, ast, _ast, copy, json, string, itertools
+from ast_perturb.ast_unparse37 import unparse
+from ast_perturb.sub_index import get_sub_index, token_sort_ratio
+from ast_perturb.signature_db import SignatureDB, BUILTIN_FN_NAMES, SIGNATURES_PATH, load_module_signatures, get_lib_fn_names
 
 # global variable (dict) to collect AST key value pairs of candidates for a given code in the multi-threaded setting.
 AST_NEG_SAMPLES_DB = {}
@@ -78,16 +80,33 @@ def hasanyattr(obj, attr_list: Union[List[str], Tuple[str]]) ->  bool:
             return True
     return False
 
-modules_signatures = json.load(open("module_signatures.json"))
+def serialize_tree(tree) -> str:
+    """convert tree back to code block (in memory, with the 3.7 `Unparser`: the format of the generated negatives)."""
+    return unparse(tree)
+
+# compiled signature db if it was built (see `signature_db.py`), the json otherwise.
+modules_signatures = load_module_signatures(SIGNATURES_PATH)
 signatures = modules_signatures['signatures']
-fn_names = set()
-for key, value in signatures.items():
-    fn_names.add(key)
-    for rec in value:
-        fn_names.add(rec["qualified_name"])
-fn_names = list(fn_names)
-builtin_fn_names = ["abs", "aiter","all", "any", "anext", "ascii", "bin", "bool", "breakpoint", "bytearray", "bytes", "callable", "chr", "classmethod", "compile", "complex", "delattr", "dict", "dir", "divmod", "enumerate", "eval", "exec", "filter", "float", "format", "frozenset", "getattr", "globals", "hasattr", "hash", "help", "hex", "id", "input", "int", "isinstance", "issubclass", "iter", "len", "list", "locals", "map", "max", "memoryview", "min", "next", "object", "oct", "open", "ord", "pow", "print", "property", "range", "repr", "reversed", "round", "set", "setattr", "slice", "sorted", "staticmethod", "str", "sum", "super", "tuple", "type", "vars", "zip", "__import__"]
-fn_names.extend(builtin_fn_names)
+builtin_fn_names = BUILTIN_FN_NAMES
+
+def build_fn_name_index(lib_fn_names: List[str]) -> Dict[str, List[str]]:
+    """library function names grouped by their last dotted component."""
+    fn_name_index = defaultdict(list)
+    for lib_fn_name in lib_fn_names:
+        fn_name_index[lib_fn_name.split(".")[-1]].append(lib_fn_name)
+
+    return dict(fn_name_index)
+if isinstance(signatures, SignatureDB):
+    # precomputed in the db.
+    fn_names = signatures.fn_names
+    fn_name_index = signatures.fn_name_index
+    first_overloads = signatures.first_overloads
+else:
+    fn_names = get_lib_fn_names(signatures)
+    fn_name_index = build_fn_name_index(fn_names)
+    first_overloads = [(recs[0]["name"], recs[0]["qualified_name"]) for recs in signatures.values()]
+# no. of rule1 candidates (the top ranked substitutes of the library functions).
+RULE1_VARIANTS = 15
 # base class for capturing generation rules.
 class RuleFilter:
     def RecursiveSub(self):
@@ -169,13 +188,13 @@ class RuleFilter:
 
     @classmethod
     def AllowAll(cls):
-        args = {f"rule{i+1}":True for i in range(len(self))}
-        return RuleFilter(**args)
+        args = {f"rule{i+1}":True for i in range(len(cls()))}
+        return cls(**args)
 
     @classmethod
     def BlockAll(cls):
-        args = {f"rule{i+1}":False for i in range(len(self))}
-        return RuleFilter(**args)
+        args = {f"rule{i+1}":False for i in range(len(cls()))}
+        return cls(**args)
 
     def __call__(self, index: int):
         return getattr(self, f"rule{index}")
@@ -319,6 +338,66 @@ class PosRuleFilter(RuleFilter):
 #     def score_match(self, other) -> float:
 #         if self == other:
 #             return 1
+# marks attributes that didn't exist before a logged mutation (reverting deletes them).
+_MISSING = object()
+class MutationLog:
+    """undo log of the mutations made to a tree: attribute assignments (`set_attr`) and in place list updates 
+    (`set_list`). `revert` restores the tree as it was before the first logged mutation."""
+    def __init__(self):
+        self.entries = []
+
+    def set_attr(self, obj, attr: str, value):
+        self.entries.append((obj, attr, getattr(obj, attr, _MISSING)))
+        setattr(obj, attr, value)
+
+    def del_attr(self, obj, attr: str):
+        self.entries.append((obj, attr, getattr(obj, attr)))
+        delattr(obj, attr)
+
+    def set_list(self, values: list, new_values: list):
+        self.entries.append((values, None, list(values)))
+        values[:] = new_values
+
+    def revert(self):
+        for obj, attr, old_value in reversed(self.entries):
+            if attr is None: obj[:] = old_value
+            elif old_value is _MISSING: delattr(obj, attr)
+            else: setattr(obj, attr, old_value)
+        self.entries = []
+
+class LoggedTransformer(ast.NodeTransformer):
+    """`ast.NodeTransformer` that records every change it makes to the tree in `self.mutation_log` 
+    (if it is set), so a transformed tree can be restored instead of transforming a deep copy."""
+    mutation_log = None
+    def _set(self, obj, attr: str, value):
+        if self.mutation_log is not None: self.mutation_log.set_attr(obj, attr, value)
+        else: setattr(obj, attr, value)
+
+    def generic_visit(self, node):
+        # same as `ast.NodeTransformer.generic_visit`, with the changes logged.
+        for field, old_value in ast.iter_fields(node):
+            if isinstance(old_value, list):
+                new_values = []
+                for value in old_value:
+                    if isinstance(value, ast.AST):
+                        value = self.visit(value)
+                        if value is None:
+                            continue
+                        elif not isinstance(value, ast.AST):
+                            new_values.extend(value)
+                            continue
+                    new_values.append(value)
+                if len(new_values) == len(old_value) and all(a is b for a, b in zip(new_values, old_value)): continue
+                if self.mutation_log is not None: self.mutation_log.set_list(old_value, new_values)
+                else: old_value[:] = new_values
+            elif isinstance(old_value, ast.AST):
+                new_node = self.visit(old_value)
+                if new_node is None:
+                    if self.mutation_log is not None: self.mutation_log.del_attr(node, field)
+                    else: delattr(node, field)
+                elif new_node is not old_value: self._set(node, field, new_node)
+        return node
+
 class VarScrambler(ast.NodeTransformer):
     """class for scrambling variable."""
     def __init__(self):
@@ -327,9 +406,45 @@ class VarScrambler(ast.NodeTransformer):
     def visit_Name(self, node):
         self.var_to_nodes[node.id].append(node)
         return super(VarScrambler, self).generic_visit(node)
-    
+
+CMP_OPS = ["Is", "IsNot", "In", "NotIn", "Eq", "Lt", "Gt", "LtE", "GtE", "NotEq"]
+# rules that apply to every node of a type (the other rules also depend on the node's fields).
+NODE_TYPE_RULES = {
+    "UnaryOp": ["rule16"], "NameConstant": ["rule5"], "Num": ["rule4"],
+    "Str": ["rule12", "rule13"], "And": ["rule7"], "Or": ["rule7"],
+    "If": ["rule9", "rule11"], "IfExp": ["rule9", "rule11"],
+    "ListComp": ["rule2"], "SetComp": ["rule3"],
+    **{op: ["rule6"] for op in CMP_OPS},
+}
+def rule_bit(rule: str) -> int:
+    return 1 << int(rule[len("rule"):])
+
+def visitor_kind(node: ast.AST) -> str:
+    """node type name that `ast.NodeVisitor.visit` dispatches `node` to
+    (python 3.8+ parses literals as `Constant` and dispatches them by the type of the value)."""
+    kind = node.__class__.__name__
+    if kind == "Constant":
+        for cls, name in getattr(ast, "_const_node_type_names", {}).items():
+            if isinstance(node.value, cls): return name
+    return kind
+
+class PerturbationSites:
+    """perturbation sites of a tree, found in a single traversal (`PerturbAst.enumerate_sites`):
+    - `sites`: rule -> nodes changed by the rule (in visit order).
+    - `var_groups`: variable name -> its `Name` nodes (rule14 misuses one node of a group at a time).
+    - `masks`: node -> bit mask (`rule_bit`) of the rules with sites in the subtree of the node.
+    - `valid_rules`: the applicable rules."""
+    def __init__(self):
+        self.sites = defaultdict(list)
+        self.var_groups = defaultdict(list)
+        self.masks = {}
+        self.valid_rules = set()
+
+    def rules(self) -> List[str]:
+        return sorted(self.valid_rules)
+
 # class for perturbing AST parse tree.
-class PerturbAst(ast.NodeTransformer):
+class PerturbAst(LoggedTransformer):
     """Perturb AST using various rules:
     1. Library function substitution.
         a) Randomly replace function names of known library function with other known library functions.
@@ -348,17 +463,22 @@ class PerturbAst(ast.NodeTransformer):
         else: self.rule_filter = rule_filter
         self.use_rules = {}
         self.rule1_search_cache = {}
+        # masks of the sites being visited and the bit of the applied rule (see `_visit_sites`).
+        self.site_masks = None
+        self.active_rule_bit = 0
 
     def init(self):
         from sortedcontainers import SortedSet
         global fn_names
         global signatures
         
-        self.rule_checking_mode = False
         self.applied_rules = SortedSet()
-        self.valid_rules = SortedSet()
         self.signatures = signatures
         self.lib_fn_names = fn_names
+        self.lib_fn_name_index = fn_name_index
+        self.first_overloads = first_overloads
+        # precomputed rule1 substitution candidates (None if the index wasn't built).
+        self.sub_index = get_sub_index(signatures)
         
     def reset(self):
         """clear visit sequence."""
@@ -378,8 +498,10 @@ class PerturbAst(ast.NodeTransformer):
         return random.choice(self.applied_rules)
     
     def is_user_defined(self, fn_name):
-        for lib_fn_name in self.lib_fn_names:
-            if self.compare_fn_names(fn_name, lib_fn_name):
+        # only library functions with the same last component can match (`compare_fn_names`), 
+        # so just check the suffix against those.
+        for lib_fn_name in self.lib_fn_name_index.get(fn_name.split(".")[-1], []):
+            if lib_fn_name.endswith(fn_name):
                 return False
         return True
     
@@ -396,21 +518,17 @@ class PerturbAst(ast.NodeTransformer):
         else: return value.id+"."+attr
     
     def sample_neg_fn(self, fn: str) -> str:
-        """return the first random function that has a different qualified name
+        """return a random function that has a different qualified name
         than the reference function `fn`.
         Args:
             fn (str): reference function name to make sure a different function is sampled.
         Returns:
             (str): name of the sampled function.
         """
-        shuffled = random.sample(
-            list(self.signatures.keys()), 
-            k=len(self.signatures)
-        )
-        for k in shuffled:
-            rec = self.signatures[k][0]
-            name = rec["name"]
-            qualified_name = rec["qualified_name"]
+        # draw (the first overloads of) random functions until one differs, only a handful can match `fn`.
+        n = len(self.first_overloads)
+        for _ in range(n):
+            name, qualified_name = self.first_overloads[random.randrange(n)]
             if not self.compare_fn_names(fn, qualified_name):
                 return name
 
@@ -420,10 +538,10 @@ class PerturbAst(ast.NodeTransformer):
     def apply_rule1_rand(self, func):
         if isinstance(func, _ast.Name):
             neg_fn = self.sample_neg_fn(func.id)
-            func.id = neg_fn
+            self._set(func, "id", neg_fn)
         elif isinstance(func, _ast.Attribute):
             neg_fn = self.sample_neg_fn(func.attr) # print(neg_fn)
-            func.attr = neg_fn
+            self._set(func, "attr", neg_fn)
 
     def fn_name_sim_score(self, target_name: str, candidate_name: str) -> float:
         """score the similarity of function names of "target" and "candidate"
@@ -433,11 +551,10 @@ class PerturbAst(ast.NodeTransformer):
         Returns:
             _type_: similarity score in (0,1)
         """
-        from fuzzywuzzy import fuzz
         # use levenshtein distance. (it is from 0 to 100, so norm by dividing by 100)
         target_name = target_name.replace("_", " ")
         candidate_name = candidate_name.replace("_", " ")
-        lev_score = fuzz.token_sort_ratio(target_name, candidate_name)/100
+        lev_score = token_sort_ratio(target_name, candidate_name)/100
         # NOTE: no need to use len score if token_sort_ratio is used.
         # # penalize a bit for length mismatch. (clamp minimum value at 0.5)
         # len_score = 1-min((abs(len(candidate_name)-len(target_name))/len(target_name)), 0.5)
@@ -495,50 +612,56 @@ class PerturbAst(ast.NodeTransformer):
             "sig_sim_score": sig_sim_score,
         }
 
+    def rank_rule1_candidates(self, fn_name: str) -> List[Tuple[str, float, dict]]:
+        """rank every library function as a substitute for `fn_name` (by name and signature similarity,
+        or only by name similarity if `fn_name` has no known signature)."""
+        scores = []
+        breakups = []
+        fn_dicts = self.signatures.get(fn_name)
+        for cand_name, cand_list in self.signatures.items():
+            if cand_name == fn_name: 
+                scores.append(0)
+                breakups.append({})
+                continue
+            if fn_dicts is None:
+                score = self.fn_name_sim_score(fn_name, cand_name)
+                breakup = {"name_sim_score": score}
+            else:
+                fn_dict = fn_dicts[0]
+                cand_scores = []
+                for cand_dict in cand_list:
+                    score, breakup = self.fn_def_sim_score(fn_dict, cand_dict)
+                    cand_scores.append(score)
+                score = max(cand_scores)
+            scores.append(score)
+            breakups.append(breakup)
+        
+        return sorted(
+            [
+                (
+                    name, scores[i],
+                    breakups[i],
+                ) for i, name in enumerate(self.signatures)
+            ], key=lambda x: x[1], reverse=True, 
+        )
+
     def apply_rule1_smart(self, func, verbose=False):
         if isinstance(func, _ast.Name): fn_name = func.id
         elif isinstance(func, _ast.Attribute): fn_name = func.attr
         if fn_name not in self.rule1_search_cache:
-            scores = []
-            breakups = []
-            for cand_name, cand_list in self.signatures.items():
-                if cand_name == fn_name: 
-                    scores.append(0)
-                    breakups.append({})
-                    continue
-                fn_dicts = self.signatures.get(fn_name)
-                if fn_dicts is None:
-                    score = self.fn_name_sim_score(fn_name, cand_name)
-                    breakup = {"name_sim_score": score}
-                else:
-                    fn_dict = fn_dicts[0]
-                    cand_scores = []
-                    for cand_dict in cand_list:
-                        score, breakup = self.fn_def_sim_score(fn_dict, cand_dict)
-                        cand_scores.append(score)
-                    score = max(cand_scores)
-                scores.append(score)
-                breakups.append(breakup)
-            
-            rank_list = sorted(
-                [
-                    (
-                        name, scores[i],
-                        breakups[i],
-                    ) for i, name in enumerate(self.signatures)
-                ], key=lambda x: x[1], reverse=True, 
-            )
+            # look up (or search) the precomputed top candidates, scan all the signatures without an index.
+            if self.sub_index is not None:
+                rank_list = self.sub_index.get(fn_name, self.fn_name_sim_score)
+            else: rank_list = self.rank_rule1_candidates(fn_name)
             if verbose:
                 for name, score, breakup in rank_list[:5]:
                     print(f"{name}: {score} {breakup}")
-            new_fn_name = rank_list[self.rule_filter.fn_choose_index][0]
             self.rule1_search_cache[fn_name] = rank_list[:20]
             # print(f"caching results for: {fn_name}")
-        else: 
-            # print(f"getting cached result for: {fn_name}")
-            new_fn_name = self.rule1_search_cache[fn_name][self.rule_filter.fn_choose_index][0] 
-        if isinstance(func, _ast.Name): func.id = new_fn_name 
-        elif isinstance(func, _ast.Attribute): func.attr = new_fn_name
+        # else: print(f"getting cached result for: {fn_name}")
+        new_fn_name = self.rule1_search_cache[fn_name][self.rule_filter.fn_choose_index][0] 
+        if isinstance(func, _ast.Name): self._set(func, "id", new_fn_name)
+        elif isinstance(func, _ast.Attribute): self._set(func, "attr", new_fn_name)
 
     def rules_applied(self):
         return list(self.applied_rules)
@@ -547,39 +670,97 @@ class PerturbAst(ast.NodeTransformer):
         if isinstance(tree_or_code, _ast.Module):
             tree = tree_or_code
         elif isinstance(tree_or_code, str):
-            tree = ast.parse(bytes(tree_or_code, "utf8")) 
-        # use var scrambler NodeTransformer to see if VarMisuse is feasible:
-        var_scrambler = VarScrambler()
-        var_scrambler.visit(tree)
-        for _, node_list in var_scrambler.var_to_nodes.items():
-            if len(node_list) > 1:
-                self.valid_rules.add("rule14")
-                break
-        self.rule_checking_mode = True
-        self.visit(tree) # traverse tree to enumerate all applicable rules without modifying it.
-        valid_rules = list(self.valid_rules)
-        self.rule_checking_mode = False
+            tree = ast.parse(bytes(tree_or_code, "utf8"))
+        valid_rules = self.enumerate_sites(tree).rules()
         self.reset() # reset traversal specific attrs.
 
         return valid_rules
 
+    def enumerate_sites(self, tree: ast.AST) -> PerturbationSites:
+        """find the sites of every rule (and the variable groups for rule14) in a single traversal."""
+        sites = PerturbationSites()
+        self._enumerate(tree, sites)
+        # VarMisuse is feasible if some variable is used more than once.
+        if any(len(nodes) > 1 for nodes in sites.var_groups.values()):
+            sites.valid_rules.add("rule14")
+
+        return sites
+
+    def _enumerate(self, node: ast.AST, sites: PerturbationSites) -> int:
+        # pre-order, like the visitor (the sites of a rule are in the order it changes them).
+        mask = 0
+        for rule in self._node_rules(node, sites):
+            sites.sites[rule].append(node)
+            mask |= rule_bit(rule)
+        for _, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        mask |= self._enumerate(item, sites)
+            elif isinstance(value, ast.AST):
+                mask |= self._enumerate(value, sites)
+        sites.masks[node] = mask
+
+        return mask
+
+    def _node_rules(self, node: ast.AST, sites: PerturbationSites) -> List[str]:
+        """rules that change `node` when they are applied (the applicable ones are added to `sites.valid_rules`)."""
+        kind = visitor_kind(node)
+        rules = NODE_TYPE_RULES.get(kind)
+        if rules is not None:
+            sites.valid_rules.update(rules)
+            return rules
+        if kind == "Name":
+            sites.var_groups[node.id].append(node)
+            return ["rule14"]
+        elif kind == "BinOp":
+            if isinstance(node.op, _ast.Div):
+                sites.valid_rules.add("rule15")
+                return ["rule15"]
+        elif kind == "Assign":
+            if isinstance(node.value, (_ast.Num, _ast.BinOp)):
+                sites.valid_rules.add("rule18")
+            # rule18 negates the value of any assignment once it is applied.
+            return ["rule18"]
+        elif kind == "Call":
+            if type(node.func) == _ast.Attribute:
+                full_name = self.get_full_name(node.func.value, node.func.attr)
+            elif hasattr(node.func, "id"): full_name = node.func.id
+            else: return []
+            rules = ["rule8", "rule17"]
+            if self.is_rule1_applicable(full_name):
+                rules.append("rule1")
+            if len(node.args) > 1:
+                rules.append("rule10")
+            sites.valid_rules.update(rules)
+            return rules
+        return []
+
+    def visit(self, node: ast.AST) -> ast.AST:
+        # skip subtrees without a site of the applied rule (nodes created by the rule have no mask).
+        if self.site_masks is not None and not(self.site_masks.get(node, -1) & self.active_rule_bit):
+            return node
+        return super(PerturbAst, self).visit(node)
+
+    def _visit_sites(self, tree: ast.AST, rule: str, sites: PerturbationSites) -> ast.AST:
+        """apply `rule` (which the rule filter must allow alone) by visiting only the paths to its sites."""
+        self.site_masks = sites.masks
+        self.active_rule_bit = rule_bit(rule)
+        try: return self.visit(tree)
+        finally: self.site_masks = None
+
     def serialize_tree(self, tree):
-        # convert tree back to code block.
-        f = io.StringIO()
-        Unparser(tree, file=f)
-        return f.getvalue().strip("\n")
-#         content = ""
-#         fname = f"{rand_str(16)}.py"
-#         with open(fname, "w") as f:
-#             Unparser(tree, file=f)
-#         with open(fname, "r") as f:
-#             content = f.read()
-#         os.remove(fname)
-#         return content.strip("\n")
-    def _generate_i(self, tree, code: str, verbose: bool) -> str:
-        # get the perturbed tree.
-        perturbed_tree: _ast.Module = self.visit(tree)
-        perturbed_code = self.serialize_tree(perturbed_tree)
+        return serialize_tree(tree)
+
+    def _generate_i(self, tree, code: str, verbose: bool, rule: str, sites: PerturbationSites) -> str:
+        # perturb the tree in place, serialize it and undo the (logged) mutations.
+        self.mutation_log = MutationLog()
+        try:
+            perturbed_tree: _ast.Module = self._visit_sites(tree, rule, sites)
+            perturbed_code = self.serialize_tree(perturbed_tree)
+        finally:
+            self.mutation_log.revert()
+            self.mutation_log = None
         if verbose:
             print(f"original code: {code}")
             print(f"`PerturbAst.visit` returned code as `{type(perturbed_tree)}` object")
@@ -590,64 +771,75 @@ class PerturbAst(ast.NodeTransformer):
 
         return perturbed_code
     
-    def _apply_var_misuse(self, tree) -> List[Tuple[str, str]]:
-        cands = []
-        var_scrambler = VarScrambler()
-        var_scrambler.visit(tree)
-        var_to_nodes = var_scrambler.var_to_nodes
+    def _iter_var_misuse(self, tree, var_to_nodes: Union[Dict[str, list], None]=None) -> Iterator[str]:
+        if var_to_nodes is None:
+            var_scrambler = VarScrambler()
+            var_scrambler.visit(tree)
+            var_to_nodes = var_scrambler.var_to_nodes
         all_var_names = list(var_to_nodes.keys())
         rand_var_names = dearrange(all_var_names)
-        ind = -1
-        for var_name, node_list in var_to_nodes.items():
-            ind += 1
+        for ind, (var_name, node_list) in enumerate(var_to_nodes.items()):
             if len(node_list) <= 1: continue
             for node in node_list:
                 node.id = rand_var_names[ind]
-                cands.append((self.serialize_tree(tree), "rule14"))
-                node.id = var_name
-        
-        return cands
+                try: candidate = self.serialize_tree(tree)
+                finally: node.id = var_name
+                yield candidate
+
+    def _apply_var_misuse(self, tree, var_to_nodes: Union[Dict[str, list], None]=None) -> List[Tuple[str, str]]:
+        return [(candidate, "rule14") for candidate in self._iter_var_misuse(tree, var_to_nodes)]
+
+    def _iter_rule_candidates(self, tree, code: str, rule: str, sites: PerturbationSites, verbose: bool) -> Iterator[str]:
+        # the rule filter is set before every candidate (the perturber may be used in between).
+        if rule == "rule1":
+            for i in range(RULE1_VARIANTS):
+                self.rule_filter.setOneHotFromName(rule)
+                self.rule_filter.smartFnSub(i)
+                yield self._generate_i(tree, code, verbose, rule, sites)
+        elif rule == "rule14":
+            self.applied_rules.add("rule14")
+            yield from self._iter_var_misuse(tree, sites.var_groups)
+        else:
+            self.rule_filter.setOneHotFromName(rule)
+            yield self._generate_i(tree, code, verbose, rule, sites)
 
-    def generate(self, code: str, maxm: int=25, verbose: bool=False) -> List[str]:
-        candidates_and_rule: List[str, str] = []
-        self.var_to_node = {}
+    def iter_candidates(self, code: str, rule_order: Union[List[str], None]=None,
+                        rule_budget: Union[int, Dict[str, int], None]=None,
+                        max_candidates: Union[int, None]=None, verbose: bool=False) -> Iterator[Tuple[str, str]]:
+        """lazily yield the (candidate, rule) pairs of `code`: a candidate is only built when it is requested.
+        Args:
+            rule_order: priority order of the rules (the applicable rules in reverse order by default, so rule1,
+                which gives the most candidates, comes last). Rules that aren't listed are skipped.
+            rule_budget: max. no. of candidates of a rule (the same for every rule if an int).
+            max_candidates: max. no. of candidates in total.
+        """
         tree: _ast.Module = ast.parse(bytes(code, "utf8")) # get parsed AST.
-        valid_rules: List[str] = self.collect_applicable_rules(tree) # find list of applicable rules.
-        # NOTE: if no rules applicable, then FAIL SILENTLY
-        if valid_rules == []: return []
-        # give less preference to rule1 as it can lead to the most number of candidates.
-        # this is done to prevent bias towards the rule1.
-        valid_rules = sorted(valid_rules, reverse=True)
-        if verbose: print("applicable rules: ", valid_rules)
-        # ctr = 0
-        for rule in valid_rules:
-            copy_tree = copy.deepcopy(tree)
-            self.rule_filter.setOneHotFromName(rule)
-            if rule == "rule1":
-                for i in range(15):
-                    # ctr += 1
-                    # if ctr > maxm: break
-                    copy_tree = copy.deepcopy(tree)
-                    self.rule_filter.smartFnSub(i)
-                    candidate = self._generate_i(copy_tree, code, verbose)
-                    candidates_and_rule.append((candidate, rule))
-            elif rule == "rule14":
-                # ctr += 1
-                self.applied_rules.add("rule14")
-                candidates_and_rule += self._apply_var_misuse(copy_tree)
-            else: 
-                # ctr += 1
-                # if ctr > maxm: break
-                candidate = self._generate_i(copy_tree, code, verbose)
-                candidates_and_rule.append((candidate, rule))
+        # find the sites of all the rules (and the list of applicable rules) in one traversal.
+        sites: PerturbationSites = self.enumerate_sites(tree)
+        if rule_order is None:
+            # give less preference to rule1 as it can lead to the most number of candidates.
+            # this is done to prevent bias towards the rule1.
+            rule_order = sorted(sites.rules(), reverse=True)
+        else: rule_order = [rule for rule in rule_order if rule in sites.valid_rules]
+        if verbose: print("applicable rules: ", rule_order)
+        # every candidate is generated on `tree` itself (its mutations are reverted after serializing it).
+        ctr = 0
+        for rule in rule_order:
+            budget = rule_budget.get(rule) if isinstance(rule_budget, dict) else rule_budget
+            if max_candidates is not None:
+                if ctr >= max_candidates: return
+                budget = max_candidates-ctr if budget is None else min(budget, max_candidates-ctr)
+            for candidate in itertools.islice(self._iter_rule_candidates(tree, code, rule, sites, verbose), budget):
+                ctr += 1
+                yield candidate, rule
+
+    def generate(self, code: str, maxm: Union[int, None]=None, verbose: bool=False) -> List[Tuple[str, str]]:
+        """all the (candidate, rule) pairs of `code` (at most `maxm`), see `iter_candidates`."""
+        self.var_to_node = {}
+        candidates_and_rule = list(self.iter_candidates(code, max_candidates=maxm, verbose=verbose))
         # store in global variable (for multi-threaded setting.)
         AST_NEG_SAMPLES_DB[code] = candidates_and_rule 
-        # print("###############")
-        # print(f"\x1b[33m{code}\x1b[0m")
-        # print("———————————————")
-        # for i, cand in enumerate(candidates):
-        #     print(f"{i+1}. \x1b[34m{cand}\x1b[0m")
-        # print("###############")
+
         return candidates_and_rule
 
     def batch_generate(self, codes: List[str], **args):
@@ -661,8 +853,9 @@ class PerturbAst(ast.NodeTransformer):
     def __call__(self, code: str, rule_probs: Union[List[float], None]=None, verbose=False) -> Tuple[_ast.Module, dict]:
         # get parsed AST.
         tree: _ast.Module = ast.parse(bytes(code, "utf8"))
-        # find list of applicable rules.
-        rules: List[str] = self.collect_applicable_rules(tree)
+        # find the sites of all the rules (and the list of applicable rules).
+        sites: PerturbationSites = self.enumerate_sites(tree)
+        rules: List[str] = sites.rules()
         # NOTE: if no rules applicable, then FAIL SILENTLY
         if rules == []: 
             return tree, {
@@ -687,8 +880,8 @@ class PerturbAst(ast.NodeTransformer):
         # set rule filter to block mode and enable sampled filter by name.
         self.rule_filter.blockAll()
         self.rule_filter.allowByName(sampled_rule)
-        # get the perturbed tree.
-        perturbed_tree: _ast.Module = self.visit(tree)
+        # get the perturbed tree (only the paths to the sites of the sampled rule are visited).
+        perturbed_tree: _ast.Module = self._visit_sites(tree, sampled_rule, sites)
         if verbose:
             print(f"original code: {code}")
             print(f"`PerturbAst.visit` returned code as `{type(perturbed_tree)}` object")
@@ -704,47 +897,34 @@ class PerturbAst(ast.NodeTransformer):
         }
     
     def visit_UnaryOp(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule16")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(16):
             self.applied_rules.add("rule16")
             if isinstance(node.op, _ast.UAdd):
-                node.op = _ast.USub()
+                self._set(node, "op", _ast.USub())
             elif isinstance(node.op, _ast.USub):
-                node.op = _ast.UAdd()
+                self._set(node, "op", _ast.UAdd())
             elif isinstance(node.op, (_ast.Not, _ast.Invert)):
                 node = node.operand
             return super(PerturbAst, self).generic_visit(node)
         return super(PerturbAst, self).generic_visit(node)
     
     def visit_BinOp(self, node):
-        if self.rule_checking_mode:
-            if isinstance(node.op, _ast.Div):
-                self.valid_rules.add("rule15")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(15):
             if isinstance(node.op, _ast.Div):
                 self.applied_rules.add("rule15")
-                node.right.id = '0'
+                self._set(node.right, "id", '0')
             return super(PerturbAst, self).generic_visit(node)
         return super(PerturbAst, self).generic_visit(node)
     # NOTE: depreceated for version 3.8, not available for version > 3.9
     def visit_NameConstant(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule5")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(5):
             self.applied_rules.add("rule5")
             if type(node.value) == bool:
-                node.value = not(node.value)
+                self._set(node, "value", not(node.value))
             return super(PerturbAst, self).generic_visit(node)
         else: return super(PerturbAst, self).generic_visit(node)
     # NOTE: depreceated for version 3.8, not available for version > 3.9
     def visit_Num(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule4")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(4):
             self.applied_rules.add("rule4")
             node = _ast.Str(
@@ -756,10 +936,6 @@ class PerturbAst(ast.NodeTransformer):
         else: return super(PerturbAst, self).generic_visit(node)
     # NOTE: depreceated for version 3.8, not available for version > 3.9
     def visit_Str(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule12")
-            self.valid_rules.add("rule13")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(12):
             self.applied_rules.add("rule12")
             # check if int conversion is allowed.
@@ -783,16 +959,12 @@ class PerturbAst(ast.NodeTransformer):
         else: return super(PerturbAst, self).generic_visit(node)
     
     def visit_Assign(self, node: _ast.Assign) -> Any:
-        if self.rule_checking_mode:
-            if isinstance(node.value, (_ast.Num, _ast.BinOp)):
-                self.valid_rules.add("rule18")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(18):
             # an implementation of ValueMisuse
             new_value = _ast.UnaryOp()
             new_value.op = _ast.USub()
             new_value.operand = node.value
-            node.value = new_value
+            self._set(node, "value", new_value)
             return super(PerturbAst, self).generic_visit(node)
         return super(PerturbAst, self).generic_visit(node)
     # def visit_Compare(self, node):
@@ -800,119 +972,78 @@ class PerturbAst(ast.NodeTransformer):
     #     print(dir(node.ops))
     #     return super(PerturbAst, self).generic_visit(node)
     def visit_Is(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.IsNot()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)   
 
     def visit_IsNot(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.Is()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_In(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.NotIn()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)  
 
     def visit_NotIn(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.In()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)            
 
     def visit_Eq(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.NotEq()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_Lt(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.GtE()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_Gt(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.LtE()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_LtE(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.Gt()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_GtE(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.Lt()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_NotEq(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule6")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(6):
             node = _ast.Eq()
             self.applied_rules.add("rule6")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_And(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule7")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(7):
             node = _ast.Or()
             self.applied_rules.add("rule7")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_Or(self, node):
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule7")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(7):
             node = _ast.And()
             self.applied_rules.add("rule7")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_If(self, node: _ast.IfExp) -> Any:
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule9")
-            if hasattr(node, "orelse"):
-                self.valid_rules.add("rule11")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(9):
             node = _ast.Module(
                 body=node.body, lineno=node.lineno,
@@ -928,11 +1059,6 @@ class PerturbAst(ast.NodeTransformer):
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_IfExp(self, node: _ast.IfExp) -> Any:
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule9")
-            if hasattr(node, "orelse"):
-                self.valid_rules.add("rule11")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(9):
             node = node.body
             # _ast.Expr(
@@ -958,14 +1084,6 @@ class PerturbAst(ast.NodeTransformer):
             except AttributeError: 
                 return super(PerturbAst, self).generic_visit(node)
             full_name = fn_name
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule8")
-            self.valid_rules.add("rule17")
-            if self.is_rule1_applicable(full_name):
-                self.valid_rules.add("rule1")
-            if hasattr(node, "args") and len(node.args) > 1:
-                self.valid_rules.add("rule10")
-            return super(PerturbAst, self).generic_visit(node)
         # check if rule1 is applicable
         if self.is_rule1_applicable(full_name) and self.rule_filter(1):
             self.applied_rules.add("rule1")
@@ -987,14 +1105,11 @@ class PerturbAst(ast.NodeTransformer):
             # arugment swapping rule.
             # print(node.args)
             # print(node.args)
-            node.args = dearrange(node.args)
+            self._set(node, "args", dearrange(node.args))
             self.applied_rules.add("rule10")
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_ListComp(self, node: _ast.ListComp) -> Any:
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule2")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(2):
             self.applied_rules.add("rule2")
             if self.rule_filter.recursive_sub: 
@@ -1015,9 +1130,6 @@ class PerturbAst(ast.NodeTransformer):
         return super(PerturbAst, self).generic_visit(node)
 
     def visit_SetComp(self, node: _ast.ListComp) -> Any:
-        if self.rule_checking_mode:
-            self.valid_rules.add("rule3")
-            return super(PerturbAst, self).generic_visit(node)
         if self.rule_filter(3):
             self.applied_rules.add("rule3")
             if self.rule_filter.recursive_sub: 
@@ -1033,18 +1145,6 @@ class PerturbAst(ast.NodeTransformer):
                 )
         else: return super(PerturbAst, self).generic_visit(node)
 
-def serialize_tree(tree):
-    # convert tree back to code block.
-    content = ""
-    fname = f"{rand_str(16)}.py"
-    with open(fname, "w") as f:
-        Unparser(tree, file=f)
-    with open(fname, "r") as f:
-        content = f.read()
-    os.remove(fname)
-    
-    return content.strip("\n")
-
 def perturb_codes(CODES: List[str], verbose: bool=False) -> List[dict]:
     rule_filter = NegRuleFilter.AllowAll()
     rule_filter.recursive_sub = True
@@ -1121,7 +1221,7 @@ def perturb_multi_threaded(codes: List[str], num_workers: int=4) -> Dict[str, Li
         for j in range(num_workers):
             if num_workers*i+j == len(codes): break
             thread = Thread(
-                target=perturbers[i].generate, 
+                target=perturbers[j].generate, 
                 args=(codes[num_workers*i+j],),
             )
             threads.append(thread)
@@ -37,6 +37,8 @@ class Unparser:
         """Unparser(tree, file=sys.stdout) -> None.
          Print the source for tree to file."""
         self.f = file
+        # `write` is called for every token: use the file's write directly.
+        self.write = file.write
         self._indent = 0
         self.dispatch(tree)
         print("", file=self.f)
@@ -59,14 +61,18 @@ class Unparser:
         "Decrease the indentation level."
         self._indent -= 1
 
+    # unparsing method of every node type dispatched so far (looked up once per type).
+    _methods = {}
     def dispatch(self, tree):
         "Dispatcher function, dispatching tree type T to method _T."
         if isinstance(tree, list):
             for t in tree:
                 self.dispatch(t)
             return
-        meth = getattr(self, "_"+tree.__class__.__name__)
-        meth(tree)
+        meth = self._methods.get(tree.__class__)
+        if meth is None:
+            meth = self._methods[tree.__class__] = getattr(Unparser, "_"+tree.__class__.__name__)
+        meth(self, tree)
 
 
     ############### Unparsing methods ######################
@@ -720,6 +726,12 @@ class Unparser:
             self.write(" as ")
             self.dispatch(t.optional_vars)
 
+def unparse(tree):
+    "Source code of tree (in memory, without the surrounding newlines)."
+    f = io.StringIO()
+    Unparser(tree, file=f)
+    return f.getvalue().strip("\n")
+
 def roundtrip(filename, output=sys.stdout):
     with open(filename, "rb") as pyfile:
         encoding = tokenize.detect_encoding(pyfile.readline)[0]
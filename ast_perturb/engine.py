@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik
+
+# process pool engine for AST negative generation: every worker process builds its `PerturbAst` once, the
+# snippets are handed out in chunks and the results are merged back in input order (so the output doesn't
+# depend on the number of workers). Processes (unlike threads) don't serialize on the GIL.
+import zlib
+import random
+import multiprocessing as mp
+from typing import *
+from tqdm import tqdm
+
+# the perturber of a worker process (created by `_init_worker`).
+_PERTURBER = None
+
+def snippet_seed(code: str) -> int:
+    """stable per snippet seed, so the random parts of generation (argument/variable shuffles)
+    give the same candidates whichever worker (or chunk) a snippet ends up in."""
+    return zlib.crc32(code.encode("utf-8"))
+
+def _init_worker(rule_filter=None):
+    global _PERTURBER
+    from ast_perturb.ast_perturb2 import PerturbAst
+    _PERTURBER = PerturbAst(rule_filter=rule_filter)
+    _PERTURBER.init()
+
+def generate_one(code: str, perturber=None) -> Tuple[str, List[Tuple[str, str]]]:
+    """(candidate, rule) pairs generated for `code` (none if it doesn't parse)."""
+    from ast_perturb import ast_perturb2
+    perturber = _PERTURBER if perturber is None else perturber
+    random.seed(snippet_seed(code))
+    try: candidates = perturber.generate(code)
+    except SyntaxError as e:
+        print(e, code); candidates = []
+    # `generate` also keeps every result in a module level dict (for the threaded setting), don't let it grow.
+    ast_perturb2.AST_NEG_SAMPLES_DB.pop(code, None)
+
+    return code, candidates
+
+def generate_parallel(snippets: List[str], num_workers: Union[int, None]=None, chunk_size: int=64,
+                      rule_filter=None, use_tqdm: bool=True) -> Iterator[Tuple[str, List[Tuple[str, str]]]]:
+    """generate the AST negatives of `snippets` with `num_workers` processes (all cores by default),
+    yielding (snippet, candidates) in the order of `snippets`."""
+    num_workers = mp.cpu_count() if num_workers is None else num_workers
+    pbar = tqdm(total=len(snippets), disable=not(use_tqdm))
+    tot = 0
+    if num_workers <= 1: # no pool (e.g. for debugging).
+        _init_worker(rule_filter)
+        results = map(generate_one, snippets)
+        pool = None
+    else:
+        # fork where possible: the workers inherit the already loaded function signatures.
+        ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+        pool = ctx.Pool(num_workers, initializer=_init_worker, initargs=(rule_filter,))
+        results = pool.imap(generate_one, snippets, chunksize=chunk_size)
+    try:
+        for i, (code, candidates) in enumerate(results):
+            tot += len(candidates)
+            pbar.update(1)
+            pbar.set_description(f"avg AST neg samples: {(tot/(i+1)):.3f}")
+            yield code, candidates
+    finally:
+        pbar.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
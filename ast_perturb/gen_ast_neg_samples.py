@@ -3,13 +3,15 @@
 
 # Author: Atharva Naik
 import os
+import ast
 import json
 import random
+import hashlib
 import argparse
 import numpy as np
 from typing import *
 from tqdm import tqdm
-from ast_perturb.ast_perturb2 import PerturbAst
+from ast_perturb.engine import generate_parallel
 # set logging level of transformers.
 # transformers.logging.set_verbosity_error()
 # seed
@@ -27,8 +29,17 @@ def get_args():
     parser = argparse.ArgumentParser("script to train (using triplet margin loss), evaluate and predict with the CodeBERT in Late Fusion configuration for Neural Code Search.")
     parser.add_argument("-d", "--dataset", type=str, default="CoNaLa", 
                         help=f"dataset to work with from: {DATASETS}")
-    parser.add_argument("-ns", "--num_splits", type=int, default=4)
-    parser.add_argument("-si", "--split_index", type=int, required=True)
+    parser.add_argument("-nw", "--num_workers", type=int, default=None, 
+                        help="no. of worker processes (defaults to all cores)")
+    parser.add_argument("-cs", "--chunk_size", type=int, default=64, 
+                        help="no. of snippets handed to a worker at a time")
+    parser.add_argument("-o", "--output_path", type=str, default=None, 
+                        help="path of the JSONL output (defaults to <dataset>_AST_neg_samples.jsonl), resumed if it exists")
+    parser.add_argument("-fe", "--flush_every", type=int, default=1000, 
+                        help="no. of records written between flushes to disk")
+    # only needed to spread the corpus over several machines.
+    parser.add_argument("-ns", "--num_splits", type=int, default=1)
+    parser.add_argument("-si", "--split_index", type=int, default=0)
     # parser.add_argument("-topk", "--topk", default=10, type=int,
     #                     help="no. of similar intents to be paired with each intent")
     # parser.add_argument("-bs", "--batch_size", type=int, default=64, help="batch size")
@@ -75,6 +86,37 @@ def get_snippets(path) -> List[str]:
         
     return sorted(list(snippets))
 
+def snippet_digest(code: str) -> str:
+    return hashlib.blake2b(code.encode("utf-8"), digest_size=8).hexdigest()
+
+def group_snippets(snippets: List[str]) -> List[List[str]]:
+    """group snippets with the same syntax tree (they only differ in spacing, comments, redundant parentheses
+    etc. and get the same candidates), so that every group is perturbed once."""
+    groups: Dict[str, List[str]] = {}
+    for code in snippets:
+        try: key = snippet_digest(ast.dump(ast.parse(code)))
+        except SyntaxError: key = snippet_digest(code)
+        groups.setdefault(key, []).append(code)
+
+    return list(groups.values())
+
+def load_done_digests(path: str) -> Set[str]:
+    """digests of the snippets already written to the JSONL output at `path`.
+    A partially written last record (left by a crash) is truncated."""
+    done = set()
+    if not os.path.exists(path): return done
+    with open(path, "r+b") as f:
+        good_size = 0
+        for line in f:
+            if not line.endswith(b"\n"): break
+            try: rec = json.loads(line)
+            except ValueError: break
+            good_size += len(line)
+            done.update(snippet_digest(code) for code in rec["snippets"])
+        f.truncate(good_size)
+
+    return done
+
 def round_list(l: list, k: int=3) -> list:
     if isinstance(l, (float, int)):
         return round(l, k)
@@ -90,36 +132,35 @@ if __name__ == "__main__":
     # load all the NL-PL data.
     path = DATASETS_TRAIN_MAP[args.dataset]
     snippets = get_snippets(path)
-    # create AST perturber to generate negative samples.
-    perturber = PerturbAst()
-    perturber.init()
-    # create a map of snippet to AST perturbed negative samples per snippet.
-    snippet_ast_neg_map: Dict[str, List[str]] = {}
-    # index the split.
-    split_size = len(snippets) // args.num_splits
-    print(f"num_splits: {args.num_splits}")
-    print(f"split_index: {args.split_index}")
-    print(f"snippets = snippets[{args.split_index*split_size} : {(args.split_index+1)*split_size}]")
-    snippets = snippets[args.split_index*split_size : (args.split_index+1)*split_size]
-    # generate perturbed AST samples for code snippets.
-    pbar = tqdm(snippets, disable=not(args.use_tqdm))
-    i = 0
-    tot = 0
-    for code in pbar:
-        i += 1
-        # candidates = perturber.generate(code)
-        try: candidates = perturber.generate(code)
-        except SyntaxError as e:
-            print(e, code); candidates = []
-        tot += len(candidates)
-        pbar.set_description(f"avg AST neg samples: {(tot/i):.3f}")
-        snippet_ast_neg_map[code] = candidates
+    if args.num_splits > 1: # index the split.
+        split_size = len(snippets) // args.num_splits
+        print(f"num_splits: {args.num_splits}")
+        print(f"split_index: {args.split_index}")
+        print(f"snippets = snippets[{args.split_index*split_size} : {(args.split_index+1)*split_size}]")
+        snippets = snippets[args.split_index*split_size : (args.split_index+1)*split_size]
+    path = args.output_path
+    if path is None and args.num_splits > 1:
+        path = f"{args.dataset}_AST_neg_samples_{args.num_splits}_{args.split_index+1}.jsonl"
+    elif path is None: path = f"{args.dataset}_AST_neg_samples.jsonl"
+    # skip the snippets written by a previous (interrupted) run.
+    done = load_done_digests(path)
+    todo = [code for code in snippets if snippet_digest(code) not in done]
+    groups = group_snippets(todo)
+    print(f"code snippets: {len(snippets)} ({len(snippets)-len(todo)} already done, {len(groups)} unique trees to perturb)")
+    # generate perturbed AST samples for code snippets (one `PerturbAst` per worker process) and
+    # stream them to the output: one {"snippets": [...], "negs": [[code, rule], ...]} record per group.
+    tot_negs = 0
+    with open(path, "a") as f:
+        for i, (group, (_, candidates)) in enumerate(zip(groups, generate_parallel(
+                [group[0] for group in groups], num_workers=args.num_workers, 
+                chunk_size=args.chunk_size, use_tqdm=args.use_tqdm
+            ))):
+            f.write(json.dumps({"snippets": group, "negs": candidates})+"\n")
+            tot_negs += len(candidates)
+            if (i+1) % args.flush_every == 0:
+                f.flush()
+                os.fsync(f.fileno())
     # statistics of the AST perturbation procedure.
-    avg_neg_samples = np.mean([len(cands) for cands in snippet_ast_neg_map.values()])
-    print(f"code snippets: {len(snippets)}")
-    print(f"code snippets: {avg_neg_samples}")
-    # serialize and save the snippet AST negative samples map.
-    path = f"{args.dataset}_AST_neg_samples_{args.num_splits}_{args.split_index+1}.json"
-    with open(path, "w") as f:
-        json.dump(snippet_ast_neg_map, f)
-# python ast_perturb/gen_ast_neg_sampes.py -d CoNaLa -ns 4 -si 0 -tqdm
\ No newline at end of file
+    print(f"avg AST neg samples: {tot_negs/max(len(groups), 1):.3f}")
+    print(f"saved to {path} (merge into the store used for training with `python -m datautils.neg_store -i {path}`)")
+# python -m ast_perturb.gen_ast_neg_samples -d CoNaLa -nw 16 -tqdm
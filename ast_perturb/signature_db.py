@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik
+
+# compiled, memory mappable form of module_signatures.json (the library function signatures used by rule1).
+# Every string (names, modules, return types, parameter names/kinds, json encoded defaults) is stored once in a
+# utf-8 heap and referred to by id from the record and parameter tables. Function names are looked up by a
+# 64 bit hash (binary search over a sorted table), the library function names are grouped by their last
+# dotted component (for `PerturbAst.is_user_defined`) and the first overload of every function is directly
+# indexable, so a random function is sampled in O(1). Opening the db only maps the file and parses the footer,
+# records are decoded when they are first accessed.
+# build it with: python -m ast_perturb.signature_db -i module_signatures.json
+import os
+import json
+import mmap
+import bisect
+import hashlib
+import argparse
+from array import array
+from typing import *
+
+SIGNATURE_DB_MAGIC = b"SYNCSIG1"
+SIGNATURES_PATH = "module_signatures.json"
+# builtins aren't in the signatures, but calls to them aren't user defined either.
+BUILTIN_FN_NAMES = ["abs", "aiter","all", "any", "anext", "ascii", "bin", "bool", "breakpoint", "bytearray", "bytes", "callable", "chr", "classmethod", "compile", "complex", "delattr", "dict", "dir", "divmod", "enumerate", "eval", "exec", "filter", "float", "format", "frozenset", "getattr", "globals", "hasattr", "hash", "help", "hex", "id", "input", "int", "isinstance", "issubclass", "iter", "len", "list", "locals", "map", "max", "memoryview", "min", "next", "object", "oct", "open", "ord", "pow", "print", "property", "range", "repr", "reversed", "round", "set", "setattr", "slice", "sorted", "staticmethod", "str", "sum", "super", "tuple", "type", "vars", "zip", "__import__"]
+# fields of a signature record/parameter (see `find_method_signatures.py`).
+RECORD_FIELDS = ["name", "module", "qualified_name", "return_type"]
+PARAMETER_FIELDS = ["kind", "has_default_value", "default"]
+
+def name_hash(name: str) -> int:
+    """64 bit hash of a name (stable across processes, unlike `hash`)."""
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+
+def file_fingerprint(path: str) -> Union[Dict[str, float], None]:
+    """size and modification time of a file (None if it doesn't exist), to tell if what was built from it is stale."""
+    if not os.path.exists(path): return None
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def get_lib_fn_names(signatures) -> List[str]:
+    """names and qualified names of every library function (followed by the builtins)."""
+    fn_names = set()
+    for key, value in signatures.items():
+        fn_names.add(key)
+        for rec in value:
+            fn_names.add(rec["qualified_name"])
+    fn_names = list(fn_names)
+    fn_names.extend(BUILTIN_FN_NAMES)
+
+    return fn_names
+
+class _Column:
+    """read-only sequence of the strings referred to by an id section."""
+    def __init__(self, db, ids):
+        self.db = db
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> str:
+        return self.db._str(self.ids[i])
+
+    def __iter__(self):
+        for i in range(len(self.ids)): yield self[i]
+
+class _FirstOverloads:
+    """(name, qualified_name) of the first overload of the i-th function (what `sample_neg_fn` draws from)."""
+    def __init__(self, db):
+        self.db = db
+
+    def __len__(self):
+        return len(self.db)
+
+    def __getitem__(self, i: int) -> Tuple[str, str]:
+        db = self.db
+        r = db.overload_starts[i]
+        return db._str(db.rec_name[r]), db._str(db.rec_qualified_name[r])
+
+class _FnNameIndex:
+    """library function names grouped by their last dotted component (`get` like the dict of `build_fn_name_index`)."""
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, last: str, default=None):
+        db = self.db
+        h = name_hash(last)
+        i = bisect.bisect_left(db.suffix_hashes, h)
+        while i < len(db.suffix_hashes) and db.suffix_hashes[i] == h:
+            if db._str(db.suffix_ids[i]) == last:
+                return [db._str(db.fn_name_ids[j]) for j in range(db.suffix_starts[i], db.suffix_starts[i+1])]
+            i += 1
+
+        return default
+
+    def __contains__(self, last: str):
+        return self.get(last) is not None
+
+class SignatureDB:
+    """
+    read-only, memory mapped function name -> signature records map. Supports the dict interface used
+    for the json loaded signatures (`[]`, `get`, `in`, `len`, iteration in the original key order, `keys`,
+    `values`, `items`) and returns the records in the same format. Decoded records are cached per process.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_len = len(SIGNATURE_DB_MAGIC)
+        assert self._buf[:magic_len] == SIGNATURE_DB_MAGIC == self._buf[-magic_len:], f"{self.path} is not a signature db"
+        footer_len = array("Q", self._buf[-magic_len-8:-magic_len])[0]
+        footer = json.loads(self._buf[-magic_len-8-footer_len:-magic_len-8])
+        self.module_list: List[str] = footer["module_list"]
+        self.num_fns: int = footer["num_fns"]
+        self.num_records: int = footer["num_records"]
+        view = memoryview(self._buf)
+        sections = {}
+        for name, (pos, size, fmt) in footer["sections"].items():
+            sections[name] = view[pos:pos+size].cast(fmt) if fmt != "B" else view[pos:pos+size]
+        self.str_offsets = sections["str_offsets"] # into str_heap, no. of strings+1
+        self.str_heap = sections["str_heap"]
+        self.key_ids = sections["key_ids"] # name of the i-th function (in the order of the json).
+        self.key_hashes = sections["key_hashes"] # sorted hashes of the names.
+        self.key_order = sections["key_order"] # function of the i-th hash.
+        self.overload_starts = sections["overload_starts"] # records of the i-th function: overload_starts[i]:overload_starts[i+1]
+        self.rec_name = sections["rec_name"]
+        self.rec_module = sections["rec_module"]
+        self.rec_qualified_name = sections["rec_qualified_name"]
+        self.rec_return_type = sections["rec_return_type"]
+        self.param_starts = sections["param_starts"] # parameters of the j-th record: param_starts[j]:param_starts[j+1]
+        self.param_name = sections["param_name"]
+        self.param_kind = sections["param_kind"]
+        self.param_has_default = sections["param_has_default"]
+        self.param_default = sections["param_default"] # json encoded default values.
+        self.fn_name_ids = sections["fn_name_ids"] # library function names, grouped by last component.
+        self.suffix_hashes = sections["suffix_hashes"] # sorted hashes of the last components.
+        self.suffix_ids = sections["suffix_ids"]
+        self.suffix_starts = sections["suffix_starts"] # names of the k-th group: suffix_starts[k]:suffix_starts[k+1]
+        self._strs = {}
+        self._records = {}
+        self.fn_names = _Column(self, self.fn_name_ids)
+        self.fn_name_index = _FnNameIndex(self)
+        self.first_overloads = _FirstOverloads(self)
+
+    def _str(self, i: int) -> str:
+        s = self._strs.get(i)
+        if s is None:
+            s = str(self.str_heap[self.str_offsets[i]:self.str_offsets[i+1]], "utf-8")
+            self._strs[i] = s
+        return s
+
+    def __len__(self):
+        return self.num_fns
+
+    def lookup(self, name: str) -> int:
+        """index of the function in the db (-1 if it isn't present)."""
+        h = name_hash(name)
+        i = bisect.bisect_left(self.key_hashes, h)
+        # scan over (extremely unlikely) hash collisions.
+        while i < self.num_fns and self.key_hashes[i] == h:
+            k = self.key_order[i]
+            if self._str(self.key_ids[k]) == name: return k
+            i += 1
+
+        return -1
+
+    def _record(self, j: int) -> dict:
+        params = {}
+        for p in range(self.param_starts[j], self.param_starts[j+1]):
+            params[self._str(self.param_name[p])] = {
+                "kind": self._str(self.param_kind[p]),
+                "has_default_value": bool(self.param_has_default[p]),
+                "default": json.loads(self._str(self.param_default[p])),
+            }
+
+        return {
+            "name": self._str(self.rec_name[j]), "module": self._str(self.rec_module[j]),
+            "qualified_name": self._str(self.rec_qualified_name[j]),
+            "return_type": self._str(self.rec_return_type[j]), "parameters": params,
+        }
+
+    def overloads(self, k: int) -> List[dict]:
+        """signature records of the k-th function."""
+        recs = self._records.get(k)
+        if recs is None:
+            recs = [self._record(j) for j in range(self.overload_starts[k], self.overload_starts[k+1])]
+            self._records[k] = recs
+        return recs
+
+    def __contains__(self, name: str):
+        return self.lookup(name) != -1
+
+    def __getitem__(self, name: str) -> List[dict]:
+        k = self.lookup(name)
+        if k == -1: raise KeyError(name)
+        return self.overloads(k)
+
+    def get(self, name: str, default=None):
+        k = self.lookup(name)
+        if k == -1: return default
+        return self.overloads(k)
+
+    def keys(self) -> Iterator[str]:
+        for k in range(self.num_fns): yield self._str(self.key_ids[k])
+
+    def __iter__(self):
+        return self.keys()
+
+    def values(self) -> Iterator[List[dict]]:
+        for k in range(self.num_fns): yield self.overloads(k)
+
+    def items(self) -> Iterator[Tuple[str, List[dict]]]:
+        for k in range(self.num_fns): yield self._str(self.key_ids[k]), self.overloads(k)
+
+    def __getstate__(self):
+        # memory maps can't be pickled, workers re-open the file instead.
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._open()
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.offsets = array("Q", [0])
+        self.heap = bytearray()
+
+    def intern(self, s: str) -> int:
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.ids)
+            self.ids[s] = i
+            self.heap += s.encode("utf-8")
+            self.offsets.append(len(self.heap))
+        return i
+
+def build_signature_db(module_signatures: Union[str, dict], out_path: str) -> str:
+    """compile the output of `find_method_signatures.py` (path or loaded dict) to a `SignatureDB` at `out_path`."""
+    if isinstance(module_signatures, str): module_signatures = json.load(open(module_signatures))
+    signatures = module_signatures["signatures"]
+    strs = _StringTable()
+    key_ids = array("I")
+    overload_starts = array("I", [0])
+    rec_cols = {field: array("I") for field in RECORD_FIELDS}
+    param_starts = array("I", [0])
+    param_name, param_kind, param_default = array("I"), array("I"), array("I")
+    param_has_default = array("B")
+    for key, recs in signatures.items():
+        key_ids.append(strs.intern(key))
+        for rec in recs:
+            assert set(rec) == set(RECORD_FIELDS+["parameters"]), f"unexpected fields in the signature of {key}: {list(rec)}"
+            for field in RECORD_FIELDS: rec_cols[field].append(strs.intern(rec[field]))
+            for name, param in rec["parameters"].items():
+                assert set(param) == set(PARAMETER_FIELDS), f"unexpected fields in parameter {name} of {key}: {list(param)}"
+                param_name.append(strs.intern(name))
+                param_kind.append(strs.intern(param["kind"]))
+                param_has_default.append(int(param["has_default_value"]))
+                param_default.append(strs.intern(json.dumps(param["default"])))
+            param_starts.append(len(param_name))
+        overload_starts.append(len(rec_cols["name"]))
+    keys = list(signatures)
+    key_order = array("I", sorted(range(len(keys)), key=lambda k: name_hash(keys[k])))
+    key_hashes = array("Q", [name_hash(keys[k]) for k in key_order])
+    # library function names grouped by last component, groups in hash order.
+    groups = {}
+    for fn_name in get_lib_fn_names(signatures):
+        groups.setdefault(fn_name.split(".")[-1], []).append(fn_name)
+    fn_name_ids = array("I")
+    suffix_ids = array("I")
+    suffix_starts = array("I", [0])
+    suffixes = sorted(groups, key=name_hash)
+    for last in suffixes:
+        suffix_ids.append(strs.intern(last))
+        fn_name_ids.extend(strs.intern(fn_name) for fn_name in groups[last])
+        suffix_starts.append(len(fn_name_ids))
+    suffix_hashes = array("Q", [name_hash(last) for last in suffixes])
+    sections = {}
+    tmp_path = out_path+".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SIGNATURE_DB_MAGIC)
+        for name, data in [("str_offsets", strs.offsets), ("str_heap", strs.heap), ("key_ids", key_ids),
+                           ("key_hashes", key_hashes), ("key_order", key_order), ("overload_starts", overload_starts),
+                           ("rec_name", rec_cols["name"]), ("rec_module", rec_cols["module"]),
+                           ("rec_qualified_name", rec_cols["qualified_name"]), ("rec_return_type", rec_cols["return_type"]),
+                           ("param_starts", param_starts), ("param_name", param_name), ("param_kind", param_kind),
+                           ("param_has_default", param_has_default), ("param_default", param_default),
+                           ("fn_name_ids", fn_name_ids), ("suffix_hashes", suffix_hashes), ("suffix_ids", suffix_ids),
+                           ("suffix_starts", suffix_starts)]:
+            f.write(b"\0"*(-f.tell() % 8)) # keep every section 8 byte aligned.
+            pos = f.tell()
+            f.write(data)
+            sections[name] = [pos, f.tell()-pos, data.typecode if isinstance(data, array) else "B"]
+        footer = json.dumps({
+            "module_list": module_signatures["module_list"], "num_fns": len(key_ids),
+            "num_records": len(rec_cols["name"]), "sections": sections,
+        }).encode("utf-8")
+        f.write(footer)
+        f.write(array("Q", [len(footer)]).tobytes())
+        f.write(SIGNATURE_DB_MAGIC)
+    os.replace(tmp_path, out_path)
+
+    return out_path
+
+def signature_db_path(path: str) -> str:
+    """module_signatures.json -> module_signatures.sigdb"""
+    return os.path.splitext(path)[0]+".sigdb"
+
+def load_module_signatures(path: str=SIGNATURES_PATH) -> dict:
+    """{"module_list": ..., "signatures": ...} of `path`, from the compiled db next to it if it is up to date
+    (the signatures are a `SignatureDB` then), from the json otherwise."""
+    db_path = signature_db_path(path)
+    if os.path.exists(db_path):
+        if not os.path.exists(path) or os.path.getmtime(db_path) >= os.path.getmtime(path):
+            db = SignatureDB(db_path)
+            return {"module_list": db.module_list, "signatures": db}
+        print(f"ignoring stale signature db: {db_path} (rebuild it with `python -m ast_perturb.signature_db`)")
+
+    return json.load(open(path))
+
+def get_args():
+    parser = argparse.ArgumentParser("compile the function signatures to a memory mappable db")
+    parser.add_argument("-i", "--input_path", type=str, default=SIGNATURES_PATH)
+    parser.add_argument("-o", "--output_path", type=str, default=None, help="path of the db (defaults to <input path>.sigdb)")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    output_path = signature_db_path(args.input_path) if args.output_path is None else args.output_path
+    build_signature_db(args.input_path, output_path)
+    db = SignatureDB(output_path)
+    print(f"saved {db.num_records} signatures of {len(db)} functions to {output_path}")
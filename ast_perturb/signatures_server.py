@@ -2,12 +2,12 @@ import json
 import jinja2
 from typing import *
 from flask import g, Flask, jsonify, request
+from ast_perturb.signature_db import load_module_signatures
 
 # list of standard python modules (py3.7)
 std_module_list = ['socket', 'fnmatch', 'netrc', 'decimal', 'ssl', 'getpass', 'tracemalloc', 'webbrowser', 'imaplib', 'chunk', 'lzma', 'stat', 'formatter', '_sysconfigdata_powerpc64le_conda_cos7_linux_gnu', 'encodings', 'pathlib', 'bz2', 'optparse', '_sysconfigdata_i686_conda_cos6_linux_gnu', 'asynchat', 'urllib', '_sitebuiltins', 'uu', 'test', 'io', '_py_abc', 'socketserver', 'pipes', 'html', 'ipaddress', 'code', 'genericpath', 'xmlrpc', 'asyncore', 'random', 'struct', 'argparse', 'difflib', 'dis', '__future__', 'tarfile', 'concurrent', 'getopt', 'sched', '_sysconfigdata_aarch64_conda_cos7_linux_gnu', 'locale', '_markupbase', 'dummy_threading', 'dataclasses', 'cgi', 'cmd', 'xml', 'importlib', 'sre_constants', 'wave', 'imghdr', 'threading', 'gettext', 'pstats', 'this', 'pty', 'wsgiref', 'zipfile', '__phello__.foo', 'sqlite3', 'http', 'runpy', '_osx_support', 'contextvars', 'antigravity', 'lib-dynload', 'turtle', 'tree_sitter-0.20.0', 'codeop', 'mimetypes', 'enum', 'tempfile', 'asyncio', 'rlcompleter', 'keyword', '_strptime', '_weakrefset', 'selectors', 'pyclbr', '_pydecimal', 'cgitb', 'telnetlib', 'csv', '_bootlocale', 'imp', 'tree_sitter', 'reprlib', 'typing', '_collections_abc', 'glob', 'macpath', 'ntpath', 'venv', 'nturl2path', '_pyio', 'textwrap', 'ctypes', 'hmac', 'pydoc_data', 'hashlib', 'crypt', 'py_compile', 'cProfile', 'sre_parse', 'uuid', 'functools', 'traceback', 'config-3', 'stringprep', 'compileall', 'contextlib', 'distutils', 'bdb', 'symtable', 'shutil', 'smtplib', 'pydoc', 'numbers', 'symbol', 'json', 'statistics', 'logging', 'shlex', 'doctest', 'token', 'codecs', 'queue', 'copyreg', 'collections', 'trace', '_sysconfigdata_x86_64_conda_cos6_linux_gnu', 'lib2to3', 'plistlib', '_compat_pickle', 'modulefinder', 'ast', 'fractions', 'copy', 'pickle', 'linecache', 'sndhdr', 'gzip', 'mailcap', 'smtpd', 'bisect', 'aifc', 'quopri', 'pprint', 'string', 'weakref', 'inspect', 'site', 'sunau', 'heapq', 'nntplib', 'opcode', 'turtledemo', 'curses', '_sysconfigdata_m_linux_x86_64-linux-gnu', 'ensurepip', 'pdb', 'subprocess', 'mailbox', 'configparser', 'types', 'binhex', 'shelve', 'timeit', 'LICENSE', 'datetime', 'unittest', 'pkgutil', 'profile', 'pickletools', 'abc', 'fileinput', 'warnings', 'operator', 'posixpath', 'multiprocessing', 'email', 'xdrlib', 'calendar', '_sysconfigdata_x86_64_apple_darwin13_4_0', 'struct', 'tkinter', 'ftplib', 'idlelib', 'platform', 'sre_compile', '_dummy_thread', 'poplib', 'secrets', 'signal', 'colorsys', '_compression', 'filecmp', 'tabnanny', '__pycache__', 'sysconfig', 'tty', 'base64', '_threading_local', 'zipapp', 'tokenize', 're', 'dbm', 'os']
 
-with open("module_signatures.json") as f:
-    all_module_signatures = json.load(f)
+all_module_signatures = load_module_signatures("module_signatures.json")
 app = Flask(__name__)
 
 # home page (has search function):
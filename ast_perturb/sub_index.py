@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik
+
+# precomputed substitution index for rule1 (smart library function substitution). The top-k candidates of every
+# library function name are computed once (with a process pool) and saved next to module_signatures.json, so the
+# generation workers only look them up. Names that aren't library functions are ranked by name similarity alone:
+# a character trigram inverted index gives a short list to re-score, then every candidate that could still beat
+# the k-th best score (checked with a cheap character count bound) is scored too, so the rankings are exactly the
+# ones of the full scan.
+# build the index with: python -m ast_perturb.sub_index -w 16
+import os
+import json
+import argparse
+import numpy as np
+from typing import *
+from tqdm import tqdm
+from collections import defaultdict
+from ast_perturb.signature_db import SIGNATURES_PATH, file_fingerprint
+
+SUB_INDEX_PATH = "rule1_sub_index.json"
+TOP_K = 20
+# characters left by fuzzywuzzy's processing (lower case ascii letters, digits and spaces).
+ALPHABET = {c: i for i, c in enumerate(" _0123456789abcdefghijklmnopqrstuvwxyz")}
+# indices loaded by this process (forked workers inherit them).
+_LOADED = {}
+
+def process_name(name: str) -> str:
+    """the string that `fuzz.token_sort_ratio` actually compares for a function name."""
+    from fuzzywuzzy import utils
+    processed = utils.full_process(name.replace("_", " "), force_ascii=True)
+    return " ".join(sorted(processed.split())).strip()
+
+def token_sort_ratio(s1: str, s2: str) -> int:
+    """`fuzz.token_sort_ratio` with difflib's matcher. fuzzywuzzy switches to python-Levenshtein's matcher when
+    it is installed, which scores some pairs differently (changing the rule1 rankings and the bounds below)."""
+    from fuzzywuzzy import utils
+    from difflib import SequenceMatcher
+    s1, s2 = process_name(s1), process_name(s2)
+    if s1 == s2: return 100
+    if len(s1) == 0 or len(s2) == 0: return 0
+
+    return utils.intr(100*SequenceMatcher(None, s1, s2).ratio())
+
+def char_ngrams(s: str, n: int=3) -> Set[str]:
+    padded = f" {s} "
+    return {padded[i:i+n] for i in range(max(1, len(padded)-n+1))}
+
+def char_counts(s: str) -> np.ndarray:
+    counts = np.zeros(len(ALPHABET), dtype=np.int32)
+    for c in s:
+        if c in ALPHABET: counts[ALPHABET[c]] += 1
+    return counts
+
+class Rule1SubIndex:
+    """top-k rule1 substitution candidates, as (name, score, score breakup) lists
+    ranked like `PerturbAst.rank_rule1_candidates` (for `candidates` in signature order).
+    `source`: fingerprint (`file_fingerprint`) of the signatures file the rankings were computed from."""
+    def __init__(self, table: Dict[str, list], candidates: List[str], top_k: int=TOP_K,
+                 shortlist_size: int=256, source: Union[Dict[str, float], None]=None):
+        self.table = table
+        self.candidates = candidates
+        self.source = source
+        self.top_k = top_k
+        self.shortlist_size = shortlist_size
+        self._postings = None
+
+    @classmethod
+    def build(cls, signatures: dict, top_k: int=TOP_K, num_workers: Union[int, None]=None,
+              chunk_size: int=16, use_tqdm: bool=True, source_path: str=SIGNATURES_PATH):
+        """rank the candidates of every library function name (the expensive part, done once)."""
+        import multiprocessing as mp
+        from ast_perturb import engine
+        names = list(signatures)
+        num_workers = mp.cpu_count() if num_workers is None else num_workers
+        ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+        table = {}
+        with ctx.Pool(num_workers, initializer=engine._init_worker) as pool:
+            for name, ranked in tqdm(pool.imap(_rank_top_k, ((name, top_k) for name in names), chunksize=chunk_size),
+                                     total=len(names), disable=not(use_tqdm), desc="ranking rule1 candidates"):
+                table[name] = ranked
+
+        return cls(table, names, top_k=top_k, source=file_fingerprint(source_path))
+
+    def save(self, path: str=SUB_INDEX_PATH):
+        tmp_path = path+".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"top_k": self.top_k, "source": self.source, "candidates": self.candidates, "table": self.table}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str=SUB_INDEX_PATH):
+        data = json.load(open(path))
+        return cls(data["table"], data["candidates"], top_k=data["top_k"], source=data.get("source"))
+
+    def _build_name_index(self):
+        self._postings = defaultdict(list) # trigram -> candidate ids.
+        processed = [process_name(name) for name in self.candidates]
+        for i, name in enumerate(processed):
+            for gram in char_ngrams(name): self._postings[gram].append(i)
+        self._lengths = np.array([len(name) for name in processed])
+        self._counts = np.stack([char_counts(name) for name in processed])
+
+    def get(self, fn_name: str, name_scorer: Callable[[str, str], float]) -> list:
+        """top-k candidates for `fn_name`: looked up for library functions, searched otherwise."""
+        ranked = self.table.get(fn_name)
+        if ranked is not None: return ranked
+        return self.search(fn_name, name_scorer)
+
+    def search(self, fn_name: str, name_scorer: Callable[[str, str], float]) -> list:
+        """top-k candidates for a name with no signature (ranked by `name_scorer` alone)."""
+        if self._postings is None: self._build_name_index()
+        query = process_name(fn_name)
+        # short list: candidates sharing the most trigrams with the name.
+        hits = defaultdict(int)
+        for gram in char_ngrams(query):
+            for i in self._postings.get(gram, []): hits[i] += 1
+        shortlist = sorted(hits, key=lambda i: -hits[i])[:self.shortlist_size]
+        scores = {i: name_scorer(fn_name, self.candidates[i]) for i in shortlist}
+        threshold = sorted(scores.values(), reverse=True)[self.top_k-1] if len(scores) >= self.top_k else 0
+        # the similarity ratio is at most 2*(shared characters)/(total length), rounded to a percentage
+        # like fuzzywuzzy does: score every other candidate whose bound reaches the k-th best score.
+        lengths = self._lengths+len(query)
+        shared = np.minimum(self._counts, char_counts(query)).sum(axis=1)
+        bound = np.floor(100*2*shared/np.maximum(lengths, 1)+0.5+1e-6)/100
+        bound[lengths == 0] = 1
+        for i in np.nonzero(bound >= threshold-1e-6)[0].tolist():
+            if i not in scores: scores[i] = name_scorer(fn_name, self.candidates[i])
+        # ties are broken by signature order (like the stable sort of the full scan).
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:self.top_k]
+
+        return [(self.candidates[i], score, {"name_sim_score": score}) for i, score in ranked]
+
+def _rank_top_k(args: Tuple[str, int]) -> Tuple[str, list]:
+    from ast_perturb import engine
+    name, top_k = args
+    ranked = engine._PERTURBER.rank_rule1_candidates(name)[:top_k]
+    return name, [list(entry) for entry in ranked]
+
+def get_sub_index(signatures: dict, path: str=SUB_INDEX_PATH,
+                  source_path: str=SIGNATURES_PATH) -> Union[Rule1SubIndex, None]:
+    """the substitution index at `path` (loaded once per process), if it was built for `signatures`
+    (the same names and, as far as the size & modification time of `source_path` tell, the same signatures)."""
+    if path not in _LOADED:
+        index = None
+        if os.path.exists(path):
+            index = Rule1SubIndex.load(path)
+            source = file_fingerprint(source_path)
+            if index.candidates != list(signatures) or (source is not None and index.source != source):
+                print(f"ignoring stale rule1 substitution index: {path} (rebuild it with `python -m ast_perturb.sub_index`)")
+                index = None
+        _LOADED[path] = index
+
+    return _LOADED[path]
+
+def get_args():
+    parser = argparse.ArgumentParser("precompute the rule1 (smart library function substitution) candidates")
+    parser.add_argument("-o", "--output_path", type=str, default=SUB_INDEX_PATH)
+    parser.add_argument("-k", "--top_k", type=int, default=TOP_K, help="no. of candidates kept per function name")
+    parser.add_argument("-w", "--num_workers", type=int, default=None, help="no. of worker processes (defaults to all cores)")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    from ast_perturb.ast_perturb2 import signatures
+    args = get_args()
+    index = Rule1SubIndex.build(signatures, top_k=args.top_k, num_workers=args.num_workers)
+    index.save(args.output_path)
+    print(f"saved the candidates of {len(index.table)} function names to {args.output_path}")
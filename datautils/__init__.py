@@ -9,14 +9,19 @@ import torch
 import random
 import numpy as np
 from typing import *
+from array import array
 from tqdm import tqdm
 import torch.nn as nn
+from datautils import telemetry
 from datautils.utils import *
 import torch.nn.functional as F
 from collections import defaultdict
 from transformers import RobertaTokenizer
 from torch.utils.data import Dataset, DataLoader
 from scripts.create_code_code_pairs import CodeSynsets
+from datautils.neg_store import ASTNegStore, build_ast_neg_store, load_perturbed_codes
+from datautils.online_negs import OnlineASTNegatives
+from datautils.curriculum import MasteringRate, CurriculumScheduler, CURRICULUM_TYPES
 
 # list of available models. 
 WORST_RULES_LIST = ["rule1", "rule3", "rule8", "rule11", "rule13", "rule17"] # the worst 6 rules
@@ -25,6 +30,12 @@ DISCO_IGNORE_LIST = ["rule1", "rule2", "rule3", "rule5", "rule7",
                      "rule8", "rule16", "rule17", "rule18"] # rules to be ignore to follow DISCO
 UNNATURAL_IGNORE_LIST = ["rule8", "rule12", "rule13", "rule14", "rule15", "rule17"]
 NEW_RULES_IGNORE_LIST = ["rule10", "rule11", "rule14", "rule15", "rule16", "rule17", "rule18"]
+# rule filters precomputed by the AST negatives store (see datautils/neg_store.py).
+RULE_IGNORE_LISTS = {
+    "new": NEW_RULES_IGNORE_LIST, "worst": WORST_RULES_LIST, 
+    "disco": DISCO_IGNORE_LIST, "worst_old": WORST_OLD_RULES_LIST, 
+    "unnatural": UNNATURAL_IGNORE_LIST,
+}
 MODEL_OPTIONS = ["codebert", "graphcodebert", "unixcoder"]
 #     anchor["input_ids"][0], anchor["attention_mask"][0], 
 #     pos["input_ids"][0], pos["attention_mask"][0],
@@ -176,6 +187,8 @@ def batch_shuffle_collate_fn(batch):
     return [anchor, pos, neg, is_hard_neg_mask]
     
 # dynamic dataloader class: has custom collating function that can use IDNS if needed.
+# the collate function runs `model`: to take it off the critical path wrap the loader in `models.MiningPrefetcher`
+# and point `model` at the mining snapshot (`prefetcher.bind(loader, get=lambda net: net.embed_model)`).
 class DynamicDataLoader(DataLoader):
     def __init__(self, *args, device: str="cpu", 
                  model=None, model_name="unixcoder", **kwargs):
@@ -211,7 +224,7 @@ class DynamicDataLoader(DataLoader):
             pos.append(batch[i][1])
         # re-order the soft negatives stored in the shuffle map.
         self.model.eval()
-        with torch.no_grad():
+        with torch.no_grad(), telemetry.stage("mining"):
             soft_neg_cands = torch.stack(soft_neg_cands)
             soft_neg_queries = torch.stack(soft_neg_queries)
             _, enc_intents = self.model(soft_neg_queries.to(self.device))
@@ -243,53 +256,6 @@ class DynamicDataLoader(DataLoader):
 
         return [anchor, pos, neg, is_hard_neg_mask]
     
-# 1-D float buffer and mastering rate calculation.
-class MasteringRate:
-    def __init__(self, role: int=0, size: int=20, 
-                 p: float=2, delta: float=0.5):
-        self.acc_buffer = np.zeros(size)
-        self.window_size = size
-        self.delta = delta
-        self.p = p
-        self.role = role # role of 0 corresponds to soft accuracy and hard corresponds to 1
-        self.window_mean = 0
-        self.mean_size = (size+1)/2
-        
-    def __call__(self):
-        return self.window_mean
-        
-    def __repr__(self):
-        return repr(self.acc_buffer)
-    
-    def __str__(self):
-        return f"{self.role}:[{self.window_size}]:={self.window_mean:.3f}(p={self.p}, δ={self.delta})"
-        
-    def beta(self):
-        """Calculate slope of linear regression for returns/accuracies
-        for the attention computation."""
-        t = 1+np.array(range(self.window_size))
-        M = self.mean_size + np.zeros(self.window_size)
-        NUM = (t-M)*(self.acc_buffer-self.window_mean)
-        DENOM = ((t-M)**2)
-        
-        return NUM.sum()/DENOM.sum()
-        
-    def attn(self, other):
-        """calculate the attention for the task from the mastering rate.
-        `other_master_rate`: the window mean of the other master rate object."""
-        beta = self.beta()
-        beta_max = max(beta, other.beta())
-        if beta_max != 0: beta = beta/beta_max
-        if self.role == 0:
-            return (self.delta*(1-self.window_mean) + (1-self.delta)*beta)*(1-other.window_mean)
-        else:
-            return (other.window_mean**self.p)*(self.delta*(1-self.window_mean) + (1-self.delta)*beta)
-        
-    def push_acc(self, acc: float):
-        for i in range(self.window_size-1):
-            self.acc_buffer[i] = self.acc_buffer[i+1]
-        self.acc_buffer[-1] = acc
-        self.window_mean = self.acc_buffer.mean()
 # class DynamicTriplesDataset(Dataset):
 #     def __init__(self, path: str, model_name: str, model=None, tokenizer=None,
 #                  use_AST=False, val=False, warmup_steps=3000, beta=0.001, p=2,
@@ -743,25 +709,10 @@ class AllModelsDataset(Dataset):
         self.ignore_old_worst_rules = ignore_old_worst_rules
         self.ignore_unnatural_rules = ignore_unnatural_rules
         self.ignore_non_disco_rules = ignore_non_disco_rules
-        if path.endswith(".jsonl"):
-            self.data = read_jsonl(path) # NL-PL pairs.
-        # if filename endswith json:
-        elif path.endswith(".json"):
-            self.data = json.load(open(path)) # NL-PL pairs.
-        # if filename endswith jsonl:
-        if path.endswith(".jsonl"):
-            self.data = read_jsonl(path) # NL-PL pairs.
-        # if filename endswith json:
-        elif path.endswith(".json"):
-            self.data = json.load(open(path)) # NL-PL pairs.
+        # NL-PL pairs (.jsonl, .json or .cols), records are parsed lazily on access.
+        self.data = open_records(path)
         # parser is needed for GraphCodeBERT to get the dataflow.
-        if model_name == "graphcodebert":
-            from datautils.parser import DFG_python
-            from tree_sitter import Language, Parser
-            PARSER =  Parser()
-            LANGUAGE = Language('datautils/py_parser.so', 'python')
-            PARSER.set_language(LANGUAGE)
-            self.parser = [PARSER, DFG_python]
+        if model_name == "graphcodebert": self.parser = self._load_parser()
         self.model_name = model_name
         self.tok_args = tok_args
         if isinstance(tokenizer, RobertaTokenizer): 
@@ -772,6 +723,27 @@ class AllModelsDataset(Dataset):
 
     def __len__(self):
         return len(self.data)
+
+    def _load_parser(self) -> list:
+        from datautils.parser import DFG_python
+        from tree_sitter import Language, Parser
+        PARSER =  Parser()
+        LANGUAGE = Language('datautils/py_parser.so', 'python')
+        PARSER.set_language(LANGUAGE)
+
+        return [PARSER, DFG_python]
+
+    def __getstate__(self):
+        # for DataLoader workers started with spawn: the tree-sitter parser can't be pickled (it is reloaded),
+        # and the model used for mining stays in the main process (see `DynamicTriplesDataset.defer_mining`).
+        state = self.__dict__.copy()
+        state.pop("parser", None)
+        if "model" in state: state["model"] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if self.model_name == "graphcodebert": self.parser = self._load_parser()
     
     def _proc_text(self, text: str) -> str:
         text = " ".join(text.split("\n"))
@@ -828,29 +800,96 @@ class AllModelsDataset(Dataset):
         
         return nl_ids
         
+    def _active_rule_filters(self) -> List[str]:
+        """names of the rule filters (keys of RULE_IGNORE_LISTS) selected by the ignore flags."""
+        flags = {
+            "new": self.ignore_new_rules, "worst": self.ignore_worst_rules,
+            "disco": self.ignore_non_disco_rules, "worst_old": self.ignore_old_worst_rules,
+            "unnatural": self.ignore_unnatural_rules,
+        }
+        return [name for name, flag in flags.items() if flag]
+
+    def _build_hard_neg_index(self, perturbed_codes: Union[dict, ASTNegStore], 
+                              snippets: Iterable[str], rule_filters: Union[List[str], None]=None):
+        """materialize the rule filtered AST negatives (and integer rule ids) of every snippet
+        once, so that fetching an item only slices `hard_neg_codes`/`hard_neg_rules`."""
+        if rule_filters is None: rule_filters = self._active_rule_filters()
+        ignored_rules = set()
+        for name in rule_filters: ignored_rules.update(RULE_IGNORE_LISTS[name])
+        rule_ids = {} # cache of parsed rule ids.
+        # snippet -> (start, end) in hard_neg_rules and hard_neg_codes (or hard_neg_ids for a store).
+        self.hard_neg_spans: Dict[str, Tuple[int, int]] = {}
+        self.hard_neg_rules = array("B")
+        self.hard_neg_codes: List[str] = []
+        # negatives in a memory mapped store are kept as ids, so they aren't copied to the heap.
+        self.hard_neg_store = perturbed_codes if isinstance(perturbed_codes, ASTNegStore) else None
+        self.hard_neg_ids = array("Q")
+        # online negatives are generated (or fetched from the cache) when a snippet's negatives are needed.
+        self.online_hard_negs = perturbed_codes if isinstance(perturbed_codes, OnlineASTNegatives) else None
+        self.hard_neg_rule_filters = rule_filters
+        if self.online_hard_negs is not None: return
+        for PL in snippets:
+            if PL in self.hard_neg_spans: continue
+            start = len(self.hard_neg_rules)
+            if self.hard_neg_store is not None:
+                i = self.hard_neg_store.lookup(PL)
+                if i != -1:
+                    mask = self.hard_neg_store.filter_mask(rule_filters)
+                    for j in range(*self.hard_neg_store.neg_range(i)):
+                        rule_id = self.hard_neg_store.rule_ids[j]
+                        if rule_id == 0 or (self.hard_neg_store.filter_bits[j] & mask) != mask: continue
+                        self.hard_neg_ids.append(j)
+                        self.hard_neg_rules.append(rule_id)
+            else:
+                for tup in perturbed_codes.get(PL, []):
+                    if isinstance(tup, str) or tup[1] in ignored_rules: continue
+                    if tup[1] not in rule_ids: rule_ids[tup[1]] = int(tup[1].replace("rule",""))
+                    self.hard_neg_codes.append(tup[0])
+                    self.hard_neg_rules.append(rule_ids[tup[1]])
+            self.hard_neg_spans[PL] = (start, len(self.hard_neg_rules))
+
+    def _get_hard_neg_cands(self, PL: str) -> Tuple[List[str], List[int]]:
+        """rule filtered AST negatives and rule ids of a snippet (from `_build_hard_neg_index`)."""
+        if self.online_hard_negs is not None:
+            with telemetry.stage("ast_perturb"):
+                return self.online_hard_negs.get_negatives(PL, ignore=self.hard_neg_rule_filters)
+        start, end = self.hard_neg_spans.get(PL, (0, 0))
+        if self.hard_neg_store is not None:
+            codes = [self.hard_neg_store.neg_code(j) for j in self.hard_neg_ids[start:end]]
+        else: codes = self.hard_neg_codes[start:end]
+
+        return codes, self.hard_neg_rules[start:end].tolist()
+
     def _retrieve_best_triplet(self, NL: str, PL: str, use_AST: bool, 
                                batch_size: int=48, stochastic=True,
                                backup_neg: Union[str, None]=None):
-        rindex = 0
+        codes_for_sim_intents, rules_for_sim_intents = self._get_neg_cands(NL, PL, use_AST)
+
+        return self._mine_triplet(NL, PL, codes_for_sim_intents, rules_for_sim_intents, 
+                                  backup_neg=backup_neg, batch_size=batch_size, 
+                                  stochastic=stochastic)
+
+    def _get_neg_cands(self, NL: str, PL: str, use_AST: bool) -> Tuple[List[str], List[int]]:
+        """candidate hard negatives (and rule ids) of a triplet: AST negatives or codes of similar intents."""
         codes_for_sim_intents: List[str] = []
         rules_for_sim_intents: List[int] = []
         if use_AST: # when using AST only use AST.
-            for tup in self.perturbed_codes[PL]: # codes from AST.
-                if self.ignore_new_rules and tup[1] in NEW_RULES_IGNORE_LIST: continue
-                elif self.ignore_worst_rules and tup[1] in WORST_RULES_LIST: continue
-                elif self.ignore_non_disco_rules and tup[1] in DISCO_IGNORE_LIST: continue
-                elif self.ignore_old_worst_rules and tup[1] in WORST_OLD_RULES_LIST: continue
-                elif self.ignore_unnatural_rules and tup[1] in UNNATURAL_IGNORE_LIST: continue
-                if isinstance(tup, str): continue
-                rule_index = int(tup[1].replace("rule",""))
-                codes_for_sim_intents.append(tup[0])
-                rules_for_sim_intents.append(rule_index)
+            # codes from AST (filtered by the active ignore lists at construction).
+            codes_for_sim_intents, rules_for_sim_intents = self._get_hard_neg_cands(PL)
             # print(codes_for_sim_intents)
         else: # TODO: add a flag for IDNS.
             sim_intents: List[str] = self.sim_intents_map[NL]
             for intent, _ in sim_intents:
                 codes_for_sim_intents += self.intent_to_code[intent]
                 rules_for_sim_intents += [-1]*len(self.intent_to_code[intent])
+
+        return codes_for_sim_intents, rules_for_sim_intents
+
+    def _mine_triplet(self, NL: str, PL: str, codes_for_sim_intents: List[str], 
+                      rules_for_sim_intents: List[int], backup_neg: Union[str, None]=None,
+                      batch_size: int=48, stochastic=True):
+        """pick the hard negative among the candidates with the model."""
+        rindex = 0
         # print("codes_for_sim_intents:", codes_for_sim_intents)
         if len(codes_for_sim_intents) == 0: # if no pool of backup candidates is available.
             neg = backup_neg
@@ -859,7 +898,7 @@ class AllModelsDataset(Dataset):
             # if len(codes_for_sim_intents) == 1: 
             #     codes_for_sim_intents += backup_neg
             #     rules_for_sim_intents += 0
-            with torch.no_grad():
+            with torch.no_grad(), telemetry.stage("mining"):
                 enc_text = torch.stack(self.model.encode_emb([NL], mode="text", 
                                                              batch_size=batch_size,
                                                              device_id=self.device)) # 1 x hidden_size
@@ -987,6 +1026,14 @@ class AllModelsDataset(Dataset):
                 torch.tensor(hard_neg),
                )
 
+class PendingTriplet(NamedTuple):
+    """triplet whose hard negative is still to be picked among the candidates `codes` (with rule ids `rules`)."""
+    NL: str
+    PL: str
+    codes: List[str]
+    rules: List[int]
+    backup_neg: str
+
 # Dataset for dynamic creation of triples.
 class DynamicTriplesDataset(AllModelsDataset):
     def __init__(self, path: str, model_name: str, model=None, tokenizer=None,
@@ -1003,53 +1050,30 @@ class DynamicTriplesDataset(AllModelsDataset):
         # self.rand_curriculum = rand_curriculum
         # check if valid curriculum type:
         msg = f"invalid curriculum type: {curriculum_type}"
-        assert curriculum_type in ["mr", "rand", "lp", 
-                                   "exp", "hard", "soft"], msg
+        assert curriculum_type in CURRICULUM_TYPES, msg
         self.curriculum_type = curriculum_type
-        if curriculum_type != "mr": 
-            warmup_steps = 0
-        self.step_ctr = 0
         self.num_epochs = num_epochs
         self.batch_size = batch_size
-        self.warmup_steps = warmup_steps
         # self.milestone_updater = MilestoneUpdater()
         self.p = p
         self.beta = beta
         self.epsilon = epsilon
-        self.soft_master_rate = MasteringRate(
-            role=0, delta=delta,
-            p=p, size=win_size, 
-        )
-        self.hard_master_rate = MasteringRate(
-            role=1, delta=delta,
-            p=p, size=win_size, 
-        )
         self.soft_neg_bias = soft_neg_bias
-        self.soft_neg_weight = 0.8
-        self.hard_neg_weight = 0.2
-        if self.curriculum_type == "hard":
-            self.soft_neg_weight = 0
-            self.hard_neg_weight = 1
-        elif self.curriculum_type == "soft":
-            self.soft_neg_weight = 1
-            self.hard_neg_weight = 0
         self.model = model # pointer to model instance to find closest NL & PL examples
         self.sim_intents_map = sim_intents_map
         self.perturbed_codes = perturbed_codes
         self.use_AST = use_AST
         self.device = device
         self.val = val
+        # return the hard triplets as `PendingTriplet`s, so the DataLoader workers (which don't have the model)
+        # only make the candidates and `mine_batch` picks the negatives in the main process.
+        self.defer_mining = False
         self.lp_s = 0
         self.lp_h = 0
-        # create a mapping of NL to all associated PLs. 
-        self.intent_to_code = {}
-        for rec in self.data:
-            try: intent = rec["intent"]
-            except TypeError: intent = rec[0]
-            try: snippet = rec["snippet"]
-            except TypeError: snippet = rec[1]
-            try: self.intent_to_code[intent].append(snippet)
-            except KeyError: self.intent_to_code[intent] = [snippet]
+        # mapping of NL to all associated PLs (grouped once and cached next to the data, read lazily).
+        self.intent_to_code = RecordGroups(self.data, key_fields=[0], value_fields=[1])
+        if use_AST:
+            self._build_hard_neg_index(perturbed_codes, (rec[1] for rec in self.data))
         if curriculum_type == "exp":
             assert batch_size is not None, "need batch size for exponential decay curriculum"
             assert num_epochs is not None, "need num epochs for exponential decay curriculum"
@@ -1057,70 +1081,67 @@ class DynamicTriplesDataset(AllModelsDataset):
             half_life_frac = 0.8 # this means the weights will be halved when 50% of training is complete
             self.Z = N*half_life_frac
             print("using exponentialy decaying curriculum")
+        # soft/hard negative weights (shared with the DataLoader workers) and mastering rates.
+        self.curriculum = CurriculumScheduler(
+            curriculum_type, warmup_steps=warmup_steps, p=p,
+            delta=delta, epsilon=epsilon, win_size=win_size,
+            soft_neg_bias=soft_neg_bias, batch_size=batch_size,
+            Z=getattr(self, "Z", None),
+        )
         
+    # the curriculum state lives in the scheduler (these are read by the fit loops and configs).
+    @property
+    def soft_master_rate(self) -> MasteringRate:
+        return self.curriculum.soft_master_rate
+
+    @property
+    def hard_master_rate(self) -> MasteringRate:
+        return self.curriculum.hard_master_rate
+
+    @property
+    def warmup_steps(self) -> int:
+        return self.curriculum.warmup_steps
+
+    @property
+    def soft_neg_weight(self) -> float:
+        return self.curriculum.soft_neg_weight
+
+    @property
+    def hard_neg_weight(self) -> float:
+        return self.curriculum.hard_neg_weight
+
     def update(self, soft_acc: float, hard_acc: float):
         # self.milestone_updater.update(acc)
-        self.soft_master_rate.push_acc(soft_acc)
-        self.hard_master_rate.push_acc(hard_acc)
-        if self.curriculum_type == "mr":
-            if self.warmup_steps > 0: self.warmup_steps -= 1; return 
-            a_s = self.soft_master_rate.attn(self.hard_master_rate)
-            a_h = self.hard_master_rate.attn(self.soft_master_rate)
-            attn_dist = F.softmax(torch.as_tensor([a_s, a_h]), dim=0)
-            bias_dist = torch.as_tensor([self.soft_neg_bias, 1-self.soft_neg_bias])
-            weights = (1-self.epsilon)*attn_dist + self.epsilon*bias_dist
-            weights = weights.numpy()
-        elif self.curriculum_type == "exp":
-            self.step_ctr += self.batch_size
-            r = self.step_ctr/self.Z
-            weights = [np.exp(-np.log(2)*r)]
-        elif self.curriculum_type == "lp":
-            lp_s = self.soft_master_rate()
-            lp_h = self.hard_master_rate()
-            a_s = (1-lp_s)*(1-lp_h)
-            a_h = (lp_s**self.p)*(1-lp_h)
-            self.lp_s, self.lp_h = lp_s, lp_h
-            weights = F.softmax(torch.as_tensor([a_s, a_h]), dim=0)
-        elif self.curriculum_type == "hard":
-            weights = [0]
-        elif self.curriculum_type == "soft":
-            weights = [1]
-        self.soft_neg_weight = weights[0]
-        self.hard_neg_weight = 1-weights[0]
+        self.curriculum.update(soft_acc, hard_acc)
+
+    def state_dict(self) -> dict:
+        """state of the curriculum (changed by `update`)."""
+        return self.curriculum.state_dict()
+
+    def load_state_dict(self, state: dict):
+        self.curriculum.load_state_dict(state)
         
     def mix_step(self):
         # if self.milestone_updater.warmup_steps > 0: 
         #     return f"warmup({self.milestone_updater.warmup_steps}) {self.milestone_updater.mixing_rate}({self.milestone_updater.steps[self.milestone_updater.i]}) "
         # else: return f"mix: {self.milestone_updater.mixing_rate}({self.milestone_updater.steps[self.milestone_updater.i]}) "
-        if self.curriculum_type == "mr":
-            if self.warmup_steps > 0:
-                return f"w({self.warmup_steps}) "
-            else: return f"{self.soft_neg_weight:.3f}|{self.hard_neg_weight:.3f} "
-        elif self.curriculum_type == "lp":
-            return f"{self.soft_neg_weight:.3f}|{self.hard_neg_weight:.3f} s:{self.lp_s:.3f}|h:{self.lp_h:.3f} "
-        elif self.curriculum_type == "exp":
-            r = self.step_ctr/self.Z
-            return f"{self.soft_neg_weight:.3f}|{self.hard_neg_weight:.3f} r:{r:.3f} "
-        elif self.curriculum_type == "hard":
-            return ""
+        return self.curriculum.mix_step()
     
     def _sample_rand_triplet(self, NL: str, PL: str):
-        codes = []
-        for intent in self.intent_to_code:
-            if intent != NL: 
-                codes += self.intent_to_code[intent]
+        codes = [rec[1] for rec in self.data if rec[0] != NL]
                 
         return NL, PL, random.choice(codes)
         
     def __getitem__(self, item: int):
         # combined get item for all 3 models: CodeBERT, GraphCodeBERT, UniXcoder.
-        if self.val or self.warmup_steps > 0:
+        soft_neg_weight, hard_neg_weight, warmup_steps = self.curriculum.weights()
+        if self.val or warmup_steps > 0:
             hard_neg = 0
         else:
             hard_neg = np.random.choice(
                 [0, 1], p=[
-                    self.soft_neg_weight, 
-                    self.hard_neg_weight,
+                    soft_neg_weight, 
+                    hard_neg_weight,
                 ])
         # if curriculum is turned off then just use hard negatives all the time.
         if not self.use_curriculum: hard_neg = 1
@@ -1132,6 +1153,10 @@ class DynamicTriplesDataset(AllModelsDataset):
             #     PL=self.data[item]["snippet"],
             #     use_AST=self.use_AST,
             # )
+            if self.defer_mining:
+                NL, PL = self.data[item][0], self.data[item][1]
+                codes, rules = self._get_neg_cands(NL, PL, use_AST=self.use_AST)
+                return PendingTriplet(NL, PL, codes, rules, backup_neg=self.data[item][2])
             anchor, pos, neg, hard_neg = self._retrieve_best_triplet(
                 NL=self.data[item][0], PL=self.data[item][1],
                 use_AST=self.use_AST, backup_neg=self.data[item][2], # required if no AST based candidates available.
@@ -1148,22 +1173,61 @@ class DynamicTriplesDataset(AllModelsDataset):
             anchor = self.data[item][0]
             pos = self.data[item][1]
             neg = self.data[item][2]
-        anchor = self._proc_text(anchor)
-        pos = self._proc_code(pos)
-        neg = self._proc_code(neg)
-        if self.model_name == "codebert":
-            return self._codebert_getitem(anchor, pos, neg, hard_neg)
-        elif self.model_name == "graphcodebert":
-            return self._graphcodebert_getitem(anchor, pos, neg, hard_neg)
-        elif self.model_name == "unixcoder":
-            return self._unixcoder_getitem(anchor, pos, neg, hard_neg)
+
+        return self._encode_triplet(anchor, pos, neg, hard_neg)
+
+    def mine_batch(self, items: list) -> list:
+        """encoded items of a batch made by the DataLoader workers with `defer_mining`: the hard negatives of
+        the `PendingTriplet`s are picked with the model (in the calling process)."""
+        for i, item in enumerate(items):
+            if isinstance(item, PendingTriplet):
+                items[i] = self._encode_triplet(*self._mine_triplet(
+                    item.NL, item.PL, item.codes, item.rules, 
+                    backup_neg=item.backup_neg,
+                ))
+
+        return items
+
+    def _encode_triplet(self, anchor: str, pos: str, neg: str, hard_neg: int):
+        with telemetry.stage("tokenize"):
+            anchor = self._proc_text(anchor)
+            pos = self._proc_code(pos)
+            neg = self._proc_code(neg)
+            if self.model_name == "codebert":
+                return self._codebert_getitem(anchor, pos, neg, hard_neg)
+            elif self.model_name == "graphcodebert":
+                return self._graphcodebert_getitem(anchor, pos, neg, hard_neg)
+            elif self.model_name == "unixcoder":
+                return self._unixcoder_getitem(anchor, pos, neg, hard_neg)
+
+class DeferredMiningLoader:
+    """
+    iterates over the batches of a `DataLoader` with workers for a `DynamicTriplesDataset`: the workers load
+    the triplets and make the hard negative candidates (e.g. generate the AST negatives), then the negatives
+    are picked with the model and the batch is collated in the iterating process (the main process, or the
+    thread of a `MiningPrefetcher` wrapping this loader). Sets `defer_mining` of the dataset and replaces the
+    collate function of the loader (workers return the items as they are).
+    """
+    def __init__(self, loader: DataLoader, dataset: DynamicTriplesDataset):
+        self.loader = loader
+        self.dataset = dataset
+        self.collate_fn = loader.collate_fn
+        loader.collate_fn = list
+        dataset.defer_mining = True
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for items in self.loader:
+            yield self.collate_fn(self.dataset.mine_batch(items))
 
 # Retrieval based validation.
 class ValRetDataset(Dataset):
     """JUST a convenience class to convert NL-PL pairs to retrieval setting."""
     def __init__(self, path: str):
         super(ValRetDataset, self).__init__()
-        self.data = json.load(open(path))
+        self.data = open_records(path)
         posts = {} # query to candidate map.
         cands = {} # unique candidates
         tot = 0
@@ -1348,21 +1412,24 @@ class CodeRetrieverDataset(AllModelsDataset):
         )
         self.nl_code_path = nl_code_path
         self.code_code_path = code_code_path
-        self.code_pairs = json.load(open(code_code_path))
-        self.train_data = copy.deepcopy(self.data)
-        self.data = create_apn_from_ccp_ncp(self.train_data, self.code_pairs)
-        print(self.data[0])
+        self.code_pairs = open_records(code_code_path)
+        # mapping of a code to the codes it is paired with (either way round, like `create_apn_from_ccp_ncp`).
+        self.code_to_sim_codes = RecordGroups(self.code_pairs, key_fields=[0, 1], value_fields=[1, 0])
         
-    def reset(self):
-        """reset code pairs"""
-        self.data = create_apn_from_ccp_ncp(self.train_data, self.code_pairs)
+    def reset(self): pass # the negatives are sampled when the items are fetched.
+
+    def _sample_neg(self, PL: str) -> str:
+        """a code paired with `PL` (`PL` itself if it has no pairs)."""
+        sim_codes = self.code_to_sim_codes.get(PL)
+        if sim_codes is None: return PL
+        return random.sample(sim_codes, k=1)[0]
         
     def __getitem__(self, item: int):
         """combined get item for all 3 models: CodeBERT, GraphCodeBERT, UniXcoder.
         if curriculum is turned off then just use hard negatives all the time."""
-        anchor = self.data[item][0]
-        pos = self.data[item][1]
-        neg = self.data[item][2]
+        anchor = self.data[item]["intent"]
+        pos = self.data[item]["snippet"]
+        neg = self._sample_neg(pos)
         anchor = self._proc_text(anchor)
         pos = self._proc_code(pos)
         neg = self._proc_code(neg)
@@ -1642,6 +1709,9 @@ class UniBiHardNegDataset(AllModelsDataset):
             try: self.intent_to_code[intent].append(snippet)
             except KeyError: self.intent_to_code[intent] = [snippet]
             
+        self._build_hard_neg_index(perturbed_codes, (
+            snippet for codes in self.intent_to_code.values() for snippet in codes
+        ))
         self.code_synsets = CodeSynsets(code_syns_path)
         self.train_data = copy.deepcopy(self.data)
         self.data = create_app_from_csyn_ncp(
@@ -1651,14 +1721,7 @@ class UniBiHardNegDataset(AllModelsDataset):
         
     def _get_hard_negs(self, NL: str, PL: str) -> Tuple[List[str], List[int]]:
         rindex = 0
-        code_cands: List[str] = []
-        rule_cands: List[int] = []
-        for tup in self.perturbed_codes.get(PL,[]): # codes from AST.
-            # if self.ignore_worst_rules and tup[1] in WORST_RULES_LIST: continue
-            # elif self.ignore_non_disco_rules and tup[1] in DISCO_IGNORE_LIST: continue
-            rule_index = int(tup[1].replace("rule",""))
-            code_cands.append(tup[0])
-            rule_cands.append(rule_index)
+        code_cands, rule_cands = self._get_hard_neg_cands(PL) # codes from AST.
         sim_intents: List[str] = self.sim_intents_map.get(NL,[])
         for intent, _ in sim_intents:
             code_cands += self.intent_to_code[intent]
@@ -1779,15 +1842,16 @@ class DiscoDataset(AllModelsDataset):
             try: self.intent_to_code[intent].append(snippet)
             except KeyError: self.intent_to_code[intent] = [snippet]
         
+        self._build_hard_neg_index(perturbed_codes, (
+            rec["snippet"] for rec in self.data
+        ), rule_filters=["disco"])
         for rec in self.data:
             a = rec["intent"]
             p = rec["snippet"]
-            hard_negs = perturbed_codes[p]
-            for n,r in hard_negs: 
-                if r in DISCO_IGNORE_LIST: continue
-                r = int(r.replace("rule",""))
+            hard_negs, rules = self._get_hard_neg_cands(p)
+            for n,r in zip(hard_negs, rules): 
                 triples.append((a,p,n,r))
-            if len(hard_negs) == 0: 
+            if len(perturbed_codes[p]) == 0: 
                 n = self._sample_soft_neg(a)
                 triples.append((a,p,n,0))
         self.data = triples
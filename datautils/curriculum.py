@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# curriculum schedulers for mixing soft (random) and hard (AST/similar intent) negatives. The mastering rate
+# windows are ring buffers with running sums, so pushing an accuracy and computing the window mean/slope are O(1).
+# The current mixing weights live in a shared memory tensor, so DataLoader worker processes (which sample the
+# negatives in `__getitem__`) always see the weights set by the training process.
+import math
+import torch
+import numpy as np
+from typing import *
+
+CURRICULUM_TYPES = ["mr", "rand", "lp", "exp", "hard", "soft"]
+
+class MasteringRate:
+    def __init__(self, role: int=0, size: int=20,
+                 p: float=2, delta: float=0.5):
+        self.window_size = size
+        self.delta = delta
+        self.p = p
+        self.role = role # role of 0 corresponds to soft accuracy and hard corresponds to 1
+        self.mean_size = (size+1)/2
+        # sum of (t-M)^2 over the window positions t = 1 ... size (a constant).
+        self.denom = size*(size**2-1)/12
+        self._reset(np.zeros(size))
+
+    def _reset(self, acc_buffer: np.ndarray):
+        """(re)build the ring and its running sums from a buffer ordered from oldest to newest."""
+        self.ring = np.array(acc_buffer, dtype=np.float64)
+        self.head = 0 # position of the oldest accuracy in the ring.
+        self.sum = self.ring.sum()
+        # sum of t*acc_t (t is the position in the window, 1 for the oldest accuracy).
+        self.t_sum = (np.arange(1, self.window_size+1)*self.ring).sum()
+        self.window_mean = self.sum/self.window_size
+
+    @property
+    def acc_buffer(self) -> np.ndarray:
+        """window accuracies ordered from oldest to newest."""
+        return np.roll(self.ring, -self.head)
+
+    def __call__(self):
+        return self.window_mean
+
+    def __repr__(self):
+        return repr(self.acc_buffer)
+
+    def __str__(self):
+        return f"{self.role}:[{self.window_size}]:={self.window_mean:.3f}(p={self.p}, δ={self.delta})"
+
+    def beta(self):
+        """Calculate slope of linear regression for returns/accuracies
+        for the attention computation (sum((t-M)*acc_t) = t_sum-M*sum)."""
+        if self.denom == 0: return 0
+        return (self.t_sum-self.mean_size*self.sum)/self.denom
+
+    def attn(self, other, beta: Union[float, None]=None, other_beta: Union[float, None]=None):
+        """calculate the attention for the task from the mastering rate.
+        `other_master_rate`: the window mean of the other master rate object."""
+        beta = self.beta() if beta is None else beta
+        beta_max = max(beta, other.beta() if other_beta is None else other_beta)
+        if beta_max != 0: beta = beta/beta_max
+        if self.role == 0:
+            return (self.delta*(1-self.window_mean) + (1-self.delta)*beta)*(1-other.window_mean)
+        else:
+            return (other.window_mean**self.p)*(self.delta*(1-self.window_mean) + (1-self.delta)*beta)
+
+    def push_acc(self, acc: float):
+        oldest = self.ring[self.head]
+        # every accuracy moves one position back (t -> t-1), the oldest one drops out and `acc` enters at t = size.
+        self.t_sum += self.window_size*acc - self.sum
+        self.sum += acc - oldest
+        self.ring[self.head] = acc
+        self.head = (self.head+1) % self.window_size
+        # recompute the sums once per lap of the ring, so floating point errors can't accumulate.
+        if self.head == 0: self._reset(self.ring)
+        self.window_mean = self.sum/self.window_size
+
+    def state_dict(self) -> dict:
+        return {"acc_buffer": self.acc_buffer.tolist(), "window_mean": self.window_mean}
+
+    def load_state_dict(self, state: dict):
+        self._reset(np.array(state["acc_buffer"]))
+
+def softmax2(a: float, b: float) -> Tuple[float, float]:
+    """softmax of two scores (without building tensors every step)."""
+    m = max(a, b)
+    e_a, e_b = math.exp(a-m), math.exp(b-m)
+    return e_a/(e_a+e_b), e_b/(e_a+e_b)
+
+class CurriculumScheduler:
+    """weights of soft & hard negatives for the curriculum `curriculum_type`:
+    - mr: mastering rate attention over the soft/hard accuracy windows (after `warmup_steps` steps).
+    - lp: learning progress, attention over the mean soft/hard accuracies.
+    - exp: hard negative weight grows as 1-exp(-ln2 * seen examples/Z).
+    - rand/hard/soft: constant weights (rand is sampled 50/50 by the dataset).
+    The weights and the warmup counter are kept in a shared memory tensor (see `weights`)."""
+    def __init__(self, curriculum_type: str="mr", warmup_steps: int=3000, p: float=2, delta: float=0.5,
+                 epsilon: float=0.8, win_size: int=20, soft_neg_bias: float=0.8,
+                 batch_size: Union[int, None]=None, Z: Union[float, None]=None):
+        msg = f"invalid curriculum type: {curriculum_type}"
+        assert curriculum_type in CURRICULUM_TYPES, msg
+        self.curriculum_type = curriculum_type
+        if curriculum_type != "mr":
+            warmup_steps = 0
+        if curriculum_type == "exp":
+            assert batch_size is not None and Z is not None, "need batch size and half life for exponential decay curriculum"
+        self.p = p
+        self.epsilon = epsilon
+        self.batch_size = batch_size
+        self.Z = Z
+        self.soft_neg_bias = soft_neg_bias
+        self.soft_master_rate = MasteringRate(role=0, delta=delta, p=p, size=win_size)
+        self.hard_master_rate = MasteringRate(role=1, delta=delta, p=p, size=win_size)
+        self.step_ctr = 0
+        self.lp_s = 0
+        self.lp_h = 0
+        # [soft_neg_weight, hard_neg_weight, warmup_steps] (shared with the DataLoader workers).
+        self.shared = torch.zeros(3, dtype=torch.float64).share_memory_()
+        soft_neg_weight = {"hard": 0, "soft": 1}.get(curriculum_type, 0.8)
+        self._set(soft_neg_weight, warmup_steps)
+
+    def _set(self, soft_neg_weight: float, warmup_steps: int):
+        self.shared[0] = soft_neg_weight
+        self.shared[1] = 1-soft_neg_weight
+        self.shared[2] = warmup_steps
+
+    @property
+    def soft_neg_weight(self) -> float:
+        return self.shared[0].item()
+
+    @property
+    def hard_neg_weight(self) -> float:
+        return self.shared[1].item()
+
+    @property
+    def warmup_steps(self) -> int:
+        return int(self.shared[2].item())
+
+    def weights(self) -> Tuple[float, float, int]:
+        """soft & hard negative weights and remaining warmup steps (a single read of the shared tensor)."""
+        soft_neg_weight, hard_neg_weight, warmup_steps = self.shared.tolist()
+        return soft_neg_weight, hard_neg_weight, int(warmup_steps)
+
+    def update(self, soft_acc: float, hard_acc: float):
+        self.soft_master_rate.push_acc(soft_acc)
+        self.hard_master_rate.push_acc(hard_acc)
+        warmup_steps = self.warmup_steps
+        if self.curriculum_type == "mr":
+            if warmup_steps > 0:
+                self.shared[2] = warmup_steps-1
+                return
+            # slopes are computed once (each is needed by both attentions).
+            b_s, b_h = self.soft_master_rate.beta(), self.hard_master_rate.beta()
+            a_s = self.soft_master_rate.attn(self.hard_master_rate, b_s, b_h)
+            a_h = self.hard_master_rate.attn(self.soft_master_rate, b_h, b_s)
+            attn_s, _ = softmax2(a_s, a_h)
+            soft_neg_weight = (1-self.epsilon)*attn_s + self.epsilon*self.soft_neg_bias
+        elif self.curriculum_type == "exp":
+            self.step_ctr += self.batch_size
+            r = self.step_ctr/self.Z
+            soft_neg_weight = np.exp(-np.log(2)*r)
+        elif self.curriculum_type == "lp":
+            lp_s = self.soft_master_rate()
+            lp_h = self.hard_master_rate()
+            a_s = (1-lp_s)*(1-lp_h)
+            a_h = (lp_s**self.p)*(1-lp_h)
+            self.lp_s, self.lp_h = lp_s, lp_h
+            soft_neg_weight, _ = softmax2(a_s, a_h)
+        elif self.curriculum_type == "hard":
+            soft_neg_weight = 0
+        elif self.curriculum_type == "soft":
+            soft_neg_weight = 1
+        else: return # rand: the dataset samples 50/50.
+        self._set(soft_neg_weight, warmup_steps)
+
+    def mix_step(self):
+        if self.curriculum_type == "mr":
+            if self.warmup_steps > 0:
+                return f"w({self.warmup_steps}) "
+            else: return f"{self.soft_neg_weight:.3f}|{self.hard_neg_weight:.3f} "
+        elif self.curriculum_type == "lp":
+            return f"{self.soft_neg_weight:.3f}|{self.hard_neg_weight:.3f} s:{self.lp_s:.3f}|h:{self.lp_h:.3f} "
+        elif self.curriculum_type == "exp":
+            r = self.step_ctr/self.Z
+            return f"{self.soft_neg_weight:.3f}|{self.hard_neg_weight:.3f} r:{r:.3f} "
+        elif self.curriculum_type == "hard":
+            return ""
+
+    def state_dict(self) -> dict:
+        return {
+            "soft_master_rate": self.soft_master_rate.state_dict(),
+            "hard_master_rate": self.hard_master_rate.state_dict(),
+            "warmup_steps": self.warmup_steps, "step_ctr": self.step_ctr,
+            "soft_neg_weight": self.soft_neg_weight, "hard_neg_weight": self.hard_neg_weight,
+            "lp_s": self.lp_s, "lp_h": self.lp_h,
+        }
+
+    def load_state_dict(self, state: dict):
+        self.soft_master_rate.load_state_dict(state["soft_master_rate"])
+        self.hard_master_rate.load_state_dict(state["hard_master_rate"])
+        self.step_ctr, self.lp_s, self.lp_h = state["step_ctr"], state["lp_s"], state["lp_h"]
+        # in place: the workers keep pointing at the same shared memory.
+        self.shared[0] = state["soft_neg_weight"]
+        self.shared[1] = state["hard_neg_weight"]
+        self.shared[2] = state["warmup_steps"]
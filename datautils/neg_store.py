@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# compact, memory mappable store for the snippet -> AST perturbed negatives map.
+import os
+import json
+import mmap
+import bisect
+import hashlib
+import argparse
+from array import array
+from typing import *
+from tqdm import tqdm
+
+NEG_STORE_MAGIC = b"SYNCNEG1"
+# rule id used for untagged negatives (old format: plain strings instead of [code, "ruleN"] pairs).
+UNTAGGED_RULE = 0
+
+def snippet_hash(snippet: str) -> int:
+    """64 bit hash of a code snippet (stable across processes, unlike `hash`)."""
+    return int.from_bytes(hashlib.blake2b(snippet.encode("utf-8"), digest_size=8).digest(), "little")
+
+def parse_rule_id(rule: str) -> int:
+    """'rule12' -> 12"""
+    return int(rule.replace("rule",""))
+
+class ASTNegStore:
+    """
+    read-only store of the AST perturbed negatives of every code snippet.
+    Snippets are looked up by a 64 bit hash (binary search over a sorted table), negatives are
+    offsets into a utf-8 string heap and rule ids are stored as uint8. Every section is memory
+    mapped, so opening the store from many processes costs almost nothing and the pages are shared.
+    Supports the subset of the dict interface used by the datasets (`[]`, `get`, `in`, `len`, `keys`),
+    so it can be passed wherever the json loaded `perturbed_codes` map was used.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_len = len(NEG_STORE_MAGIC)
+        assert self._buf[:magic_len] == NEG_STORE_MAGIC == self._buf[-magic_len:], f"{self.path} is not an AST negatives store"
+        footer_len = array("Q", self._buf[-magic_len-8:-magic_len])[0]
+        footer = json.loads(self._buf[-magic_len-8-footer_len:-magic_len-8])
+        self.num_snippets: int = footer["num_snippets"]
+        self.num_negs: int = footer["num_negs"]
+        # names of the precomputed rule filters, the i-th filter is the i-th bit of `filter_bits`.
+        self.filters: List[str] = footer["filters"]
+        self.filter_rules: Dict[str, List[str]] = footer["filter_rules"]
+        view = memoryview(self._buf)
+        sections = {}
+        for name, (pos, size, fmt) in footer["sections"].items():
+            sections[name] = view[pos:pos+size].cast(fmt) if fmt != "B" else view[pos:pos+size]
+        self.hashes = sections["hashes"] # sorted snippet hashes.
+        self.snippet_offsets = sections["snippet_offsets"] # into snippet_heap, num_snippets+1
+        self.neg_starts = sections["neg_starts"] # negatives of i-th snippet: neg_starts[i]:neg_starts[i+1]
+        self.neg_offsets = sections["neg_offsets"] # into neg_heap, num_negs+1
+        self.rule_ids = sections["rule_ids"] # uint8 rule id of each negative.
+        self.filter_bits = sections["filter_bits"] # uint8 bitmask of the filters each negative passes.
+        self.snippet_heap = sections["snippet_heap"]
+        self.neg_heap = sections["neg_heap"]
+
+    def __len__(self):
+        return self.num_snippets
+
+    def _snippet(self, i: int) -> str:
+        return str(self.snippet_heap[self.snippet_offsets[i]:self.snippet_offsets[i+1]], "utf-8")
+
+    def lookup(self, snippet: str) -> int:
+        """index of the snippet in the store (-1 if it isn't present)."""
+        h = snippet_hash(snippet)
+        i = bisect.bisect_left(self.hashes, h)
+        # scan over (extremely unlikely) hash collisions.
+        while i < self.num_snippets and self.hashes[i] == h:
+            if self._snippet(i) == snippet: return i
+            i += 1
+
+        return -1
+
+    def neg_range(self, i: int) -> Tuple[int, int]:
+        """range of the negatives of the i-th snippet in `rule_ids`/`neg_offsets`."""
+        return self.neg_starts[i], self.neg_starts[i+1]
+
+    def neg_code(self, j: int) -> str:
+        return str(self.neg_heap[self.neg_offsets[j]:self.neg_offsets[j+1]], "utf-8")
+
+    def filter_mask(self, ignore: Iterable[str]=()) -> int:
+        """bitmask a negative has to match to survive the named rule filters (e.g. 'disco', 'worst')."""
+        mask = 0
+        for name in ignore:
+            if name not in self.filters: raise KeyError(f"rule filter '{name}' wasn't precomputed, available: {self.filters}")
+            mask |= 1 << self.filters.index(name)
+
+        return mask
+
+    def get_negatives(self, snippet: str, ignore: Iterable[str]=()) -> Tuple[List[str], List[int]]:
+        """negative codes and integer rule ids of a snippet, after dropping the
+        rules of the named filters (untagged negatives are always dropped)."""
+        i = self.lookup(snippet)
+        if i == -1: return [], []
+        mask = self.filter_mask(ignore)
+        codes, rules = [], []
+        start, end = self.neg_range(i)
+        for j in range(start, end):
+            if self.rule_ids[j] == UNTAGGED_RULE or (self.filter_bits[j] & mask) != mask: continue
+            codes.append(self.neg_code(j))
+            rules.append(self.rule_ids[j])
+
+        return codes, rules
+
+    def __contains__(self, snippet: str):
+        return self.lookup(snippet) != -1
+
+    def __getitem__(self, snippet: str) -> List[Union[List[str], str]]:
+        """negatives in the original format: [code, 'ruleN'] pairs (plain strings if untagged)."""
+        i = self.lookup(snippet)
+        if i == -1: raise KeyError(snippet)
+        negs = []
+        start, end = self.neg_range(i)
+        for j in range(start, end):
+            code = self.neg_code(j)
+            if self.rule_ids[j] == UNTAGGED_RULE: negs.append(code)
+            else: negs.append([code, f"rule{self.rule_ids[j]}"])
+
+        return negs
+
+    def get(self, snippet: str, default=None):
+        try: return self[snippet]
+        except KeyError: return default
+
+    def keys(self) -> Iterator[str]:
+        for i in range(self.num_snippets): yield self._snippet(i)
+
+    def __iter__(self):
+        return self.keys()
+
+    def items(self) -> Iterator[Tuple[str, list]]:
+        for snippet in self.keys(): yield snippet, self[snippet]
+
+    def __getstate__(self):
+        # memory maps can't be pickled, workers re-open the file instead.
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._open()
+
+def read_ast_neg_jsonl(paths: Union[str, List[str]]) -> Dict[str, list]:
+    """merge the JSONL outputs of `ast_perturb/gen_ast_neg_samples.py` (e.g. of several splits) into a
+    snippet -> negatives map. Every snippet is kept once (the first record wins)."""
+    if isinstance(paths, str): paths = [paths]
+    perturbed_codes = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                # skip the partially written record of an interrupted run.
+                if not line.endswith("\n"): break
+                rec = json.loads(line)
+                for snippet in rec["snippets"]:
+                    perturbed_codes.setdefault(snippet, rec["negs"])
+
+    return perturbed_codes
+
+def build_ast_neg_store(perturbed_codes: Union[str, List[str], Dict[str, list]], out_path: str,
+                        rule_filters: Union[Dict[str, List[str]], None]=None) -> str:
+    """
+    build an `ASTNegStore` from the output(s) of `ast_perturb/gen_ast_neg_samples.py` (or the loaded dict).
+    `rule_filters` maps a filter name to the rules it ignores (defaults to the ignore lists of `datautils`).
+    """
+    if isinstance(perturbed_codes, list) or (isinstance(perturbed_codes, str) and perturbed_codes.endswith(".jsonl")):
+        perturbed_codes = read_ast_neg_jsonl(perturbed_codes)
+    elif isinstance(perturbed_codes, str):
+        perturbed_codes = json.load(open(perturbed_codes))
+    if rule_filters is None:
+        from datautils import RULE_IGNORE_LISTS
+        rule_filters = RULE_IGNORE_LISTS
+    filters = list(rule_filters.keys())
+    assert len(filters) <= 8, "filter bits are stored as uint8"
+    # bitmask of the filters each rule id passes.
+    rule_bits = {}
+    def get_rule_bits(rule: str) -> int:
+        if rule not in rule_bits:
+            rule_bits[rule] = sum(1 << k for k, name in enumerate(filters) if rule not in rule_filters[name])
+        return rule_bits[rule]
+
+    snippets = sorted(perturbed_codes.keys(), key=snippet_hash)
+    hashes = array("Q")
+    snippet_offsets = array("Q", [0])
+    neg_starts = array("Q", [0])
+    neg_offsets = array("Q", [0])
+    rule_ids = array("B")
+    filter_bits = array("B")
+    snippet_heap = bytearray()
+    neg_heap = bytearray()
+    for snippet in tqdm(snippets, desc="building AST negatives store"):
+        hashes.append(snippet_hash(snippet))
+        snippet_heap += snippet.encode("utf-8")
+        snippet_offsets.append(len(snippet_heap))
+        for neg in perturbed_codes[snippet]:
+            if isinstance(neg, str): code, rule_id, bits = neg, UNTAGGED_RULE, 0
+            else:
+                code, rule = neg[0], neg[1]
+                rule_id, bits = parse_rule_id(rule), get_rule_bits(rule)
+                assert 0 < rule_id < 256, f"rule id of {rule} doesn't fit in uint8"
+            neg_heap += code.encode("utf-8")
+            neg_offsets.append(len(neg_heap))
+            rule_ids.append(rule_id)
+            filter_bits.append(bits)
+        neg_starts.append(len(rule_ids))
+    sections = {}
+    with open(out_path, "wb") as f:
+        f.write(NEG_STORE_MAGIC)
+        for name, data, fmt in [("hashes", hashes, "Q"), ("snippet_offsets", snippet_offsets, "Q"),
+                                ("neg_starts", neg_starts, "Q"), ("neg_offsets", neg_offsets, "Q"),
+                                ("rule_ids", rule_ids, "B"), ("filter_bits", filter_bits, "B"),
+                                ("snippet_heap", snippet_heap, "B"), ("neg_heap", neg_heap, "B")]:
+            f.write(b"\0"*(-f.tell() % 8)) # keep every section 8 byte aligned.
+            pos = f.tell()
+            f.write(data)
+            sections[name] = [pos, f.tell()-pos, fmt]
+        footer = json.dumps({
+            "num_snippets": len(hashes), "num_negs": len(rule_ids),
+            "filters": filters, "filter_rules": rule_filters, "sections": sections,
+        }).encode("utf-8")
+        f.write(footer)
+        f.write(array("Q", [len(footer)]).tobytes())
+        f.write(NEG_STORE_MAGIC)
+
+    return out_path
+
+def load_perturbed_codes(path: Union[str, None], online: bool=False, cache_size: int=10000):
+    """open the snippet -> AST negatives map: memory maps `.negs` stores and loads json/JSONL files.
+    With `online` the negatives are generated on the fly (`OnlineASTNegatives`), the map at `path` (if any)
+    is used for the snippets it has."""
+    if online:
+        from datautils.online_negs import OnlineASTNegatives
+        store = None if path is None else load_perturbed_codes(path)
+        return OnlineASTNegatives(store=store, cache_size=cache_size)
+    if path.endswith(".negs"): return ASTNegStore(path)
+    elif path.endswith(".jsonl"): return read_ast_neg_jsonl(path)
+    return json.load(open(path))
+
+def get_args():
+    parser = argparse.ArgumentParser("convert a snippet -> AST negatives map to a compact memory mappable store")
+    parser.add_argument("-i", "--input_paths", type=str, nargs="+", required=True, 
+                        help="path to the json map or the JSONL outputs (of gen_ast_neg_samples.py) to merge")
+    parser.add_argument("-o", "--output_path", type=str, default=None, help="path of the store (defaults to <first input path>.negs)")
+
+    return parser.parse_args()
+
+# python -m datautils.neg_store -i PyDocs_AST_neg_samples_1_1.json
+# python -m datautils.neg_store -i CoNaLa_AST_neg_samples_4_{1,2,3,4}.jsonl -o CoNaLa_AST_neg_samples.negs
+if __name__ == "__main__":
+    args = get_args()
+    output_path = args.output_path
+    if output_path is None: output_path = os.path.splitext(args.input_paths[0])[0]+".negs"
+    input_paths = args.input_paths[0] if len(args.input_paths) == 1 else args.input_paths
+    build_ast_neg_store(input_paths, output_path)
+    store = ASTNegStore(output_path)
+    print(f"saved {store.num_negs} negatives of {len(store)} snippets to {output_path}")
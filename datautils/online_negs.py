@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# AST negatives generated on the fly inside the DataLoader workers, so a new corpus can be trained on without
+# the offline generation step (ast_perturb/gen_ast_neg_samples.py). Every process builds its own `PerturbAst`
+# the first time it needs one and keeps the negatives of recently seen snippets in a bounded LRU cache. On a
+# cache miss, a precomputed store (if one is given) is tried before generating.
+import random
+from typing import *
+from collections import OrderedDict
+from datautils.neg_store import ASTNegStore, parse_rule_id
+
+class OnlineASTNegatives:
+    """
+    source of the AST negatives of a snippet, with the same `get_negatives` interface as `ASTNegStore`
+    (so the datasets can use it in place of the precomputed `perturbed_codes`).
+    `store`: precomputed map (`ASTNegStore` or dict) tried first on a cache miss.
+    `cache_size`: no. of (snippet, rule filters) results kept per process.
+    `max_candidates`/`rule_budget`: caps on the generated negatives (see `PerturbAst.iter_candidates`).
+    """
+    def __init__(self, store: Union[ASTNegStore, Dict[str, list], None]=None, cache_size: int=10000,
+                 max_candidates: Union[int, None]=None, rule_budget: Union[int, Dict[str, int], None]=None):
+        self.store = store
+        self.cache_size = cache_size
+        self.max_candidates = max_candidates
+        self.rule_budget = rule_budget
+        self._perturber = None
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    @property
+    def perturber(self):
+        # built lazily, i.e. in the DataLoader worker that first needs it (loading the signatures is slow).
+        if self._perturber is None:
+            from ast_perturb.ast_perturb2 import PerturbAst, NegRuleFilter
+            self._perturber = PerturbAst(rule_filter=NegRuleFilter())
+            self._perturber.init()
+        return self._perturber
+
+    def _store_negatives(self, snippet: str, ignore: Tuple[str]) -> Union[Tuple[List[str], List[int]], None]:
+        if isinstance(self.store, ASTNegStore):
+            if self.store.lookup(snippet) == -1: return None
+            return self.store.get_negatives(snippet, ignore)
+        negs = self.store.get(snippet)
+        if negs is None: return None
+        ignored_rules = self._ignored_rules(ignore)
+        codes, rules = [], []
+        for neg in negs:
+            if isinstance(neg, str) or neg[1] in ignored_rules: continue
+            codes.append(neg[0])
+            rules.append(parse_rule_id(neg[1]))
+
+        return codes, rules
+
+    def _ignored_rules(self, ignore: Tuple[str]) -> Set[str]:
+        from datautils import RULE_IGNORE_LISTS
+        ignored_rules = set()
+        for name in ignore: ignored_rules.update(RULE_IGNORE_LISTS[name])
+
+        return ignored_rules
+
+    def _generate(self, snippet: str, ignore: Tuple[str]) -> Tuple[List[str], List[int]]:
+        from ast_perturb.engine import snippet_seed
+        ignored_rules = self._ignored_rules(ignore)
+        # the order of offline generation, without the rules that would be filtered out anyway.
+        rule_order = sorted([f"rule{i+1}" for i in range(len(self.perturber.rule_filter))], reverse=True)
+        rule_order = [rule for rule in rule_order if rule not in ignored_rules]
+        # seeded per snippet like offline generation, without disturbing the random state of the worker.
+        state = random.getstate()
+        random.seed(snippet_seed(snippet))
+        try:
+            candidates = list(self.perturber.iter_candidates(
+                snippet, rule_order=rule_order, rule_budget=self.rule_budget,
+                max_candidates=self.max_candidates,
+            ))
+        except SyntaxError: candidates = []
+        finally: random.setstate(state)
+
+        return [code for code, _ in candidates], [parse_rule_id(rule) for _, rule in candidates]
+
+    def get_negatives(self, snippet: str, ignore: Iterable[str]=()) -> Tuple[List[str], List[int]]:
+        """negative codes and integer rule ids of a snippet, after dropping the rules of the named filters."""
+        ignore = tuple(ignore)
+        key = (snippet, ignore)
+        negs = self._cache.get(key)
+        if negs is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        else:
+            negs = self._store_negatives(snippet, ignore) if self.store is not None else None
+            if negs is not None:
+                self.store_hits += 1
+                return negs
+            self.misses += 1
+            negs = self._generate(snippet, ignore)
+            self._cache[key] = negs
+            if len(self._cache) > self.cache_size: self._cache.popitem(last=False)
+        # copies: the callers extend the lists.
+        return list(negs[0]), list(negs[1])
+
+    def __getitem__(self, snippet: str) -> List[List[str]]:
+        """negatives in the format of the precomputed map: [code, 'ruleN'] pairs."""
+        codes, rules = self.get_negatives(snippet)
+        return [[code, f"rule{rule}"] for code, rule in zip(codes, rules)]
+
+    def get(self, snippet: str, default=None):
+        return self[snippet]
+
+    def __getstate__(self):
+        # the perturber and the cache are per process (rebuilt by spawned workers).
+        state = self.__dict__.copy()
+        state["_perturber"] = None
+        state["_cache"] = OrderedDict()
+        return state
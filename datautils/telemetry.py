@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# per step training telemetry: time spent in each stage of a step (data loading, tokenization, hard negative
+# mining, forward, backward, optimizer step, validation, checkpointing), examples/s and peak memory. Every step
+# is appended to a JSON lines log and a summary table is printed (and logged) at the end of every epoch.
+import time
+import json
+import torch
+import resource
+import threading
+import contextlib
+from typing import *
+from collections import defaultdict
+
+# the telemetry of the running fit loop (the dataset/collate function hooks report to it).
+_ACTIVE = None
+
+def stage(name: str):
+    """time a stage that runs inside the data loading (tokenization, mining in the dataset or collate function).
+    Stages timed on other threads (e.g. a `MiningPrefetcher`) are logged as "background.<name>"."""
+    if _ACTIVE is None: return contextlib.nullcontext()
+    return _ACTIVE.stage(name)
+
+class Telemetry:
+    """stage times of a training step are recorded with `lap(stage)`, which attributes the time since the
+    previous lap to `stage` (so the fit loops only need a line at every stage boundary, instead of wrapping
+    every stage in a block). The data loading time is recorded by iterating over the loader through `timed`.
+    On GPUs every lap synchronizes the device, so that asynchronously launched kernels are attributed to the
+    stage that launched them (the price is losing the overlap of host and device work across stages)."""
+    def __init__(self, log_path: Union[str, None]=None, device: str="cpu", enabled: bool=True):
+        global _ACTIVE
+        self.enabled = enabled and log_path is not None
+        self.log_path = log_path
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.nested = set() # stages timed inside other stages (excluded from "other").
+        self.epoch_records = []
+        self._lock = threading.Lock()
+        self._main_thread = threading.get_ident()
+        self._reset_step()
+        if self.enabled:
+            self.log_file = open(log_path, "a")
+            _ACTIVE = self
+
+    def _reset_step(self):
+        self.step_times = defaultdict(float)
+        self.step_start = self.mark = time.perf_counter()
+        if self.enabled and self.use_cuda: torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _sync(self):
+        if self.use_cuda: torch.cuda.synchronize(self.device)
+
+    def _record(self, name: str, seconds: float):
+        with self._lock: self.step_times[name] += seconds
+
+    def lap(self, name: str):
+        """attribute the time since the previous lap to stage `name`."""
+        if not self.enabled: return
+        self._sync()
+        now = time.perf_counter()
+        self._record(name, now-self.mark)
+        self.mark = now
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if threading.get_ident() != self._main_thread: name = "background."+name
+        self.nested.add(name)
+        start = time.perf_counter()
+        try: yield
+        finally: self._record(name, time.perf_counter()-start)
+
+    def timed(self, iterable: Iterable) -> Iterator:
+        """iterate over `iterable`, recording the wait for every item as the "data" stage."""
+        if not self.enabled:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try: item = next(it)
+            except StopIteration: return
+            now = time.perf_counter()
+            self._record("data", now-start)
+            self.mark = now
+            yield item
+
+    def peak_memory_mb(self) -> float:
+        if self.use_cuda: return torch.cuda.max_memory_allocated(self.device)/2**20
+        # peak resident set size of the process (in KB on linux).
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+    def end_step(self, epoch: int, step: int, num_examples: int):
+        """log the step and start timing the next one."""
+        if not self.enabled: return
+        self._sync()
+        wall = time.perf_counter()-self.step_start
+        with self._lock: stage_times = dict(self.step_times)
+        stage_times["other"] = max(0, wall-sum(t for name, t in stage_times.items() if name not in self.nested))
+        record = {
+            "type": "step", "epoch": epoch, "step": step, "wall_time": wall, "stages": stage_times,
+            "examples_per_sec": num_examples/wall, "peak_mem_mb": self.peak_memory_mb(),
+        }
+        self.epoch_records.append(record)
+        self.log_file.write(json.dumps(record)+"\n")
+        self.log_file.flush()
+        self._reset_step()
+
+    def end_epoch(self, epoch: int) -> dict:
+        """print (and log) the summary table of the epoch's steps."""
+        if not self.enabled or len(self.epoch_records) == 0: return {}
+        records, self.epoch_records = self.epoch_records, []
+        totals = defaultdict(float)
+        for record in records:
+            for name, t in record["stages"].items(): totals[name] += t
+        wall = sum(record["wall_time"] for record in records)
+        summary = {
+            "type": "epoch_summary", "epoch": epoch, "steps": len(records), "wall_time": wall,
+            "stages": {name: {"total": t, "mean_ms": 1000*t/len(records), "percent": 100*t/wall} for name, t in totals.items()},
+            "examples_per_sec": sum(r["examples_per_sec"]*r["wall_time"] for r in records)/wall,
+            "peak_mem_mb": max(r["peak_mem_mb"] for r in records),
+        }
+        print(f"epoch {epoch+1} telemetry: {len(records)} steps in {wall:.2f}s, {summary['examples_per_sec']:.2f} examples/s, peak memory {summary['peak_mem_mb']:.1f} MB")
+        print(f"{'stage':<28} {'total (s)':>10} {'ms/step':>10} {'% of step':>10}")
+        for name, stats in sorted(summary["stages"].items(), key=lambda x: -x[1]["total"]):
+            # nested stages are part of another stage's time (data loading, or a background thread).
+            name = name+" *" if name in self.nested else name
+            print(f"{name:<28} {stats['total']:>10.2f} {stats['mean_ms']:>10.1f} {stats['percent']:>10.1f}")
+        if len(self.nested) > 0: print("* timed inside data loading or on a background thread (not added to the step time)")
+        self.log_file.write(json.dumps(summary)+"\n")
+        self.log_file.flush()
+
+        return summary
+
+    def close(self):
+        global _ACTIVE
+        if not self.enabled: return
+        self.log_file.close()
+        if _ACTIVE is self: _ACTIVE = None
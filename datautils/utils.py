@@ -2,8 +2,14 @@
 # -*- coding: utf-8 -*-
 
 # Author: Atharva Naik (18CS10067)
+import os
+import re
 import json
+import mmap
 import random
+import hashlib
+import numpy as np
+from array import array
 from typing import *
 from tqdm import tqdm
 
@@ -43,6 +49,352 @@ def read_jsonl(path: str) -> List[dict]:
             
     return data
 
+# matches a complete JSON string literal or a single structural character.
+# string bodies are skipped inside the regex engine, so only the structure is walked in python.
+JSON_TOKEN_PATTERN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{},]')
+INDEX_MAGIC = b"SYNCIDX1"
+COLUMNAR_MAGIC = b"SYNCCOL1"
+GROUPS_MAGIC = b"SYNCGRP1"
+
+def _jsonl_spans(buf) -> array:
+    """byte spans (start, end) of every non-empty line of a .jsonl buffer."""
+    spans = array("Q")
+    start, size = 0, len(buf)
+    while start < size:
+        end = buf.find(b"\n", start)
+        if end == -1: end = size
+        line_end = end
+        # ignore trailing whitespace (e.g. "\r") and empty lines.
+        while line_end > start and buf[line_end-1:line_end].isspace(): line_end -= 1
+        if line_end > start:
+            spans.append(start)
+            spans.append(line_end)
+        start = end+1
+
+    return spans
+
+def _json_array_spans(buf) -> array:
+    """byte spans (start, end) of every top level element of a .json file holding a list."""
+    spans = array("Q")
+    depth = 0
+    elem_start = None # start of the current element (after the previous top level delimiter).
+    for match in JSON_TOKEN_PATTERN.finditer(buf):
+        tok = match.group()
+        if depth == 1 and tok in (b",", b"]"):
+            # element is everything between the previous delimiter and this one.
+            start = _lstrip_start(buf, elem_start, match.start())
+            end = _rstrip_end(buf, start, match.start())
+            if end > start:
+                spans.append(start)
+                spans.append(end)
+            elem_start = match.end()
+            if tok == b"]": depth = 0; break
+        elif tok in (b"[", b"{"):
+            depth += 1
+            if depth == 1: elem_start = match.end()
+        elif tok in (b"]", b"}"):
+            depth -= 1
+    assert depth == 0, "truncated or malformed JSON array"
+
+    return spans
+
+def _lstrip_start(buf, start: int, end: int) -> int:
+    while start < end and buf[start:start+1].isspace(): start += 1
+    return start
+
+def _rstrip_end(buf, start: int, end: int) -> int:
+    while end > start and buf[end-1:end].isspace(): end -= 1
+    return end
+
+class IndexedJSONReader:
+    """
+    lazy random access reader for .jsonl files and .json files containing a list of records.
+    a byte offset index is built on first open and cached next to the data file (`<path>.idx`),
+    records are only parsed when they are accessed. Both the data and the index are memory mapped,
+    so the startup time and resident memory don't grow with the size of the file.
+    """
+    def __init__(self, path: str, index_path: Union[str, None]=None):
+        self.path = path
+        self.index_path = index_path if index_path is not None else path+".idx"
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        if os.fstat(self._file.fileno()).st_size > 0: # empty files can't be memory mapped.
+            self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else: self._buf = b""
+        self.spans = self._load_index()
+
+    def _stamp(self) -> array:
+        """size and modification time of the data file, used to invalidate stale indices."""
+        stat = os.stat(self.path)
+        return array("Q", [stat.st_size, stat.st_mtime_ns])
+
+    def _load_index(self):
+        stamp = self._stamp().tobytes()
+        header_len = len(INDEX_MAGIC)+len(stamp)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                header = f.read(header_len)
+                if header == INDEX_MAGIC+stamp:
+                    if os.fstat(f.fileno()).st_size == header_len: return array("Q")
+                    self._index_buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    return memoryview(self._index_buf)[header_len:].cast("Q")
+        if self.path.endswith(".jsonl"): spans = _jsonl_spans(self._buf)
+        else: spans = _json_array_spans(self._buf)
+        try:
+            with open(self.index_path, "wb") as f:
+                f.write(INDEX_MAGIC+stamp)
+                spans.tofile(f)
+        except OSError as e: # read-only data directory: keep the index in memory.
+            print(f"couldn't cache index at {self.index_path}: {e}")
+
+        return spans
+
+    def __len__(self):
+        return len(self.spans)//2
+
+    def __getitem__(self, i: Union[int, slice]):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not(0 <= i < len(self)): raise IndexError(f"record index {i} out of range")
+
+        return json.loads(self._buf[self.spans[2*i]:self.spans[2*i+1]])
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def __deepcopy__(self, memo):
+        return self # records are read-only, so a copy can share the mapping.
+
+    def __getstate__(self):
+        # memory maps can't be pickled (DataLoader workers with spawn), re-open them instead.
+        return {"path": self.path, "index_path": self.index_path}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._open()
+
+
+class ColumnarRecords:
+    """
+    read-only columnar (Arrow style) view of records created by `convert_to_columnar`.
+    every field is stored as a column of uint64 offsets into a utf-8 heap, so `get_bytes`
+    returns a zero-copy memoryview into the memory mapped file. Layout:
+    magic | per column: heap, offsets | footer (json) | footer length (uint64) | magic
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_len = len(COLUMNAR_MAGIC)
+        assert self._buf[:magic_len] == COLUMNAR_MAGIC == self._buf[-magic_len:], f"{self.path} is not a columnar records file"
+        footer_len = array("Q", self._buf[-magic_len-8:-magic_len])[0]
+        footer = json.loads(self._buf[-magic_len-8-footer_len:-magic_len-8])
+        self.num_rows: int = footer["num_rows"]
+        self.record_type: str = footer["record_type"]
+        self.fields: list = footer["fields"]
+        self.kinds: Dict[str, str] = dict(zip(self.fields, footer["kinds"]))
+        view = memoryview(self._buf)
+        self._heaps = {}
+        self._offsets = {}
+        for field, (heap_pos, offsets_pos) in zip(self.fields, footer["columns"]):
+            self._heaps[field] = view[heap_pos:offsets_pos]
+            self._offsets[field] = view[offsets_pos:offsets_pos+8*(self.num_rows+1)].cast("Q")
+
+    def __len__(self):
+        return self.num_rows
+
+    def get_bytes(self, i: int, field: Union[str, int]) -> memoryview:
+        """zero-copy access to the utf-8 (or json for non string columns) bytes of a field."""
+        offsets = self._offsets[field]
+        return self._heaps[field][offsets[i]:offsets[i+1]]
+
+    def get_value(self, i: int, field: Union[str, int]):
+        value = self.get_bytes(i, field)
+        if self.kinds[field] == "str": return str(value, "utf-8")
+        elif len(value) == 0: raise KeyError(field) # field missing from this record.
+
+        return json.loads(bytes(value))
+
+    def __getitem__(self, i: Union[int, slice]):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not(0 <= i < len(self)): raise IndexError(f"record index {i} out of range")
+        if self.record_type == "list":
+            return [self.get_value(i, field) for field in self.fields]
+        rec = {}
+        for field in self.fields:
+            try: rec[field] = self.get_value(i, field)
+            except KeyError: pass
+
+        return rec
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._open()
+
+def convert_to_columnar(path: str, out_path: Union[str, None]=None) -> str:
+    """convert a .json/.jsonl file of records (dicts or lists) to the columnar format read by `ColumnarRecords`."""
+    import shutil
+    import tempfile
+    if out_path is None: out_path = os.path.splitext(path)[0]+".cols"
+    records = IndexedJSONReader(path)
+    # first pass: find the fields and whether every value of a field is a string.
+    fields, kinds = {}, {}
+    record_type = "list"
+    for rec in tqdm(records, desc="scanning fields"):
+        if isinstance(rec, dict): record_type = "dict"
+        keys = rec.keys() if isinstance(rec, dict) else range(len(rec))
+        for k in keys:
+            fields.setdefault(k, 0)
+            fields[k] += 1
+            if not isinstance(rec[k], str): kinds[k] = "json"
+    fields = list(fields.items())
+    # columns with missing values are stored as json (an empty entry then means missing).
+    kinds = [kinds.get(k, "str" if n == len(records) else "json") for k,n in fields]
+    fields = [k for k,_ in fields]
+    # second pass: fill the heap of every column.
+    heaps = [tempfile.TemporaryFile() for _ in fields]
+    offsets = [array("Q", [0]) for _ in fields]
+    for rec in tqdm(records, desc="writing columns"):
+        for j, (field, kind) in enumerate(zip(fields, kinds)):
+            try: value = rec[field]
+            except (KeyError, IndexError): value = b""
+            else: value = value.encode("utf-8") if kind == "str" else json.dumps(value).encode("utf-8")
+            heaps[j].write(value)
+            offsets[j].append(offsets[j][-1]+len(value))
+    columns = []
+    with open(out_path, "wb") as f:
+        f.write(COLUMNAR_MAGIC)
+        for heap, offs in zip(heaps, offsets):
+            heap_pos = f.tell()
+            heap.seek(0)
+            shutil.copyfileobj(heap, f)
+            heap.close()
+            f.write(b"\0"*(-f.tell() % 8)) # keep the offsets 8 byte aligned.
+            offsets_pos = f.tell()
+            offs.tofile(f)
+            columns.append([heap_pos, offsets_pos])
+        footer = json.dumps({
+            "num_rows": len(records), "record_type": record_type, 
+            "fields": fields, "kinds": kinds, "columns": columns,
+        }).encode("utf-8")
+        f.write(footer)
+        f.write(array("Q", [len(footer)]).tobytes())
+        f.write(COLUMNAR_MAGIC)
+
+    return out_path
+
+def open_records(path: str) -> Union[IndexedJSONReader, ColumnarRecords]:
+    """lazily open a file of records (.jsonl, .json with a list of records or .cols)."""
+    if path.endswith(".cols"): return ColumnarRecords(path)
+    return IndexedJSONReader(path)
+
+def _key_hash(key: str) -> int:
+    """64 bit hash of a key that is stable across processes (unlike `hash`), so it can be cached."""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+class RecordGroups:
+    """
+    lazy grouping of list records by the value of some of their fields, e.g. the snippets of every intent
+    (`RecordGroups(records, key_fields=[0], value_fields=[1])`). Every (record, key field) is an entry: the
+    hashes of the entries' keys and the entry ids are sorted by hash once and cached next to the data file
+    (`<path>.keys<fields>.grp`, invalidated like the `.idx` index), so neither the keys nor the values are
+    kept in memory. Looking up a key is a binary search over the memory mapped hashes plus parsing the
+    records of the key (which also checks the key, so hash collisions are harmless). The values of a key
+    are in the order of the records, like appending them to a dict of lists.
+    """
+    def __init__(self, records: Union[IndexedJSONReader, ColumnarRecords], 
+                 key_fields: List[int], value_fields: List[int]):
+        assert len(key_fields) == len(value_fields), "need a value field for every key field"
+        self.records = records
+        self.key_fields = key_fields
+        self.value_fields = value_fields
+        self._open()
+
+    def _open(self):
+        self.path = "{}.keys{}.grp".format(self.records.path, "_".join(map(str, self.key_fields)))
+        self.hashes, self.entries = self._load()
+
+    def _stamp(self) -> array:
+        """size and modification time of the data file, used to invalidate stale groupings."""
+        stat = os.stat(self.records.path)
+        return array("Q", [stat.st_size, stat.st_mtime_ns])
+
+    def _load(self) -> Tuple[np.ndarray, np.ndarray]:
+        stamp = self._stamp().tobytes()
+        header_len = len(GROUPS_MAGIC)+len(stamp)
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                header = f.read(header_len)
+                if header == GROUPS_MAGIC+stamp:
+                    if os.fstat(f.fileno()).st_size == header_len: 
+                        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+                    self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    table = np.frombuffer(self._buf, dtype=np.uint64, offset=header_len)
+                    return table[:len(table)//2], table[len(table)//2:]
+        hashes = array("Q")
+        for rec in self.records:
+            for field in self.key_fields: hashes.append(_key_hash(rec[field]))
+        hashes = np.frombuffer(hashes, dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable") # (stable: the entries of a key stay in record order)
+        hashes, entries = hashes[order], order.astype(np.uint64)
+        try:
+            with open(self.path, "wb") as f:
+                f.write(GROUPS_MAGIC+stamp)
+                hashes.tofile(f)
+                entries.tofile(f)
+        except OSError as e: # read-only data directory: keep the grouping in memory.
+            print(f"couldn't cache record groups at {self.path}: {e}")
+
+        return hashes, entries
+
+    def get(self, key: str, default=None) -> Union[list, None]:
+        """values of the records whose key field is `key` (`default` if there are none)."""
+        h = np.uint64(_key_hash(key))
+        start = int(np.searchsorted(self.hashes, h, side="left"))
+        end = int(np.searchsorted(self.hashes, h, side="right"))
+        values, K = [], len(self.key_fields)
+        for entry in self.entries[start:end].tolist():
+            rec, k = self.records[entry//K], entry % K
+            if rec[self.key_fields[k]] == key: values.append(rec[self.value_fields[k]])
+
+        return values if len(values) > 0 else default
+
+    def __getitem__(self, key: str) -> list:
+        values = self.get(key)
+        if values is None: raise KeyError(key)
+
+        return values
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return {"records": self.records, "key_fields": self.key_fields, "value_fields": self.value_fields}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._open()
+
 def get_posts(data: List[dict]) -> Dict[str, dict]:
     posts = {} # group the posts by the intent (or post title.)
     # the value contains a list of dataset entries featuring relevant code snippets in the decreasing order of relevance.
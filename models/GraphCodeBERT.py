@@ -17,16 +17,23 @@ from tree_sitter import Language, Parser
 from sklearn.metrics import ndcg_score as NDCG
 from torch.utils.data import Dataset, DataLoader
 from transformers import RobertaModel, RobertaTokenizer
-from datautils import ValRetDataset, CodeRetrieverDataset
-from models.metrics import recall_at_k, TripletAccuracy, RuleWiseAccuracy
+from datautils import ValRetDataset, CodeRetrieverDataset, DeferredMiningLoader
+from models.metrics import recall_at_k, TripletAccuracy, RuleWiseAccuracy, RunningMean
 from sklearn.metrics import label_ranking_average_precision_score as MRR
 from datautils.parser import DFG_python
 from datautils.parser import (remove_comments_and_docstrings,
                               tree_to_token_index,
                               index_to_code_token,
                               tree_to_variable_index)
-from models import test_ood_performance, get_tok_path, dynamic_negative_sampling, fit_disco
+from models import test_ood_performance, get_tok_path, dynamic_negative_sampling, fit_disco, MiningPrefetcher, in_batch_hard_negatives, fused_encode, GradCache, \
+                   mixed_precision, get_grad_scaler, enable_activation_checkpointing
 from models.losses import scl_loss, TripletMarginWithDistanceLoss, cos_dist, cos_cdist, cos_csim
+from models.distributed import init_distributed, wrap_ddp, get_loader_kwargs, set_epoch, all_gather, \
+                               sync_curriculum, is_main_process, get_world_size
+from models.checkpointing import CheckpointWriter, training_state, load_training_state, \
+                                 loop_state, restore_metrics, LOOP_COUNTERS
+from models.serialization import empty_weights, is_fast_checkpoint, get_ckpt_path
+from datautils.telemetry import Telemetry
 # seed
 random.seed(0)
 np.random.seed(0)
@@ -55,10 +62,43 @@ def get_args():
     parser.add_argument("-crt", "--code_retriever_triplets", action="store_true", help="use CodeRetriever bimodal objective with random triplets")
     parser.add_argument("-dns", "--dynamic_negative_sampling", action="store_true", 
                         help="do dynamic negative sampling at batch level")
+    parser.add_argument("-pfd", "--prefetch_depth", type=int, default=0, 
+                        help="no. of batches prepared (incl. negative mining) in the background while training (0 turns prefetching off)")
+    parser.add_argument("-nw", "--num_workers", type=int, default=0, 
+                        help="no. of DataLoader worker processes loading the training data (and generating online AST negatives)")
+    parser.add_argument("-mms", "--max_mining_staleness", type=int, default=0, 
+                        help="no. of optimizer steps the (no-grad snapshot of the) model used for mining negatives can lag behind")
+    parser.add_argument("-ibn", "--in_batch_negs", type=int, default=0, 
+                        help="no. of hard negatives mined from the batch's own positives for every soft negative triplet (0 turns it off)")
+    parser.add_argument("-ff", "--fused_forward", action="store_true", 
+                        help="encode the anchors, positives & negatives of a step with a single encoder call")
+    parser.add_argument("-nlb", "--num_len_buckets", type=int, default=1, 
+                        help="no. of sequence length buckets (one encoder call each) for the fused forward pass")
+    parser.add_argument("-gcc", "--grad_cache_chunk", type=int, default=0, 
+                        help="chunk size for gradient cached (large batch) contrastive training (0 turns it off)")
+    parser.add_argument("-prec", "--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"], 
+                        help="precision of the encoder forward passes (autocast, bf16 on CPU), losses are always computed in fp32")
+    parser.add_argument("-ackpt", "--activation_checkpointing", type=int, default=0, 
+                        help="no. of encoder layers per activation checkpointing segment (0 turns it off)")
+    parser.add_argument("-ddp", "--distributed", action="store_true", 
+                        help="distributed data parallel training (launch with torchrun, uses gloo on CPU)")
+    parser.add_argument("-cks", "--ckpt_steps", type=int, default=0, 
+                        help="save a full (resumable) training state checkpoint every `ckpt_steps` steps (0 turns it off)")
+    parser.add_argument("-kln", "--keep_last_n", type=int, default=3, help="no. of training state checkpoints to keep")
+    parser.add_argument("-res", "--resume", type=str, default=None, 
+                        help="training state checkpoint (or checkpoints folder, for the latest one) to resume training from")
+    parser.add_argument("-tel", "--telemetry", action="store_true", 
+                        help="log per step stage timings, examples/s and peak memory (to telemetry.jsonl in the experiment folder)")
+    parser.add_argument("-lge", "--log_every", type=int, default=10, 
+                        help="update the progress bar (which syncs the training metrics with the host) every `log_every` steps")
     parser.add_argument("-sip", "--sim_intents_path", type=str, default=None, 
                         help="path to dictionary containing similar intents corresponding to a given intent")
     parser.add_argument("-pcp", "--perturbed_codes_path", type=str, default=None, 
-                        help="path to dictionary containing AST perturbed codes corresponding to a given code")
+                        help="path to dictionary (.json) or store (.negs) containing AST perturbed codes corresponding to a given code")
+    parser.add_argument("-oan", "--online_ast_negs", action="store_true", 
+                        help="generate the AST negatives on the fly in the DataLoader workers (the perturbed codes, if given, are used for the snippets they have)")
+    parser.add_argument("-ancs", "--ast_neg_cache_size", type=int, default=10000, 
+                        help="no. of snippets whose online AST negatives are cached per DataLoader worker")
     parser.add_argument("-ccpp", "--code_code_pairs_path", type=str, default=None, 
                         help="path to code-code pairs for CodeRetriever's unimodal objective")
     parser.add_argument("-w", "--warmup_steps", type=int, default=3000, help="no. of warmup steps (soft negatives only during warmup)")
@@ -91,6 +131,9 @@ def get_args():
     if args.use_ccl: args.curr_type = "hard"
     assert not(args.use_ccl and args.use_cross_entropy), "conflicting objectives selected: CCL and CE CL"
     assert not(args.use_ccl and args.code_retriever_baseline), "conflicting objectives selected: CCL and CodeRetriever"
+    assert not(args.in_batch_negs and (args.use_cross_entropy or args.code_retriever_baseline or args.use_ccl)), "in-batch negatives are meant for the triplet margin loss (the CE objectives already use all in-batch positives as negatives)"
+    assert not(args.in_batch_negs and args.dynamic_negative_sampling), "conflicting negative sampling selected: in-batch negatives and DNS"
+    assert not(args.in_batch_negs and args.grad_cache_chunk), "gradient caching isn't supported for in-batch negatives"
     if args.code_retriever_baseline: # only use soft negative for CodeRetriever
         args.curr_type = "soft"
 
@@ -115,6 +158,17 @@ class GraphCodeBERTWrapperModel(nn.Module):
             return self.encoder(inputs_embeds=inputs_embeddings, attention_mask=attn_mask, position_ids=position_idx)[1]
         else: return self.encoder(nl_inputs, attention_mask=nl_inputs.ne(1))[1]
 
+def nl_as_code_inputs(nl_inputs: torch.Tensor, pad_token_id: int=1):
+    """express NL inputs as (code_inputs, attn_mask, position_idx) without data flow nodes, which
+    `GraphCodeBERTWrapperModel` encodes exactly like the `nl_inputs` (same position ids & attention)."""
+    mask = nl_inputs.ne(pad_token_id)
+    # RoBERTa position ids: 2, 3, ... for the tokens & 1 for padding.
+    position_idx = mask.cumsum(-1)*mask+1
+    # every position attends to all the (non pad) tokens.
+    attn_mask = mask[:,None,:].expand(-1, nl_inputs.shape[1], -1)
+
+    return nl_inputs, attn_mask, position_idx
+
 # code dataset.
 class CodeDataset(Dataset):
     def __init__(self, code_snippets: str,  args: dict, tokenizer: Union[str, None, RobertaTokenizer]=None):
@@ -594,6 +648,10 @@ class GraphCodeBERTripletNet(nn.Module):
             RobertaModel.from_pretrained(model_path)
         )
         print(f"loaded embedding model in {(time.time()-start):.2f}s")
+        self.activation_checkpointing = args.get("activation_checkpointing", 0)
+        self.config["activation_checkpointing"] = self.activation_checkpointing
+        if self.activation_checkpointing > 0: # trade recompute for activation memory.
+            enable_activation_checkpointing(self.embed_model.encoder, self.activation_checkpointing)
         print(f"loaded tokenizer files from {tok_path}")
         # create tokenizer.
         self.tokenizer = RobertaTokenizer.from_pretrained(tok_path)
@@ -624,7 +682,13 @@ class GraphCodeBERTripletNet(nn.Module):
         self.use_ccl = args.get("use_ccl", False)
         self.use_scl = args.get("use_scl", False)
         self.use_csim = args.get("use_csim", False)
+        self.fused_forward = args.get("fused_forward", False)
+        self.num_len_buckets = args.get("num_len_buckets", 1)
+        self.precision = args.get("precision", "fp32")
         
+        self.config["fused_forward"] = self.fused_forward
+        self.config["num_len_buckets"] = self.num_len_buckets
+        self.config["precision"] = self.precision
         self.config["code_retriever_baseline"] = self.code_retriever_baseline
         self.config["use_disco_rules"] = self.ignore_non_disco_rules
         self.config["ignore_worst_rules"] = self.ignore_worst_rules
@@ -638,15 +702,33 @@ class GraphCodeBERTripletNet(nn.Module):
         self.dropout2 = nn.Dropout(0.1)
         self.ce_loss = nn.CrossEntropyLoss()
         
-    def forward(self, anchor_title, pos_snippet, neg_snippet):
-        anchor_text_emb = self.embed_model(nl_inputs=anchor_title)
+    @mixed_precision
+    def forward(self, anchor_title, pos_snippet, neg_snippet=None):
+        if self.fused_forward: return self.fused_forward_pass(anchor_title, pos_snippet, neg_snippet)
         anchor_text_emb = self.embed_model(nl_inputs=anchor_title)
         x = pos_snippet
         pos_code_emb = self.embed_model(code_inputs=x[0], attn_mask=x[1], position_idx=x[2])
-        x = neg_snippet
-        neg_code_emb = self.embed_model(code_inputs=x[0], attn_mask=x[1], position_idx=x[2])
+        neg_code_emb = None
+        if neg_snippet is not None:
+            x = neg_snippet
+            neg_code_emb = self.embed_model(code_inputs=x[0], attn_mask=x[1], position_idx=x[2])
         
         return anchor_text_emb, pos_code_emb, neg_code_emb
+
+    def fused_forward_pass(self, anchor_title, pos_snippet, neg_snippet=None):
+        """same as `forward`, but all the sequences are encoded with one encoder call (per length bucket).
+        The NL inputs are expressed in the code input format (w/o data flow nodes) to share the call."""
+        pad_token_id = self.tokenizer.pad_token_id
+        groups = [nl_as_code_inputs(anchor_title, pad_token_id), pos_snippet]
+        if neg_snippet is not None: groups.append(neg_snippet)
+        embs = fused_encode(
+            lambda *x: self.embed_model(code_inputs=x[0], attn_mask=x[1], position_idx=x[2]), groups,
+            lengths=[x[2].ne(1).sum(-1) for x in groups], # position_idx is 1 for padding.
+            pad_values=(pad_token_id, False, 1), num_buckets=self.num_len_buckets,
+        )
+        if neg_snippet is None: embs.append(None)
+
+        return tuple(embs)
         
     def val(self, valloader: DataLoader, epoch_i: int=0, epochs: int=0, device="cuda:0"):
         self.eval()
@@ -780,6 +862,10 @@ class GraphCodeBERTripletNet(nn.Module):
         device_id = args.get("device_id", "cuda:0")
         self.config["device_id"] = device_id
         device = torch.device(device_id)
+        distributed = args.get("distributed", False)
+        if distributed: device = init_distributed(device_id) # one process per device (launched with torchrun).
+        self.config["distributed"] = distributed
+        self.config["world_size"] = get_world_size()
         exp_name = args.get("exp_name", "experiment")
         self.config["exp_name"] = exp_name
         os.makedirs(exp_name, exist_ok=True)
@@ -791,12 +877,35 @@ class GraphCodeBERTripletNet(nn.Module):
         sim_intents_path = args.get("sim_intents_path")
         code_code_pairs_path = args.get("code_code_pairs_path")
         perturbed_codes_path = args.get("perturbed_codes_path")
+        online_ast_negs = args.get("online_ast_negs", False)
+        ast_neg_cache_size = args.get("ast_neg_cache_size", 10000)
         intent_level_dynamic_sampling = args.get("intent_level_dynamic_sampling", False)
         
         self.config["use_ast"] = use_AST
         self.config["sim_intents_path"] = sim_intents_path
         self.config["perturbed_codes_path"] = perturbed_codes_path
         self.config["dynamic_negative_sampling"] = args.get("dynamic_negative_sampling", False)
+        prefetch_depth = args.get("prefetch_depth", 0)
+        num_workers = args.get("num_workers", 0)
+        max_mining_staleness = args.get("max_mining_staleness", 0)
+        self.config["prefetch_depth"] = prefetch_depth
+        self.config["num_workers"] = num_workers
+        self.config["max_mining_staleness"] = max_mining_staleness
+        in_batch_negs = args.get("in_batch_negs", 0)
+        grad_cache_chunk = args.get("grad_cache_chunk", 0)
+        ckpt_steps = args.get("ckpt_steps", 0)
+        keep_last_n = args.get("keep_last_n", 3)
+        resume = args.get("resume")
+        log_telemetry = args.get("telemetry", False)
+        log_every = args.get("log_every", 10)
+        self.config["in_batch_negs"] = in_batch_negs
+        self.config["grad_cache_chunk"] = grad_cache_chunk
+        self.config["ckpt_steps"] = ckpt_steps
+        self.config["keep_last_n"] = keep_last_n
+        self.config["telemetry"] = log_telemetry
+        self.config["log_every"] = log_every
+        self.config["online_ast_negs"] = online_ast_negs
+        self.config["ast_neg_cache_size"] = ast_neg_cache_size
         self.config["intent_level_dynamic_sampling"] = intent_level_dynamic_sampling
 
         print(f"model will be saved at {save_path}")
@@ -805,14 +914,16 @@ class GraphCodeBERTripletNet(nn.Module):
         sim_intents_map = {}
         perturbed_codes = {}
         if intent_level_dynamic_sampling or use_AST:
-            from datautils import DynamicTriplesDataset
+            from datautils import DynamicTriplesDataset, load_perturbed_codes
             if intent_level_dynamic_sampling:
                 assert sim_intents_path is not None, "Missing path to dictionary containing similar intents corresponding to an intent"
                 sim_intents_map = json.load(open(sim_intents_path))
                 perturbed_codes = {}
             if use_AST:
-                assert perturbed_codes_path is not None, "Missing path to dictionary containing perturbed codes corresponding to a given code snippet"
-                perturbed_codes = json.load(open(perturbed_codes_path))
+                msg = "Missing path to dictionary containing perturbed codes corresponding to a given code snippet"
+                assert perturbed_codes_path is not None or online_ast_negs, msg
+                perturbed_codes = load_perturbed_codes(perturbed_codes_path, online=online_ast_negs,
+                                                       cache_size=ast_neg_cache_size)
             trainset = DynamicTriplesDataset(
                 train_path, "graphcodebert", device=device_id, beta=beta, p=p, warmup_steps=warmup_steps,
                 use_AST=use_AST, model=self, tokenizer=self.tokenizer, sim_intents_map=sim_intents_map, 
@@ -856,15 +967,37 @@ class GraphCodeBERTripletNet(nn.Module):
         
         if SHUFFLE_BATCH_DEBUG_SETTING and not(self.code_retriever_baseline): #TODO: remove this. Used only for a temporary experiment.
             from datautils import batch_shuffle_collate_fn_graphcodebert
-            trainloader = DataLoader(trainset, shuffle=True, batch_size=batch_size,
-                                     collate_fn=batch_shuffle_collate_fn_graphcodebert)
+            trainloader = DataLoader(trainset, **get_loader_kwargs(trainset, num_workers=num_workers), 
+                                     batch_size=batch_size, collate_fn=batch_shuffle_collate_fn_graphcodebert)
             valloader = DataLoader(valset, shuffle=False, batch_size=batch_size,
                                    collate_fn=batch_shuffle_collate_fn_graphcodebert)
         else:
-            trainloader = DataLoader(trainset, shuffle=True, 
+            trainloader = DataLoader(trainset, **get_loader_kwargs(trainset, num_workers=num_workers), 
                                      batch_size=batch_size)
             valloader = DataLoader(valset, shuffle=False,
                                    batch_size=batch_size)
+        if num_workers > 0 and hasattr(trainset, "defer_mining"):
+            # the workers make the hard negative candidates, the model picks among them in this process.
+            trainloader = DeferredMiningLoader(trainloader, trainset)
+        if prefetch_depth > 0: # prepare (and mine negatives for) the next batch while the current one trains.
+            mine_fn = None
+            if args.get("dynamic_negative_sampling", False):
+                mine_fn = lambda net, batch: dynamic_negative_sampling(
+                    net.embed_model, batch, model_name="graphcodebert", 
+                    device=device, k=1,
+                )
+            trainloader = MiningPrefetcher(
+                trainloader, model=self, mine_fn=mine_fn, depth=prefetch_depth,
+                max_staleness=max_mining_staleness, model_in_the_loop=hasattr(trainset, "model"),
+            )
+            if hasattr(trainset, "model") and trainloader.background: trainloader.bind(trainset)
+        # DDP wrapped net (the gradients are all-reduced over the ranks).
+        net = wrap_ddp(self, device) if distributed else self
+        # encode the batch in chunks and backpropagate the cached embedding gradients (see `GradCache`).
+        grad_cache = GradCache(net, grad_cache_chunk) if grad_cache_chunk > 0 else None
+        encode = grad_cache.encode if grad_cache is not None else net
+        # loss scaling for fp16 training (a no-op otherwise).
+        scaler = get_grad_scaler(device, self.precision)
         train_metrics = {
             "log_steps": [],
             "summary": [],
@@ -878,29 +1011,67 @@ class GraphCodeBERTripletNet(nn.Module):
             train_acc = 0
             train_u_acc = 0
         best_val_acc = 0
-        for epoch_i in range(epochs):
+        # running mean of the epoch's batch losses (kept on the device).
+        loss_mean = RunningMean()
+        # periodic full (resumable) training state checkpoints, written in the background by the main process.
+        ckpt_writer = CheckpointWriter(os.path.join(exp_name, "checkpoints"), keep_last_n) if ckpt_steps > 0 and is_main_process() else None
+        # per step stage timings (data, tokenization, mining, forward, backward, optimizer, validation, checkpointing).
+        telemetry = Telemetry(os.path.join(exp_name, "telemetry.jsonl"), device, enabled=log_telemetry and is_main_process())
+        resume_state, start_epoch = None, 0
+        if resume is not None:
+            resume_state = load_training_state(resume, self, self.optimizer, scaler, trainset, trainloader)
+            start_epoch, best_val_acc, train_metrics = resume_state["epoch"], resume_state["best_val_acc"], resume_state["train_metrics"]
+        # the ranks start from the curriculum of the main process, and then stay in sync (they update it with the same all-gathered accuracies).
+        if distributed: sync_curriculum(trainset)
+        for epoch_i in range(start_epoch, epochs):
             self.train()
+            set_epoch(trainloader, epoch_i)
+            start_step = resume_state["step"] if resume_state is not None else 0
             batch_losses = []
-            pbar = tqdm(enumerate(trainloader), total=len(trainloader),
-                        desc=f"train: epoch: {epoch_i+1}/{epochs} batch_loss: 0 loss: 0 acc: 0")
+            loss_mean.reset()
+            pbar = tqdm(telemetry.timed(enumerate(trainloader, start=start_step)), total=len(trainloader), initial=start_step,
+                        desc=f"train: epoch: {epoch_i+1}/{epochs} batch_loss: 0 loss: 0 acc: 0", disable=not is_main_process())
             rule_wise_acc.reset()
             if not(self.use_cross_entropy or self.code_retriever_baseline):
                 train_soft_neg_acc.reset()
                 train_hard_neg_acc.reset()
+            if resume_state is not None: # continue the interrupted epoch where it left off.
+                batch_losses = [loss.to(device) for loss in resume_state["batch_losses"]]
+                train_tot, train_acc, train_u_acc = (resume_state["counters"].get(k, 0) for k in LOOP_COUNTERS)
+                restore_metrics(resume_state, locals())
+                resume_state = None
             for step, batch in pbar:
-                if args.get("dynamic_negative_sampling", False):
+                # refresh the progress bar (syncs the metrics with the host) only every `log_every` steps.
+                log_step = (step+1) % log_every == 0 or (step+1) == len(trainloader)
+                if args.get("dynamic_negative_sampling", False) and prefetch_depth == 0:
                     batch = dynamic_negative_sampling(
                         self.embed_model, batch, 
                         model_name="graphcodebert", 
                         device=device, k=1
                     )
+                    telemetry.lap("mining")
                 self.train()
                 anchor_title = batch[6].to(device)
                 pos_snippet = (batch[0].to(device), batch[1].to(device), batch[2].to(device))
                 neg_snippet = (batch[3].to(device), batch[4].to(device), batch[5].to(device))
                 # print(neg_snippet[0].shape, neg_snippet[1].shape, neg_snippet[2].shape)
-                anchor_text_emb, pos_code_emb, neg_code_emb = self(anchor_title, pos_snippet, neg_snippet)
                 N = len(batch[0])
+                if in_batch_negs > 0 and N > 1 and len(torch.unique(pos_snippet[0], dim=0)) > 1:
+                    # soft negatives are mined from the batch's own positives (at least two distinct ones are needed),
+                    # so only the hard negatives are encoded.
+                    is_hard = (batch[-1]!=0) if hasattr(trainset, "update") else torch.zeros(N, dtype=torch.bool)
+                    hard_neg_snippet = tuple(x[is_hard.to(device)] for x in neg_snippet) if is_hard.any() else None
+                    anchor_text_emb, pos_code_emb, hard_neg_emb = net(anchor_title, pos_snippet, hard_neg_snippet)
+                    anchor_text_emb, pos_code_emb, neg_code_emb, rule_ids = in_batch_hard_negatives(
+                        anchor_text_emb, pos_code_emb, hard_neg_emb, is_hard=is_hard,
+                        rule_ids=batch[-1], pos_ids=pos_snippet[0], k=in_batch_negs, use_csim=self.use_csim,
+                    )
+                    if hasattr(trainset, "update"): batch[-1] = rule_ids
+                else: anchor_text_emb, pos_code_emb, neg_code_emb = encode(anchor_title, pos_snippet, neg_snippet)
+                if distributed: # the losses & metrics see the (in-batch negatives of the) triplets of every rank.
+                    anchor_text_emb, pos_code_emb, neg_code_emb = map(all_gather, (anchor_text_emb, pos_code_emb, neg_code_emb))
+                    if torch.is_tensor(batch[-1]): batch[-1] = all_gather(batch[-1])
+                    N = len(anchor_text_emb)
                 if hasattr(trainset, "update") or isinstance(trainset, CodeRetrieverDataset):
                     if not(self.use_cross_entropy or self.code_retriever_baseline):
                         train_soft_neg_acc.update(
@@ -915,7 +1086,7 @@ class GraphCodeBERTripletNet(nn.Module):
                             train_soft_neg_acc.last_batch_acc,
                             train_hard_neg_acc.last_batch_acc,
                         )
-                        HARD_ACC = f" ha:{100*train_hard_neg_acc.get():.2f}"
+                        if log_step: HARD_ACC = f" ha:{100*train_hard_neg_acc.get():.2f}"
                         MIX_STEP = trainset.mix_step()
                     if self.use_scl:
                         batch_loss = scl_loss(
@@ -923,9 +1094,10 @@ class GraphCodeBERTripletNet(nn.Module):
                             neg_code_emb, lamb=1, device=device,
                             loss_fn=self.loss_fn,
                         ).mean()
-                        pd_ap = F.pairwise_distance(anchor_text_emb, pos_code_emb).mean().item()
-                        pd_an = F.pairwise_distance(anchor_text_emb, neg_code_emb).mean().item()
-                        pd_ap_an_info = f" ap:{pd_ap:.3f} an:{pd_an:.3f}"
+                        if log_step:
+                            pd_ap = F.pairwise_distance(anchor_text_emb, pos_code_emb).mean().item()
+                            pd_an = F.pairwise_distance(anchor_text_emb, neg_code_emb).mean().item()
+                            pd_ap_an_info = f" ap:{pd_ap:.3f} an:{pd_an:.3f}"
                         # hard_loss = self.loss_fn(anchor_text_emb, torch.zeros_like(
                         #                          pos_code_emb), neg_code_emb)
                         # soft_loss = self.loss_fn(anchor_text_emb, pos_code_emb, neg_code_emb)
@@ -938,10 +1110,11 @@ class GraphCodeBERTripletNet(nn.Module):
                         target = torch.as_tensor(range(N)).to(device)
                         batch_loss = self.ce_loss(scores, target)
                         preds = scores.argmax(dim=-1)
-                        train_acc += (preds == target).sum().item()
+                        train_acc += (preds == target).sum()
                         train_tot += N
-                        batch_loss_str = f"bl:{batch_loss:.3f}"
-                        metric_str = f"a:{(100*train_acc/train_tot):.2f}"
+                        if log_step:
+                            batch_loss_str = f"bl:{batch_loss:.3f}"
+                            metric_str = f"a:{(100*train_acc/train_tot):.2f}"
                     elif self.code_retriever_baseline:
                         if self.use_csim:
                             d_ap = -cos_csim(anchor_text_emb, pos_code_emb)
@@ -958,11 +1131,12 @@ class GraphCodeBERTripletNet(nn.Module):
                         batch_loss = unimodal_loss + bimodal_loss
                         b_preds = (-d_ap).argmax(dim=-1)
                         u_preds = (-d_pn).argmax(dim=-1)
-                        train_acc += (b_preds == target).sum().item()
-                        train_u_acc += (u_preds == target).sum().item()
+                        train_acc += (b_preds == target).sum()
+                        train_u_acc += (u_preds == target).sum()
                         train_tot += N
-                        metric_str = f"ba:{(100*train_acc/train_tot):.2f} ua:{(100*train_u_acc/train_tot):.2f}"
-                        batch_loss_str = f"bl:{batch_loss:.3f}={unimodal_loss:.3f}u+{bimodal_loss:.3f}b"
+                        if log_step:
+                            metric_str = f"ba:{(100*train_acc/train_tot):.2f} ua:{(100*train_u_acc/train_tot):.2f}"
+                            batch_loss_str = f"bl:{batch_loss:.3f}={unimodal_loss:.3f}u+{bimodal_loss:.3f}b"
                     else:
                         # pd_ap = F.pairwise_distance(anchor_text_emb, pos_code_emb)
                         # pd_an = F.pairwise_distance(anchor_text_emb, neg_code_emb)
@@ -987,34 +1161,42 @@ class GraphCodeBERTripletNet(nn.Module):
                             #                                 neg_code_emb).mean()
                             ccl_loss = self.ce_loss(scores, target)
                             batch_loss = soft_margin_loss + ccl_loss
-                            batch_loss_str = f"bl:{batch_loss:.3f}={soft_margin_loss:.3f}+{ccl_loss:.3f}"
+                            if log_step: batch_loss_str = f"bl:{batch_loss:.3f}={soft_margin_loss:.3f}+{ccl_loss:.3f}"
                             # batch_loss = soft_margin_loss + hard_margin_loss + ccl_loss
                             # batch_loss_str = f"bl:{batch_loss:.3f}={soft_margin_loss:.3f}+{hard_margin_loss:.3f}+{ccl_loss:.3f}"
                         else: 
                             batch_loss = self.loss_fn(anchor_text_emb, pos_code_emb, neg_code_emb).mean()
-                            batch_loss_str = f"bl:{batch_loss:.3f}"
+                            if log_step: batch_loss_str = f"bl:{batch_loss:.3f}"
                     rule_wise_acc.update(anchor_text_emb, pos_code_emb, 
                                          neg_code_emb, batch[-1].cpu().tolist())
                     if (self.use_cross_entropy or self.code_retriever_baseline):
-                        pbar.set_description(f"T e:{epoch_i+1}/{epochs} bl:{batch_loss:.3f} l:{np.mean(batch_losses):.3f} {metric_str}")
+                        if log_step: pbar.set_description(f"T e:{epoch_i+1}/{epochs} bl:{batch_loss:.3f} l:{loss_mean.get():.3f} {metric_str}")
                     else: 
-                        pbar.set_description(
-                            f"T e:{epoch_i+1}/{epochs} {MIX_STEP}{batch_loss_str} l:{np.mean(batch_losses):.3f} a:{100*train_soft_neg_acc.get():.2f}{HARD_ACC}"
-                        )
+                        if log_step:
+                            pbar.set_description(
+                                f"T e:{epoch_i+1}/{epochs} {MIX_STEP}{batch_loss_str} l:{loss_mean.get():.3f} a:{100*train_soft_neg_acc.get():.2f}{HARD_ACC}"
+                            )
                 else: 
                     train_soft_neg_acc.update(
                         anchor_text_emb, 
                         pos_code_emb, neg_code_emb
                     )
                     batch_loss = self.loss_fn(anchor_text_emb, pos_code_emb, neg_code_emb).mean()
-                    pbar.set_description(f"train: epoch: {epoch_i+1}/{epochs} batch_loss: {batch_loss:.3f} loss: {np.mean(batch_losses):.3f} acc: {100*train_soft_neg_acc.get():.2f}")
-                batch_loss.backward()
-                self.optimizer.step()
+                    if log_step: pbar.set_description(f"train: epoch: {epoch_i+1}/{epochs} batch_loss: {batch_loss:.3f} loss: {loss_mean.get():.3f} acc: {100*train_soft_neg_acc.get():.2f}")
+                telemetry.lap("forward")
+                scaler.scale(batch_loss).backward()
+                if grad_cache is not None: grad_cache.backward()
+                telemetry.lap("backward")
+                scaler.step(self.optimizer)
+                scaler.update()
                 # scheduler.step()  # Update learning rate schedule
                 self.zero_grad()
-                batch_losses.append(batch_loss.item())
+                if prefetch_depth > 0: trainloader.step()
+                telemetry.lap("optimizer")
+                batch_losses.append(batch_loss.detach())
+                loss_mean.update(batch_loss)
                 # if step == 5: break # DEBUG
-                if ((step+1) % VALID_STEPS == 0) or ((step+1) == len(trainloader)):
+                if is_main_process() and (((step+1) % VALID_STEPS == 0) or ((step+1) == len(trainloader))):
                     # validate current model
                     print(rule_wise_acc())
                     print(dict(rule_wise_acc.counts))
@@ -1038,18 +1220,20 @@ class GraphCodeBERTripletNet(nn.Module):
                     if val_acc > best_val_acc and (not(hasattr(trainset, "warmup_steps")) or trainset.warmup_steps == 0):
                         print(f"saving best model till now with val_acc: {val_acc} at {save_path}")
                         best_val_acc = val_acc
+                        telemetry.lap("validation")
                         torch.save(self.state_dict(), save_path)
+                        telemetry.lap("checkpoint")
 
                     train_metrics["log_steps"].append({
-                        "train_batch_losses": batch_losses, 
-                        "train_loss": np.mean(batch_losses), 
+                        "train_batch_losses": torch.stack(batch_losses).tolist(), 
+                        "train_loss": loss_mean.get(), 
                         "val_loss": val_loss,
                         "val_acc": 100*val_acc,
                     })
                     if (self.use_cross_entropy or self.code_retriever_baseline):
-                        train_metrics["train_acc"] = 100*train_acc/train_tot
+                        train_metrics["train_acc"] = 100*int(train_acc)/train_tot
                         if self.code_retriever_baseline:
-                            train_metrics["train_u_acc"] = 100*train_u_acc/train_tot
+                            train_metrics["train_u_acc"] = 100*int(train_u_acc)/train_tot
                     else:
                         train_metrics["train_soft_neg_acc"] = 100*train_soft_neg_acc.get()
                         train_metrics["train_hard_neg_acc"] = 100*train_hard_neg_acc.get()
@@ -1057,7 +1241,20 @@ class GraphCodeBERTripletNet(nn.Module):
                     print(f"saving metrics to {metrics_path}")
                     with open(metrics_path, "w") as f:
                         json.dump(train_metrics, f)
+                    telemetry.lap("validation")
+                global_step = epoch_i*len(trainloader)+step+1
+                if ckpt_writer is not None and global_step % ckpt_steps == 0:
+                    ckpt_writer.save(training_state(
+                        self, self.optimizer, scaler, trainset, trainloader, epoch=epoch_i, step=step+1,
+                        best_val_acc=best_val_acc, train_metrics=train_metrics, batch_losses=batch_losses,
+                        **loop_state(locals()),
+                    ), global_step)
+                    telemetry.lap("checkpoint")
+                telemetry.end_step(epoch_i, step, N)
+            telemetry.end_epoch(epoch_i)
             if self.code_retriever_baseline: trainset.reset()        
+        if ckpt_writer is not None: ckpt_writer.close()
+        telemetry.close()
         
         return train_metrics
 
@@ -1247,7 +1444,9 @@ if __name__ == "__main__":
         print("creating model object")
         # instantiate model class.
         tok_path = get_tok_path("graphcodebert")
-        triplet_net = GraphCodeBERTripletNet(tok_path=tok_path, **vars(args))
+        # a fast checkpoint replaces all the weights, so the pretrained ones aren't loaded.
+        with empty_weights(is_fast_checkpoint(get_ckpt_path(args.exp_name))):
+            triplet_net = GraphCodeBERTripletNet(tok_path=tok_path, **vars(args))
         test_ood_performance(
             triplet_net, model_name="graphcodebert", args=args,
             query_paths=["query_and_candidates.json", "external_knowledge/queries.json", 
@@ -1,21 +1,147 @@
 # This package contains main model files, for our "Universal Joint/Shared Space Encoder"
 # some common utilites.
 import os
+import copy
 import json
 import time
+import types
+import queue
+import functools
+import contextlib
 import torch
 import argparse
+import threading
 import numpy as np
+import torch.nn as nn
 from typing import *
 from tqdm import tqdm
 from models.losses import cos_csim
 from torch.utils.data import DataLoader
+from torch.utils.checkpoint import checkpoint
+from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
 from sklearn.metrics import ndcg_score as NDCG
-from datautils import DiscoDataset, ValRetDataset
-from models.metrics import TripletAccuracy, recall_at_k, RuleWiseAccuracy
+from datautils import DiscoDataset, ValRetDataset, load_perturbed_codes
+from models.metrics import TripletAccuracy, recall_at_k, RuleWiseAccuracy, RunningMean
+from models.distributed import init_distributed, wrap_ddp, get_loader_kwargs, set_epoch, all_gather, \
+                               is_main_process, get_world_size
+from models.serialization import get_ckpt_path, load_checkpoint
+from datautils.telemetry import Telemetry
+from models.checkpointing import CheckpointWriter, training_state, load_training_state, loop_state, restore_metrics
 from sklearn.metrics import label_ranking_average_precision_score as MRR
 
 VALID_STEPS = 501
+PRECISION_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+def autocast_context(device: str, precision: str="fp32"):
+    """autocast context for the given precision (CPU autocast always uses bf16)."""
+    if precision == "fp32": return contextlib.nullcontext()
+    device_type = "cuda" if str(device).startswith("cuda") else "cpu"
+    dtype = PRECISION_DTYPES[precision] if device_type == "cuda" else torch.bfloat16
+
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
+def get_grad_scaler(device: str, precision: str="fp32"):
+    """loss scaler, only enabled for fp16 on GPU (bf16 has the exponent range of fp32)."""
+    return torch.cuda.amp.GradScaler(enabled=(precision == "fp16" and str(device).startswith("cuda")))
+
+def mixed_precision(forward):
+    """decorator for the forward of the triplet nets: encodes under autocast at the net's `precision`
+    and returns fp32 embeddings, so that the losses (cdist based CE, triplet margin) are computed in fp32."""
+    @functools.wraps(forward)
+    def wrapper(net, *args, **kwargs):
+        precision = getattr(net, "precision", "fp32")
+        if precision == "fp32": return forward(net, *args, **kwargs)
+        device = next(net.parameters()).device
+        with autocast_context(device, precision):
+            embs = forward(net, *args, **kwargs)
+
+        return tuple(None if emb is None else emb.float() for emb in embs)
+
+    return wrapper
+
+def _segment_checkpointed_encoder_forward(self, hidden_states, attention_mask=None, head_mask=None,
+                                          encoder_hidden_states=None, encoder_attention_mask=None,
+                                          past_key_values=None, use_cache=None, output_attentions=False,
+                                          output_hidden_states=False, return_dict=True):
+    """forward of a huggingface `RobertaEncoder` whose layers are checkpointed in segments of `ckpt_segment_size`
+    layers (the usual forward outside of training). Only the input of each segment is kept for backward, so the
+    cache, attentions and hidden states of the layers inside the segments aren't available."""
+    if not(self.training and torch.is_grad_enabled()):
+        return type(self).forward(
+            self, hidden_states, attention_mask=attention_mask, head_mask=head_mask,
+            encoder_hidden_states=encoder_hidden_states, encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values, use_cache=use_cache, output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states, return_dict=return_dict,
+        )
+    if output_attentions or output_hidden_states or past_key_values is not None:
+        raise ValueError("per layer attentions, hidden states and caches aren't supported with segment activation checkpointing")
+    def run_segment(hidden_states, start: int):
+        for i in range(start, min(start+self.ckpt_segment_size, len(self.layer))):
+            layer_head_mask = head_mask[i] if head_mask is not None else None
+            hidden_states = self.layer[i](
+                hidden_states, attention_mask, layer_head_mask, 
+                encoder_hidden_states, encoder_attention_mask,
+            )[0]
+        return hidden_states
+    for start in range(0, len(self.layer), self.ckpt_segment_size):
+        # the activations of the segment are recomputed during backward.
+        hidden_states = checkpoint(run_segment, hidden_states, start, use_reentrant=False)
+    # (use_cache is off: there are no per layer key/values to return)
+    if not return_dict: return (hidden_states,)
+
+    return BaseModelOutputWithPastAndCrossAttentions(last_hidden_state=hidden_states)
+
+def enable_activation_checkpointing(roberta: nn.Module, segment_size: int=1):
+    """activation checkpointing for the layers of a huggingface `RobertaModel`: the layers are split into segments 
+    of `segment_size` layers (the granularity) and only the input of each segment is stored for backward.
+    Smaller segments store more inputs but recompute less at a time. Single layer segments use the model's own
+    gradient checkpointing, longer ones patch the encoder's forward in place, so the parameters & state dict 
+    (and saved checkpoints) are unchanged either way."""
+    # the key/value cache (on for decoders like UniXcoder's) can't be kept while checkpointing and isn't
+    # needed for the embeddings (huggingface would warn about & turn it off at every training step).
+    roberta.config.use_cache = False
+    if segment_size == 1:
+        roberta.gradient_checkpointing_enable()
+        return
+    roberta.encoder.ckpt_segment_size = segment_size
+    roberta.encoder.forward = types.MethodType(_segment_checkpointed_encoder_forward, roberta.encoder)
+
+def get_disco_trainset(triplet_net, model_name: str, train_path: str, perturbed_codes):
+    if model_name == "codebert":
+        trainset = DiscoDataset(
+            train_path, perturbed_codes=perturbed_codes, model_name=model_name, tokenizer=triplet_net.tokenizer,
+            max_length=100, padding="max_length", return_tensors="pt", add_special_tokens=True, truncation=True,
+        )
+    elif model_name == "graphcodebert":
+        trainset = DiscoDataset(
+            train_path, perturbed_codes=perturbed_codes, model_name=model_name, 
+            tokenizer=triplet_net.tokenizer, nl_length=100, code_length=100, data_flow_length=64,
+        )
+    elif model_name == "unixcoder":
+        trainset = DiscoDataset(
+            train_path, perturbed_codes=perturbed_codes, model_name=model_name, 
+            tokenizer=triplet_net.tokenizer, max_length=100, padding=True,
+        )
+
+    return trainset
+
+def get_disco_batch(batch: list, model_name: str, device: str):
+    """move a `DiscoDataset` batch to the device and split it into anchor, positive & negative inputs."""
+    if model_name == "codebert":
+        anchor_title = (batch[0].to(device), batch[1].to(device))
+        pos_snippet = (batch[2].to(device), batch[3].to(device))
+        neg_snippet = (batch[4].to(device), batch[5].to(device))
+    elif model_name == "graphcodebert":
+        anchor_title = batch[6].to(device)
+        pos_snippet = (batch[0].to(device), batch[1].to(device), batch[2].to(device))
+        neg_snippet = (batch[3].to(device), batch[4].to(device), batch[5].to(device))
+    elif model_name == "unixcoder":
+        anchor_title = batch[0].to(device)
+        pos_snippet = batch[1].to(device)
+        neg_snippet = batch[2].to(device)
+
+    return anchor_title, pos_snippet, neg_snippet
+
 def fit_disco(triplet_net, model_name: str, **args):
     train_path = args.get("train_path")
     val_path = args.get("val_path")
@@ -27,7 +153,15 @@ def fit_disco(triplet_net, model_name: str, **args):
     device_id = args.get("device_id", "cuda:0")
     batch_size = args.get("batch_size", 32)
     epochs = args.get("epochs", 5)
+    grad_cache_chunk = args.get("grad_cache_chunk", 0)
+    ckpt_steps = args.get("ckpt_steps", 0)
+    keep_last_n = args.get("keep_last_n", 3)
+    resume = args.get("resume")
+    log_telemetry = args.get("telemetry", False)
+    log_every = args.get("log_every", 10)
     device = device_id if torch.cuda.is_available() else "cpu"
+    distributed = args.get("distributed", False)
+    if distributed: device = init_distributed(device_id) # one process per device (launched with torchrun).
     # create experiment folder.
     os.makedirs(exp_name, exist_ok=True)
     # save params to config file.
@@ -38,35 +172,35 @@ def fit_disco(triplet_net, model_name: str, **args):
     triplet_net.config["exp_name"] = exp_name
     triplet_net.config["val_path"] = val_path
     triplet_net.config["epochs"] = epochs
+    triplet_net.config["grad_cache_chunk"] = grad_cache_chunk
+    triplet_net.config["ckpt_steps"] = ckpt_steps
+    triplet_net.config["keep_last_n"] = keep_last_n
+    triplet_net.config["telemetry"] = log_telemetry
+    triplet_net.config["log_every"] = log_every
+    triplet_net.config["distributed"] = distributed
+    triplet_net.config["world_size"] = get_world_size()
 
     print(f"model will be saved at {save_path}")
     print(f"moving model to {device}")
     triplet_net.embed_model.to(device)
     assert perturbed_codes_path is not None, msg.format("perturbed codes", "code snippet")
-    perturbed_codes = json.load(open(perturbed_codes_path))
+    perturbed_codes = load_perturbed_codes(perturbed_codes_path)
     # create the datasets and data loaders.
-    if model_name == "codebert":
-        trainset = DiscoDataset(
-            train_path, perturbed_codes=perturbed_codes, model_name=model_name, tokenizer=triplet_net.tokenizer,
-            max_length=100, padding="max_length", return_tensors="pt", add_special_tokens=True, truncation=True,
-        )
-    elif model_name == "graphcodebert":
-        trainset = DiscoDataset(
-            train_path, perturbed_codes=perturbed_codes, model_name=model_name, 
-            tokenizer=triplet_net.tokenizer, nl_length=100, code_length=100, data_flow_length=64,
-        )
-    elif model_name == "unixcoder":
-        trainset = DiscoDataset(
-            train_path, perturbed_codes=perturbed_codes, model_name=model_name, 
-            tokenizer=triplet_net.tokenizer, max_length=100, padding=True,
-        )
+    trainset = get_disco_trainset(triplet_net, model_name, train_path, perturbed_codes)
     valset = ValRetDataset(val_path)
     config_path = os.path.join(exp_name, "config.json") # path to config file
     with open(config_path, "w") as f: # save config file.
         print(triplet_net.config)
         json.dump(triplet_net.config, f)
     print(f"saved config to {config_path}")
-    trainloader = DataLoader(trainset, shuffle=True, batch_size=batch_size)
+    trainloader = DataLoader(trainset, **get_loader_kwargs(trainset), batch_size=batch_size)
+    # DDP wrapped net (the gradients are all-reduced over the ranks).
+    net = wrap_ddp(triplet_net, device) if distributed else triplet_net
+    # encode the batch in chunks and backpropagate the cached embedding gradients (see `GradCache`).
+    grad_cache = GradCache(net, grad_cache_chunk) if grad_cache_chunk > 0 else None
+    encode = grad_cache.encode if grad_cache is not None else net
+    # loss scaling for fp16 training (a no-op otherwise).
+    scaler = get_grad_scaler(device, getattr(triplet_net, "precision", "fp32"))
     train_metrics = {"log_steps": [], "summary": []} 
     # rule wise triplet accuracies.
     rule_wise_acc = RuleWiseAccuracy(margin=1)
@@ -74,54 +208,73 @@ def fit_disco(triplet_net, model_name: str, **args):
     train_tot = 0
     train_acc = 0
     best_val_acc = 0
-    for epoch_i in range(epochs):
+    # running mean of the epoch's batch losses (kept on the device).
+    loss_mean = RunningMean()
+    # periodic full (resumable) training state checkpoints, written in the background by the main process.
+    ckpt_writer = CheckpointWriter(os.path.join(exp_name, "checkpoints"), keep_last_n) if ckpt_steps > 0 and is_main_process() else None
+    # per step stage timings (data, tokenization, forward, backward, optimizer, validation, checkpointing).
+    telemetry = Telemetry(os.path.join(exp_name, "telemetry.jsonl"), device, enabled=log_telemetry and is_main_process())
+    resume_state, start_epoch = None, 0
+    if resume is not None:
+        resume_state = load_training_state(resume, triplet_net, triplet_net.optimizer, scaler, trainset, trainloader)
+        start_epoch, best_val_acc, train_metrics = resume_state["epoch"], resume_state["best_val_acc"], resume_state["train_metrics"]
+    for epoch_i in range(start_epoch, epochs):
         triplet_net.train()
+        set_epoch(trainloader, epoch_i)
+        start_step = resume_state["step"] if resume_state is not None else 0
         batch_losses = []
-        pbar = tqdm(enumerate(trainloader), total=len(trainloader),
-                    desc=f"train: epoch: {epoch_i+1}/{epochs} batch_loss: 0 loss: 0 acc: 0")
+        loss_mean.reset()
+        pbar = tqdm(telemetry.timed(enumerate(trainloader, start=start_step)), total=len(trainloader), initial=start_step, 
+                    disable=not is_main_process(), desc=f"train: epoch: {epoch_i+1}/{epochs} batch_loss: 0 loss: 0 acc: 0")
         # reset triplet accuracies.
         rule_wise_acc.reset() 
+        if resume_state is not None: # continue the interrupted epoch where it left off.
+            batch_losses = [loss.to(device) for loss in resume_state["batch_losses"]]
+            train_tot, train_acc = (resume_state["counters"].get(k, 0) for k in ("train_tot", "train_acc"))
+            restore_metrics(resume_state, locals())
+            resume_state = None
         for step, batch in pbar:
+            # refresh the progress bar (syncs the metrics with the host) only every `log_every` steps.
+            log_step = (step+1) % log_every == 0 or (step+1) == len(trainloader)
             triplet_net.train()
-            if model_name == "codebert":
-                anchor_title = (batch[0].to(device), batch[1].to(device))
-                pos_snippet = (batch[2].to(device), batch[3].to(device))
-                neg_snippet = (batch[4].to(device), batch[5].to(device))
-            elif model_name == "graphcodebert":
-                anchor_title = batch[6].to(device)
-                pos_snippet = (batch[0].to(device), batch[1].to(device), batch[2].to(device))
-                neg_snippet = (batch[3].to(device), batch[4].to(device), batch[5].to(device))
-            elif model_name == "unixcoder":
-                anchor_title = batch[0].to(device)
-                pos_snippet = batch[1].to(device)
-                neg_snippet = batch[2].to(device)
-            anchor_text_emb, pos_code_emb, neg_code_emb = triplet_net(
+            anchor_title, pos_snippet, neg_snippet = get_disco_batch(batch, model_name, device)
+            anchor_text_emb, pos_code_emb, neg_code_emb = encode(
                 anchor_title, pos_snippet, neg_snippet
             )
-            N = len(batch[0])
+            if distributed: # the CE loss sees the (in-batch negatives of the) triplets of every rank.
+                anchor_text_emb, pos_code_emb, neg_code_emb = map(all_gather, (anchor_text_emb, pos_code_emb, neg_code_emb))
+                batch[-1] = all_gather(batch[-1])
+            N = len(anchor_text_emb)
             d_ap = torch.cdist(anchor_text_emb, pos_code_emb)
             d_an = torch.cdist(anchor_text_emb, neg_code_emb)
             scores = -torch.cat((d_ap, d_an), axis=-1)
             target = torch.as_tensor(range(N)).to(device)
             batch_loss = triplet_net.ce_loss(scores, target) # CE bimodal loss.
-            batch_loss.backward() # compute gradients.
-            triplet_net.optimizer.step() # take optimization step.
+            telemetry.lap("forward")
+            scaler.scale(batch_loss).backward() # compute gradients.
+            if grad_cache is not None: grad_cache.backward() # backpropagate them through the encoder chunk by chunk.
+            telemetry.lap("backward")
+            scaler.step(triplet_net.optimizer) # take optimization step.
+            scaler.update()
             triplet_net.zero_grad() # clear gradients
-            batch_losses.append(batch_loss.item()) # collect batch losses.
+            telemetry.lap("optimizer")
+            batch_losses.append(batch_loss.detach()) # collect batch losses.
+            loss_mean.update(batch_loss)
 
             # update metrics.
             train_tot += N
             preds = scores.argmax(dim=-1)
-            train_acc += (preds == target).sum().item()
+            train_acc += (preds == target).sum()
             rule_wise_acc.update(anchor_text_emb, pos_code_emb, 
                                  neg_code_emb, batch[-1].tolist())
             # batch loss string (show values of various losses)
-            batch_loss_str = f"bl:{batch_loss:.3f}"
+            if log_step: batch_loss_str = f"bl:{batch_loss:.3f}"
             # show metrics
-            metric_str = f"{(100*train_acc/train_tot):.2f}"
-            pbar.set_description(f"T e:{epoch_i+1}/{epochs} {batch_loss_str} l:{np.mean(batch_losses):.3f} {metric_str}")
+            if log_step:
+                metric_str = f"{(100*train_acc/train_tot):.2f}"
+                pbar.set_description(f"T e:{epoch_i+1}/{epochs} {batch_loss_str} l:{loss_mean.get():.3f} {metric_str}")
             # if step == 5: break # DEBUG
-            if ((step+1) % VALID_STEPS == 0) or ((step+1) == len(trainloader)):
+            if is_main_process() and (((step+1) % VALID_STEPS == 0) or ((step+1) == len(trainloader))):
                 # validate current model
                 print(rule_wise_acc())
                 print(dict(rule_wise_acc.counts))
@@ -134,19 +287,34 @@ def fit_disco(triplet_net, model_name: str, **args):
                 if val_acc > best_val_acc and (not(hasattr(trainset, "warmup_steps")) or trainset.warmup_steps == 0):
                     best_val_acc = val_acc
                     print(f"saving best model till now with val_acc: {val_acc} at {save_path}")
+                    telemetry.lap("validation")
                     torch.save(triplet_net.state_dict(), save_path)
+                    telemetry.lap("checkpoint")
 
                 train_metrics["log_steps"].append({
-                    "train_batch_losses": batch_losses, 
-                    "train_loss": np.mean(batch_losses), 
+                    "train_batch_losses": torch.stack(batch_losses).tolist(), 
+                    "train_loss": loss_mean.get(), 
                     "val_loss": val_loss,
                     "val_acc": 100*val_acc,
                 })
-                train_metrics["train_acc"] = 100*train_acc/train_tot
+                train_metrics["train_acc"] = 100*int(train_acc)/train_tot
                 metrics_path = os.path.join(exp_name, "train_metrics.json")
                 print(f"saving metrics to {metrics_path}")
                 with open(metrics_path, "w") as f:
                     json.dump(train_metrics, f)
+                telemetry.lap("validation")
+            global_step = epoch_i*len(trainloader)+step+1
+            if ckpt_writer is not None and global_step % ckpt_steps == 0:
+                ckpt_writer.save(training_state(
+                    triplet_net, triplet_net.optimizer, scaler, trainset, trainloader, epoch=epoch_i, step=step+1,
+                    best_val_acc=best_val_acc, train_metrics=train_metrics, batch_losses=batch_losses,
+                    **loop_state(locals()),
+                ), global_step)
+                telemetry.lap("checkpoint")
+            telemetry.end_step(epoch_i, step, N)
+        telemetry.end_epoch(epoch_i)
+    if ckpt_writer is not None: ckpt_writer.close()
+    telemetry.close()
 
     return train_metrics
 
@@ -172,17 +340,15 @@ def test_ood_performance(triplet_net, model_name: str, query_paths: List[str],
                          dataset_names: List[str]=["CoNaLa", "External Knowledge", "Web Query", "CodeSearchNet"]):
     """do only code retrieval with l2 distance as distance function"""
     device = args.device_id if torch.cuda.is_available() else "cpu"
-    ckpt_path = os.path.join(args.exp_name, "model.pt")
+    # fast checkpoints (see `models.serialization`) are memory mapped into a net built with `empty_weights`.
+    ckpt_path = get_ckpt_path(args.exp_name)
     print(f"loading checkpoint (state dict) from {ckpt_path}")
-    try: state_dict = torch.load(ckpt_path, map_location="cpu")
+    try: 
+        load_checkpoint(triplet_net, ckpt_path)
+        print(f"\x1b[32;1mloaded state dict from {ckpt_path}\x1b[0m")
     except Exception as e: 
-        state_dict = None
         print("Couldn't load state dict because:")
         print(e)
-    # load model checkpoint.
-    if state_dict: 
-        print(f"\x1b[32;1mloading state dict from {ckpt_path}\x1b[0m")
-        triplet_net.load_state_dict(state_dict)
     ID = 0
     all_metrics = {}
     for query_path, cand_path in zip(query_paths, cand_paths):
@@ -280,6 +446,119 @@ def test_ood_performance(triplet_net, model_name: str, query_paths: List[str],
         
     return all_metrics
 
+class MiningPrefetcher:
+    """
+    double buffered prefetch stage for batches that need a model forward pass to be prepared
+    (dynamic negative sampling, model-in-the-loop datasets/collate functions). A background thread
+    prepares batch t+1 (loading, tokenization, mining forward) while step t trains, through a
+    bounded queue of `depth` batches.
+    Mining uses a no-grad snapshot of the model, refreshed from the training model every 
+    `max_staleness` optimizer steps (call `step()` after each optimizer step). Since prefetched
+    batches were mined earlier, the mining weights lag by at most `max_staleness`+`depth` steps.
+    With `max_staleness=0` mining must see the current weights, so it runs on the main thread
+    (and only loading is prefetched, unless `model_in_the_loop` is set, then nothing is).
+    Objects that run the model while producing a batch (e.g. a dataset's `model` pointer) must
+    be pointed at the snapshot with `bind` so they never touch the weights being trained.
+    """
+    def __init__(self, loader: Iterable, model: nn.Module, mine_fn: Union[Callable, None]=None, 
+                 max_staleness: int=0, depth: int=2, model_in_the_loop: bool=False):
+        self.loader = loader
+        self.model = model
+        self.mine_fn = mine_fn # mine_fn(model, batch) -> batch
+        self.max_staleness = max_staleness
+        self.depth = depth
+        self.steps_since_refresh = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.background = not(model_in_the_loop and max_staleness == 0)
+        if max_staleness > 0:
+            self.mining_model = copy.deepcopy(model)
+            self.mining_model.requires_grad_(False)
+            self.mining_model.eval()
+        else: self.mining_model = model
+
+    def bind(self, obj, attr: str="model", get: Callable=lambda m: m):
+        """point `obj.attr` at (a part of) the mining model."""
+        setattr(obj, attr, get(self.mining_model))
+
+    def step(self):
+        """call after every optimizer step: refreshes the snapshot once it is too stale."""
+        if self.max_staleness == 0: return
+        self.steps_since_refresh += 1
+        if self.steps_since_refresh >= self.max_staleness:
+            with self._lock: # wait for the batch being mined with the old weights.
+                self.mining_model.load_state_dict(self.model.state_dict())
+            self.steps_since_refresh = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _next_batch(self, it: Iterator, stream=None):
+        # the lock is held while the batch is loaded too: datasets bound to the snapshot run it in `__getitem__`.
+        with self._lock, torch.no_grad():
+            if stream is None: 
+                batch = next(it)
+                if self.mine_fn is not None and self.max_staleness > 0: 
+                    batch = self.mine_fn(self.mining_model, batch)
+                return batch
+            with torch.cuda.stream(stream):
+                batch = next(it)
+                if self.mine_fn is not None and self.max_staleness > 0: 
+                    batch = self.mine_fn(self.mining_model, batch)
+            stream.synchronize()
+        return batch
+
+    def _worker(self, q: queue.Queue):
+        stream = None
+        device = next(self.mining_model.parameters()).device
+        if device.type == "cuda": stream = torch.cuda.Stream(device)
+        try:
+            it = iter(self.loader)
+            while not self._stop.is_set():
+                try: batch = self._next_batch(it, stream)
+                except StopIteration: break
+                self._put(q, ("batch", batch))
+            self._put(q, ("end", None))
+        except Exception as e: self._put(q, ("error", e))
+
+    def _put(self, q: queue.Queue, item: tuple):
+        # don't block forever on a full queue once the consumer has stopped.
+        while not self._stop.is_set():
+            try: q.put(item, timeout=0.1); return
+            except queue.Full: pass
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+        self._thread = None
+
+    def __iter__(self):
+        if not self.background:
+            for batch in self.loader:
+                if self.mine_fn is not None: batch = self.mine_fn(self.model, batch)
+                yield batch
+            return
+        self.close()
+        self._stop.clear()
+        q = queue.Queue(maxsize=self.depth)
+        self._thread = threading.Thread(target=self._worker, args=(q,), daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                kind, batch = q.get()
+                if kind == "end": break
+                elif kind == "error": raise batch
+                if self.mine_fn is not None and self.max_staleness == 0:
+                    batch = self.mine_fn(self.model, batch)
+                elif torch.cuda.is_available():
+                    # tensors made on the mining stream are now used on the training stream.
+                    for t in batch:
+                        if isinstance(t, torch.Tensor) and t.is_cuda: 
+                            t.record_stream(torch.cuda.current_stream(t.device))
+                yield batch
+        finally: self.close()
+
 def dynamic_negative_sampling(model, batch: list, model_name: str="codebert", device: str="cpu", k=1) -> list:
     """take the original batch of triplets and return new dynamically sampled batch of triplets"""
     new_batch = []
@@ -334,5 +613,144 @@ def dynamic_negative_sampling(model, batch: list, model_name: str="codebert", de
         elif model_name == "unixcoder":
             new_batch.append(batch[2].reshape(k*batch_size, seq_len))
     model.train()
-        
-    return new_batch
\ No newline at end of file
+
+    return new_batch
+
+def in_batch_hard_negatives(anchor_emb: torch.Tensor, pos_emb: torch.Tensor,
+                            hard_neg_emb: Union[torch.Tensor, None]=None,
+                            is_hard: Union[torch.Tensor, None]=None,
+                            rule_ids: Union[torch.Tensor, None]=None,
+                            pos_ids: Union[torch.Tensor, None]=None,
+                            k: int=1, use_csim: bool=False):
+    """dynamic negative sampling at batch level, using the embeddings of the training forward pass itself.
+    Every soft negative triplet gets the `k` positives (of the other triplets) that are closest to its anchor
+    as negatives, while the hard (AST) negative triplets keep their (already encoded) negatives.
+    anchor_emb, pos_emb: batch_size x hidden_size (with grad)
+    hard_neg_emb: num_hard x hidden_size embeddings of the negatives of the `is_hard` triplets.
+    pos_ids: batch_size x seq_len input ids of the positives, the duplicates of a triplet's positive aren't mined.
+    returns the anchor, positive & negative embeddings and the rule ids of the (at most k*num_soft + num_hard) triplets
+    (a soft negative triplet gets fewer than `k` negatives if the batch has fewer other positives)."""
+    batch_size = len(anchor_emb)
+    device = anchor_emb.device
+    if is_hard is None: is_hard = torch.zeros(batch_size, dtype=torch.bool)
+    is_hard = is_hard.to(device)
+    soft = (~is_hard).nonzero().squeeze(-1)
+    k = max(1, min(k, batch_size-1))
+    # only the selection is done without grad, the loss flows through the selected positives.
+    with torch.no_grad():
+        if use_csim: scores = cos_csim(anchor_emb[soft], pos_emb)
+        else: scores = -torch.cdist(anchor_emb[soft], pos_emb)
+        # a triplet's own positive (or another copy of the same snippet in the batch) can't be its negative.
+        scores[torch.arange(len(soft), device=device), soft] = float("-inf")
+        if pos_ids is not None:
+            pos_ids = pos_ids.to(device)
+            scores[(pos_ids[soft].unsqueeze(1) == pos_ids.unsqueeze(0)).all(-1)] = float("-inf")
+        top = torch.topk(scores, k=k, dim=1)
+        neg_inds = top.indices.T.reshape(-1) # (k*num_soft,)
+        mined = top.values.T.reshape(-1) > float("-inf")
+    soft, neg_inds = soft.repeat(k)[mined], neg_inds[mined]
+    anchors, positives, negatives = [anchor_emb[soft]], [pos_emb[soft]], [pos_emb[neg_inds]]
+    rules = [torch.zeros(len(soft), dtype=torch.long)]
+    if hard_neg_emb is not None:
+        hard = is_hard.nonzero().squeeze(-1)
+        anchors.append(anchor_emb[hard])
+        positives.append(pos_emb[hard])
+        negatives.append(hard_neg_emb)
+        rules.append(rule_ids[hard.cpu()].long())
+
+    return torch.cat(anchors), torch.cat(positives), torch.cat(negatives), torch.cat(rules)
+
+def fused_encode(encode_fn: Callable, groups: List[tuple], lengths: List[torch.Tensor],
+                 pad_values: tuple, num_buckets: int=1) -> List[torch.Tensor]:
+    """encode several groups of sequences (e.g. the anchors, positives & negatives of a step) with one 
+    encoder call per sequence length bucket (a single call by default) instead of one call per group.
+    groups: tuples of input tensors (batch_size x seq_len, or batch_size x seq_len x seq_len for attention masks)
+    lengths: no. of non pad positions of each sequence of every group (padding is at the end of the sequences).
+    pad_values: value used to pad each of the input tensors of a group.
+    returns the pooled outputs of every group (same as encoding each group separately)."""
+    sizes = [len(lens) for lens in lengths]
+    lengths = torch.cat(lengths)
+    seq_len = max(group[0].shape[1] for group in groups)
+    inputs = []
+    for i, pad_value in enumerate(pad_values):
+        padded = []
+        for group in groups:
+            x = group[i]
+            if x.shape[1] < seq_len:
+                l = x.shape[1]
+                x_padded = x.new_full((len(x),)+(seq_len,)*(x.dim()-1), pad_value)
+                if x.dim() == 3: x_padded[:,:l,:l] = x
+                else: x_padded[:,:l] = x
+                x = x_padded
+            padded.append(x)
+        inputs.append(torch.cat(padded))
+    if num_buckets > 1: buckets = lengths.argsort().chunk(num_buckets)
+    else: buckets = [torch.arange(len(lengths), device=lengths.device)]
+    embs = []
+    for bucket in buckets:
+        # trailing positions that are padding for the whole bucket are dropped.
+        l = lengths[bucket].max().item()
+        embs.append(encode_fn(*(x[bucket][:,:l,:l] if x.dim() == 3 else x[bucket][:,:l] for x in inputs)))
+    emb = torch.cat(embs)
+    if num_buckets > 1: emb = emb[torch.cat(buckets).argsort()]
+
+    return list(emb.split(sizes))
+
+def _slice_inputs(x, s: slice):
+    """slice the batch dimension of (a tuple of) input tensors."""
+    if x is None: return None
+    if isinstance(x, (tuple, list)): return tuple(t[s] for t in x)
+    return x[s]
+
+class GradCache:
+    """gradient cache (Gao et al., 2021) for contrastive losses over large batches within a fixed memory budget.
+    1) `encode`: the embeddings of the whole (logical) batch are computed chunk by chunk without a graph.
+    2) the loss is computed on the full batch (all in-batch negatives) from these embeddings and `loss.backward()` 
+    only computes the gradients w.r.t. the embeddings.
+    3) `backward`: every chunk is re-encoded with grad (with the same dropout masks) and the cached 
+    embedding gradients are backpropagated through it, so the model gets the same gradients as a full batch step.
+    `encode_fn` is the net's forward (or any fn mapping the input groups to a tuple of embeddings)."""
+    def __init__(self, encode_fn: Callable, chunk_size: int):
+        self.encode_fn = encode_fn
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.reps = []
+
+    def encode(self, *inputs) -> Tuple[torch.Tensor, ...]:
+        N = len(inputs[0][0] if isinstance(inputs[0], (tuple, list)) else inputs[0])
+        self.chunks, chunk_reps = [], []
+        for i in range(0, N, self.chunk_size):
+            chunk = [_slice_inputs(x, slice(i, i+self.chunk_size)) for x in inputs]
+            # RNG state is saved so that the re-encoding uses the same dropout masks.
+            rng_state = (torch.get_rng_state(), torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+            with torch.no_grad(): embs = self.encode_fn(*chunk)
+            self.chunks.append((chunk, rng_state))
+            chunk_reps.append(embs)
+        # the embeddings of the full batch are leaves of the loss' graph.
+        self.reps = []
+        for embs in zip(*chunk_reps):
+            if embs[0] is None: self.reps.append(None)
+            else: self.reps.append(torch.cat(embs).requires_grad_())
+
+        return tuple(self.reps)
+
+    def backward(self):
+        """backpropagate the (cached) gradients of the embeddings, call after `loss.backward()`."""
+        start = 0
+        for i, (chunk, (cpu_rng_state, cuda_rng_states)) in enumerate(self.chunks):
+            size = len(chunk[0][0] if isinstance(chunk[0], (tuple, list)) else chunk[0])
+            # a DDP wrapped net only has to all-reduce the gradients after the last chunk.
+            sync_context = contextlib.nullcontext()
+            if hasattr(self.encode_fn, "no_sync") and i < len(self.chunks)-1: sync_context = self.encode_fn.no_sync()
+            with sync_context:
+                with torch.random.fork_rng(devices=range(torch.cuda.device_count()) if cuda_rng_states is not None else []):
+                    torch.set_rng_state(cpu_rng_state)
+                    if cuda_rng_states is not None: torch.cuda.set_rng_state_all(cuda_rng_states)
+                    embs = self.encode_fn(*chunk)
+                surrogate = 0
+                for emb, rep in zip(embs, self.reps):
+                    if rep is None or rep.grad is None: continue
+                    surrogate = surrogate + (emb*rep.grad[start:start+size]).sum()
+                if torch.is_tensor(surrogate): surrogate.backward()
+            start += size
+        self.chunks, self.reps = [], []
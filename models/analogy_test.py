@@ -11,6 +11,7 @@ from torch.utils.data import Dataset
 from models.CodeBERT import CodeBERTripletNet
 from models.UniXcoder import UniXcoderTripletNet
 from models.GraphCodeBERT import GraphCodeBERTripletNet
+from models.serialization import empty_weights, is_fast_checkpoint, get_ckpt_path, load_checkpoint
 from torchmetrics.functional import pairwise_cosine_similarity
 
 # parse command line arguments.
@@ -46,17 +47,17 @@ def get_tok_path(model_name: str) -> str:
     return tok_path
 # create model object and load checkpoint.
 tok_path = get_tok_path(args.model_type)
-if args.model_type == "unixcoder":
-    model = UniXcoderTripletNet()
-elif args.model_type == "codebert":
-    model = CodeBERTripletNet(tok_path=tok_path)
-elif args.model_type == "graphcodebert":
-    model = GraphCodeBERTripletNet(tok_path=tok_path)
+ckpt_path = get_ckpt_path(args.exp)
+# fast checkpoints are memory mapped, without loading the pretrained weights.
+with empty_weights(is_fast_checkpoint(ckpt_path)):
+    if args.model_type == "unixcoder":
+        model = UniXcoderTripletNet()
+    elif args.model_type == "codebert":
+        model = CodeBERTripletNet(tok_path=tok_path)
+    elif args.model_type == "graphcodebert":
+        model = GraphCodeBERTripletNet(tok_path=tok_path)
 # load state dict into the model.
-model.load_state_dict(torch.load(os.path.join(
-    args.exp, "model.pt"), 
-    map_location="cpu"
-))
+load_checkpoint(model, ckpt_path)
 model.to(args.device_id)
 analogy_data = json.load(open(args.path))
 a = [i["a"] for i in analogy_data]
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# full (resumable) training state checkpoints: model, optimizer, grad scaler, curriculum, RNG states,
+# sampler position and the running counters/accuracies of the fit loop. The checkpoints are snapshotted
+# to CPU on the training thread and written by a background thread (atomic rename, keep last N).
+import os
+import copy
+import glob
+import queue
+import torch
+import random
+import threading
+import numpy as np
+from typing import *
+from datautils import telemetry
+from models.distributed import get_sampler, unwrap_loader
+from models.metrics import TripletAccuracy, RuleWiseAccuracy, RunningMean
+
+CKPT_PATTERN = "checkpoint-{:08d}.pt"
+# running counters of the fit loops (the accuracy trackers are picked up by type).
+LOOP_COUNTERS = ("train_tot", "train_acc", "train_u_acc")
+
+def to_cpu(obj):
+    """snapshot of a (nested) state: tensors are copied to CPU, everything else is deep copied,
+    so the training loop can keep updating the originals while the snapshot is being written."""
+    if torch.is_tensor(obj): return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict): return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return type(obj)(to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def get_rng_states() -> dict:
+    return {
+        "python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+def set_rng_states(states: dict):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if states["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+def loop_state(local_vars: dict) -> dict:
+    """running counters and accuracy trackers of a fit loop (picked from its `locals()`)."""
+    return {
+        "counters": {k: int(local_vars[k]) for k in LOOP_COUNTERS if k in local_vars}, # (device tensors)
+        "metrics": {k: v for k, v in local_vars.items() if isinstance(v, (TripletAccuracy, RuleWiseAccuracy, RunningMean))},
+    }
+
+def restore_metrics(saved: dict, local_vars: dict):
+    """restore the accuracy trackers of a fit loop in place (the counters have to be reassigned by the loop)."""
+    for name, metric in saved["metrics"].items():
+        if name in local_vars: local_vars[name].__dict__.update(metric.__dict__)
+
+def training_state(net, optimizer, scaler, trainset, loader, epoch: int, step: int, **loop_vars) -> dict:
+    """everything needed to resume training after `step` steps of epoch `epoch`."""
+    sampler = get_sampler(loader)
+    return {
+        "model": net.state_dict(), "optimizer": optimizer.state_dict(),
+        "scaler": scaler.state_dict() if scaler is not None else None,
+        "trainset": trainset.state_dict() if hasattr(trainset, "state_dict") else None,
+        "sampler": sampler.state_dict() if hasattr(sampler, "state_dict") else None,
+        "rng": get_rng_states(), "epoch": epoch, "step": step, **loop_vars,
+    }
+
+def latest_checkpoint(ckpt_dir: str) -> Union[str, None]:
+    paths = sorted(glob.glob(os.path.join(ckpt_dir, CKPT_PATTERN.replace("{:08d}", "*"))))
+    return paths[-1] if len(paths) > 0 else None
+
+def load_training_state(path: str, net, optimizer, scaler, trainset, loader) -> dict:
+    """load a training state checkpoint (`path` can also be a checkpoint folder, then the latest
+    checkpoint is used) into the model, optimizer, grad scaler, curriculum and sampler, restore the
+    RNG states and return the checkpoint (epoch, step and the fit loop's state)."""
+    if os.path.isdir(path): path = latest_checkpoint(path)
+    assert path is not None, "no checkpoint to resume from"
+    print(f"resuming training from {path}")
+    device = next(net.parameters()).device
+    state = torch.load(path, map_location="cpu")
+    net.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    # move the optimizer state (AdamW moments) to the model's device.
+    for param_state in optimizer.state.values():
+        for k, v in param_state.items():
+            if torch.is_tensor(v) and k != "step": param_state[k] = v.to(device)
+    if scaler is not None and state["scaler"] is not None: scaler.load_state_dict(state["scaler"])
+    if state["trainset"] is not None: trainset.load_state_dict(state["trainset"])
+    sampler = get_sampler(loader)
+    if state["sampler"] is not None:
+        sampler.load_state_dict(state["sampler"])
+        # skip the samples of the interrupted epoch that were already trained on.
+        sampler.skip(state["step"]*unwrap_loader(loader).batch_size)
+    set_rng_states(state["rng"])
+
+    return state
+
+class CheckpointWriter:
+    """writes training state checkpoints from a background thread. `save` snapshots the state to CPU
+    (on the calling thread) and hands it to the writer, which writes it to a temporary file, atomically
+    renames it and deletes all but the last `keep_last_n` checkpoints. At most one snapshot waits to be
+    written, so a slow disk throttles checkpointing instead of piling up snapshots in memory."""
+    def __init__(self, ckpt_dir: str, keep_last_n: int=3):
+        self.ckpt_dir = ckpt_dir
+        self.keep_last_n = keep_last_n
+        self.error = None
+        os.makedirs(ckpt_dir, exist_ok=True)
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def save(self, state: dict, global_step: int):
+        self._raise_error()
+        self._queue.put((to_cpu(state), global_step))
+
+    def _write(self, state: dict, global_step: int):
+        path = os.path.join(self.ckpt_dir, CKPT_PATTERN.format(global_step))
+        tmp_path = path+".tmp"
+        with telemetry.stage("checkpoint_write"):
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path) # a crash mid-write never leaves a partial checkpoint.
+        paths = sorted(glob.glob(os.path.join(self.ckpt_dir, CKPT_PATTERN.replace("{:08d}", "*"))))
+        for old_path in paths[:-self.keep_last_n] if self.keep_last_n > 0 else []: os.remove(old_path)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is not None: self._write(*item)
+            except Exception as e: self.error = e
+            finally: self._queue.task_done()
+            if item is None: break
+
+    def _raise_error(self):
+        if self.error is not None: raise self.error
+
+    def close(self):
+        """wait for the pending checkpoint to be written."""
+        if self._thread is None: return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._raise_error()
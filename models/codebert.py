@@ -26,7 +26,7 @@ from sklearn.metrics import label_ranking_average_precision_score as MRR
 from models.metrics import TripletAccuracy, RuleWiseAccuracy, recall_at_k
 from models import test_ood_performance, get_tok_path, dynamic_negative_sampling, fit_disco
 from models.losses import scl_loss, TripletMarginWithDistanceLoss, cos_dist, cos_cdist, cos_csim
-from datautils import read_jsonl, ValRetDataset, UniBiHardNegDataset, DynamicTriplesDataset, CodeRetrieverDataset, \
+from datautils import read_jsonl, load_perturbed_codes, ValRetDataset, UniBiHardNegDataset, DynamicTriplesDataset, CodeRetrieverDataset, \
 CodeRetrieverTriplesDataset, CodeRetrieverQuadsDataset, CodeRetrieverQuintsDataset, batch_shuffle_collate_fn_codebert
 # set logging level of transformers.
 torch.autograd.set_detect_anomaly(True)
@@ -68,7 +68,7 @@ def get_args():
     parser.add_argument("-sip", "--sim_intents_path", type=str, default=None, 
                         help="path to dictionary containing similar intents corresponding to a given intent")
     parser.add_argument("-pcp", "--perturbed_codes_path", type=str, default=None, 
-                        help="path to dictionary containing AST perturbed codes corresponding to a given code")
+                        help="path to dictionary (.json) or store (.negs) containing AST perturbed codes corresponding to a given code")
     parser.add_argument("-csp", "--code_syns_path", type=str, default=None, 
                         help="path to code synsets for all losses setting")
     parser.add_argument("-ccpp", "--code_code_pairs_path", type=str, default=None, 
@@ -912,7 +912,7 @@ class CodeBERTripletNet(nn.Module):
                 perturbed_codes = {}
             if use_AST:
                 assert perturbed_codes_path is not None, "Missing path to dictionary containing perturbed codes corresponding to a given code snippet"
-                perturbed_codes = json.load(open(perturbed_codes_path))
+                perturbed_codes = load_perturbed_codes(perturbed_codes_path)
             # create the data loaders.
             trainset = DynamicTriplesDataset(
                 train_path, "codebert", device=device_id, beta=beta, warmup_steps=warmup_steps,
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# distributed data parallel (DDP) training utilities. Launch the training scripts with torchrun, e.g.:
+# torchrun --nproc_per_node 4 -m models.CodeBERT -t -ddp ... (gloo backend on CPU, nccl on GPUs)
+import os
+import torch
+from typing import *
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+
+def init_distributed(device: str="cpu") -> str:
+    """initialize the default process group from the torchrun environment variables
+    and return the device of this process (GPU of the local rank, or CPU)."""
+    use_cuda = torch.cuda.is_available() and str(device).startswith("cuda")
+    if not dist.is_initialized():
+        dist.init_process_group(backend="nccl" if use_cuda else "gloo", init_method="env://")
+    if use_cuda:
+        device = f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+        torch.cuda.set_device(device)
+    else: device = "cpu"
+
+    return device
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process() -> bool:
+    """only the main process validates, saves models and writes metrics."""
+    return get_rank() == 0
+
+def wrap_ddp(net: torch.nn.Module, device: str) -> torch.nn.Module:
+    # not every parameter gets a gradient every step (e.g. the pooler of UniXcoder).
+    return DistributedDataParallel(
+        net, find_unused_parameters=True,
+        device_ids=[device] if str(device).startswith("cuda") else None,
+    )
+
+class ResumableSampler(DistributedSampler):
+    """`DistributedSampler` (a single shard for non-distributed training) whose order only depends on the
+    seed and the epoch, so a resumed run can `skip` the samples of the interrupted epoch that were already
+    trained on. `len` is always the length of the full epoch (the step counters of the fit loops rely on it)."""
+    def __init__(self, dataset, shuffle: bool=True, seed: Union[int, None]=None):
+        if seed is None: # drawn from torch's RNG (reproducible for seeded runs), same for every rank.
+            seed = [int(torch.randint(2**31, (1,)).item())]
+            if is_distributed(): dist.broadcast_object_list(seed, src=0)
+            seed = seed[0]
+        super(ResumableSampler, self).__init__(
+            dataset, num_replicas=get_world_size(), 
+            rank=get_rank(), shuffle=shuffle, seed=seed,
+        )
+        self.start_index = 0
+
+    def skip(self, num_samples: int):
+        """start the next iteration after the first `num_samples` samples (of this rank's shard)."""
+        self.start_index = num_samples
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())
+        start, self.start_index = self.start_index, 0
+
+        return iter(indices[start:])
+
+    def state_dict(self) -> dict:
+        return {"seed": self.seed, "epoch": self.epoch}
+
+    def load_state_dict(self, state: dict):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+
+def get_loader_kwargs(dataset, shuffle: bool=True, num_workers: int=0) -> dict:
+    """sampling related kwargs of the `DataLoader`: every rank iterates over its own shard of the dataset,
+    loaded by `num_workers` worker processes (kept alive across the epochs, with their caches)."""
+    kwargs = {"sampler": ResumableSampler(dataset, shuffle=shuffle), "num_workers": num_workers}
+    if num_workers > 0: kwargs["persistent_workers"] = True
+
+    return kwargs
+
+def unwrap_loader(loader):
+    """the `DataLoader` inside (any number of) `MiningPrefetcher`/`DeferredMiningLoader` wrappers."""
+    while hasattr(loader, "loader"): loader = loader.loader
+    return loader
+
+def get_sampler(loader):
+    """sampler of a `DataLoader` (also for wrapped loaders, see `unwrap_loader`)."""
+    return getattr(unwrap_loader(loader), "sampler", None)
+
+def set_epoch(loader, epoch: int):
+    """reshuffle (the shards of) the sampler for epoch `epoch`."""
+    sampler = get_sampler(loader)
+    if isinstance(sampler, DistributedSampler): sampler.set_epoch(epoch)
+
+class _AllGather(torch.autograd.Function):
+    """all gather (along the batch dimension) that keeps the gradient of the local slice. Every rank
+    computes the same loss over the gathered batch, so the gradients of the gathered tensor are summed
+    over the ranks (and DDP's averaging over the ranks gives the gradient of the global batch loss)."""
+    @staticmethod
+    def forward(ctx, tensor: torch.Tensor):
+        world_size = dist.get_world_size()
+        # the ranks can have different no. of rows (e.g. with in-batch negatives), so pad to the largest.
+        size = torch.as_tensor([len(tensor)], device=tensor.device)
+        sizes = [torch.zeros_like(size) for _ in range(world_size)]
+        dist.all_gather(sizes, size)
+        sizes = [s.item() for s in sizes]
+        padded = tensor.new_zeros((max(sizes),)+tensor.shape[1:])
+        padded[:len(tensor)] = tensor
+        gathered = [torch.zeros_like(padded) for _ in range(world_size)]
+        dist.all_gather(gathered, padded.contiguous())
+        ctx.sizes = sizes
+        ctx.rank = dist.get_rank()
+
+        return torch.cat([x[:s] for x, s in zip(gathered, sizes)])
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        grad = grad.contiguous()
+        dist.all_reduce(grad)
+        start = sum(ctx.sizes[:ctx.rank])
+
+        return grad[start:start+ctx.sizes[ctx.rank]]
+
+def all_gather(tensor: Union[torch.Tensor, None]) -> Union[torch.Tensor, None]:
+    """concatenation of the tensors of all the ranks (differentiable w.r.t. the local tensor)."""
+    if tensor is None or not is_distributed(): return tensor
+    if tensor.dtype == torch.bool: return all_gather(tensor.to(torch.uint8)).bool()
+    if dist.get_backend() == "nccl" and not tensor.is_cuda: # nccl only communicates GPU tensors.
+        return all_gather(tensor.to(torch.cuda.current_device())).cpu()
+    if not tensor.requires_grad: return _AllGather.apply(tensor).detach()
+    return _AllGather.apply(tensor)
+
+def sync_curriculum(trainset):
+    """set the curriculum (mastering rate buffers, soft/hard negative weights ...) of every rank to the
+    curriculum of the main process (once, after construction/resume: the ranks update their curricula
+    with the same all-gathered accuracies, so they stay identical without syncing every step)."""
+    if not is_distributed() or not hasattr(trainset, "state_dict"): return
+    state = [trainset.state_dict() if is_main_process() else None]
+    dist.broadcast_object_list(state, src=0)
+    trainset.load_state_dict(state[0])
@@ -8,38 +8,79 @@ import torch.nn.functional as F
 from models.losses import cos_dist
 from collections import defaultdict
         
+class RunningMean:
+    """O(1) running mean. Tensor values are accumulated on their device, 
+    so only `get` syncs with the host."""
+    def __init__(self):
+        self.reset()
+        
+    def reset(self):
+        self.total = 0
+        self.count = 0
+        
+    def update(self, value, n: int=1):
+        if torch.is_tensor(value): value = value.detach()
+        self.total = self.total + value*n
+        self.count += n
+        
+    def get(self) -> float:
+        if self.count == 0: return 0
+        return float(self.total)/self.count
+
 class RuleWiseAccuracy:
-    """rule category wise accuracy."""
+    """rule category wise accuracy. The matches are counted on the device of the embeddings
+    (with `bincount` over rule slots), the rule ids are on the host already (so are the counts)."""
     def __init__(self, use_scl: bool=False, margin: int=1):
         self.reset()
         self.margin = margin
         self.use_scl = use_scl
         # if self.use_scl: self.margin = 0
     def reset(self):
-        self.counts = defaultdict(lambda:0)
-        self.matches = defaultdict(lambda:0)
+        self.slots = {} # rule id -> slot of the rule in the count vectors (in order of appearance).
+        self.slot_counts = torch.zeros(0, dtype=torch.long)
+        self.slot_matches = None
         
     def update(self, anchor, pos, neg, rule_ids):
         # if self.use_scl:
             # pos = -torch.diag(anchor @ pos.T).cpu() # cos_dist(anchor, pos).cpu()
             # neg = -torch.diag(anchor @ neg.T).cpu() # cos_dist(anchor, neg).cpu()            
         # else:
-        pos = F.pairwise_distance(anchor, pos).cpu()
-        neg = F.pairwise_distance(anchor, neg).cpu()
-        matches = (neg-pos>self.margin)
-        for ind, r in enumerate(rule_ids): # print(matches[ind])
-            self.counts[r] += 1 
-            self.matches[r] += matches[ind].item()
+        pos = F.pairwise_distance(anchor, pos).detach()
+        neg = F.pairwise_distance(anchor, neg).detach()
+        matches = (neg-pos>self.margin).float()
+        if torch.is_tensor(rule_ids): rule_ids = rule_ids.tolist()
+        for r in rule_ids: 
+            if r not in self.slots: self.slots[r] = len(self.slots)
+        slots = torch.as_tensor([self.slots[r] for r in rule_ids], dtype=torch.long)
+        num_slots = len(self.slots)
+        self.slot_counts = F.pad(self.slot_counts, (0, num_slots-len(self.slot_counts)))
+        self.slot_counts += torch.bincount(slots, minlength=num_slots)
+        if self.slot_matches is None: self.slot_matches = torch.zeros(0, device=matches.device)
+        # (restored checkpoints hold the matches on the CPU)
+        self.slot_matches = F.pad(self.slot_matches.to(matches.device), (0, num_slots-len(self.slot_matches)))
+        self.slot_matches += torch.bincount(slots.to(matches.device), weights=matches, minlength=num_slots)
+        
+    @property
+    def counts(self) -> dict:
+        slot_counts = self.slot_counts.tolist()
+        return {r: slot_counts[i] for r, i in self.slots.items()}
+    
+    @property
+    def matches(self) -> dict:
+        if self.slot_matches is None: return {}
+        slot_matches = self.slot_matches.tolist() # (single) sync with the host.
+        return {r: slot_matches[i] for r, i in self.slots.items()}
             
     def __str__(self):
         acc = self()
-        return "|".join([f"R{r}:{100*acc[i]:.0f}" for i, r in enumerate(sorted(self.counts))])
+        return "|".join([f"R{r}:{100*acc[i]:.0f}" for i, r in sorted(enumerate(self.slots), key=lambda x: x[1])])
             
     def __call__(self):
-        acc = np.zeros(len(self.counts))
-        for i, r in enumerate(self.counts):
-            if self.counts[r] == 0: acc[i] = 0
-            else: acc[i] = self.matches[r]/self.counts[r]
+        acc = np.zeros(len(self.slots))
+        if self.slot_matches is None: return acc
+        counts = self.slot_counts.numpy()
+        matches = self.slot_matches.cpu().numpy()
+        acc[counts > 0] = matches[counts > 0]/counts[counts > 0]
         return acc
 
 class TripletAccuracy:
@@ -49,39 +90,45 @@ class TripletAccuracy:
         self.margin = margin
         self.reset()
         self.use_scl = use_scl
-        self.last_batch_acc = None
+        self.last_batch = None
         # if self.use_scl: self.margin = 0
     def reset(self):
+        # counts stay on the device of the embeddings (synced with the host by `get` & `last_batch_acc`).
         self.count = 0
         self.tot = 0
         
     def get(self):
-        if self.tot == 0: return 0
-        else: return self.count/self.tot
+        tot = int(self.tot)
+        if tot == 0: return 0
+        else: return int(self.count)/tot
+        
+    @property
+    def last_batch_acc(self):
+        if self.last_batch is None: return None
+        batch_count, batch_tot = (int(x) for x in self.last_batch)
+        if batch_tot != 0: return batch_count/batch_tot
+        else: return 0
         
     def update(self, anchor, pos, neg, mask=None):
         """mask can be a boolean or integer tensor."""
-        batch_tot = 0
-        batch_count = 0
         # if self.use_scl:
             # pos = -torch.diag(anchor @ pos.T).cpu() # cos_dist(anchor, pos).cpu()
             # neg = -torch.diag(anchor @ neg.T).cpu() # cos_dist(anchor, neg).cpu()
         # else:
-        pos = F.pairwise_distance(anchor, pos).cpu()
-        neg = F.pairwise_distance(anchor, neg).cpu()
+        pos = F.pairwise_distance(anchor, pos).detach()
+        neg = F.pairwise_distance(anchor, neg).detach()
         # print(pos, neg)
         # print("shapes:", pos.shape, neg.shape)
         if mask is not None:
-            batch_count += (mask*torch.as_tensor((neg-pos)>self.margin)).sum().item()
-            batch_tot += mask.sum().item()
+            mask = torch.as_tensor(mask).to(pos.device, non_blocking=True)
+            batch_count = (mask*((neg-pos)>self.margin)).sum()
+            batch_tot = mask.sum()
         else:
-            batch_count += torch.as_tensor((neg-pos)>self.margin).sum().item()
-            batch_tot += len(pos)
-        self.count += batch_count
-        self.tot += batch_tot
-        if batch_tot != 0:
-            self.last_batch_acc = batch_count/batch_tot
-        else: self.last_batch_acc = 0
+            batch_count = ((neg-pos)>self.margin).sum()
+            batch_tot = len(pos)
+        self.count = self.count + batch_count
+        self.tot = self.tot + batch_tot
+        self.last_batch = (batch_count, batch_tot)
 
 # test metrics.
 def recall_at_k(actual, predicted, k: int=10):
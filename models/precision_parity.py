@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# step time and recall@5 parity of mixed precision training against fp32, on a fixed short (DISCO objective) run.
+import os
+import json
+import time
+import copy
+import torch
+import random
+import argparse
+import numpy as np
+from typing import *
+from tqdm import tqdm
+from torch.utils.data import DataLoader
+from datautils import ValRetDataset, load_perturbed_codes
+from models import get_tok_path, get_disco_trainset, get_disco_batch, get_grad_scaler
+
+def load_triplet_net(model_name: str, tok_path: Union[str, None]=None, **args):
+    """`model_path` and `tok_path` (e.g. local checkpoints) default to the pretrained models of the hub."""
+    if tok_path is None: tok_path = get_tok_path(model_name)
+    if model_name == "codebert":
+        from models.CodeBERT import CodeBERTripletNet
+        triplet_net = CodeBERTripletNet(tok_path=tok_path, **args)
+    elif model_name == "graphcodebert":
+        from models.GraphCodeBERT import GraphCodeBERTripletNet
+        triplet_net = GraphCodeBERTripletNet(tok_path=tok_path, **args)
+    elif model_name == "unixcoder":
+        from models.UniXcoder import UniXcoderTripletNet
+        triplet_net = UniXcoderTripletNet(**args)
+    # the training scripts turn anomaly detection on (at import), which would dominate the step times.
+    torch.autograd.set_detect_anomaly(False)
+
+    return triplet_net
+
+def seed_everything(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def short_run(triplet_net, model_name: str, trainset, valset, precision: str, steps: int,
+              batch_size: int, device: str, seed: int=2022) -> dict:
+    """train for `steps` steps (same data order and init for every precision) and validate."""
+    seed_everything(seed)
+    triplet_net.precision = precision
+    triplet_net.to(device)
+    triplet_net.train()
+    scaler = get_grad_scaler(device, precision)
+    trainloader = DataLoader(trainset, shuffle=True, batch_size=batch_size)
+    step_times, batch_losses = [], []
+    for step, batch in tqdm(enumerate(trainloader), total=steps, desc=f"{precision} run"):
+        if step == steps: break
+        if str(device).startswith("cuda"): torch.cuda.synchronize(device)
+        start = time.time()
+        anchor_title, pos_snippet, neg_snippet = get_disco_batch(batch, model_name, device)
+        anchor_text_emb, pos_code_emb, neg_code_emb = triplet_net(anchor_title, pos_snippet, neg_snippet)
+        N = len(batch[0])
+        d_ap = torch.cdist(anchor_text_emb, pos_code_emb)
+        d_an = torch.cdist(anchor_text_emb, neg_code_emb)
+        scores = -torch.cat((d_ap, d_an), axis=-1)
+        target = torch.as_tensor(range(N)).to(device)
+        batch_loss = triplet_net.ce_loss(scores, target)
+        scaler.scale(batch_loss).backward()
+        scaler.step(triplet_net.optimizer)
+        scaler.update()
+        triplet_net.zero_grad()
+        if str(device).startswith("cuda"): torch.cuda.synchronize(device)
+        step_times.append(time.time()-start)
+        batch_losses.append(batch_loss.item())
+    recall_at_5 = triplet_net.val_ret(valset, device=device)
+    # the first steps include warmup (kernel selection, allocator growth).
+    skip = min(2, len(step_times)-1)
+
+    return {
+        "precision": precision, "steps": len(step_times),
+        "step_time": np.mean(step_times[skip:]),
+        "final_loss": batch_losses[-1], "recall@5": 100*recall_at_5,
+    }
+
+def get_args():
+    parser = argparse.ArgumentParser("mixed precision parity (step time & recall@5 against fp32)")
+    parser.add_argument("-m", "--model_name", type=str, default="codebert", choices=["codebert", "graphcodebert", "unixcoder"])
+    parser.add_argument("-mp", "--model_path", type=str, default=None, help="model to start from (defaults to the pretrained model)")
+    parser.add_argument("-tok", "--tok_path", type=str, default=None, help="tokenizer files (defaults to the pretrained tokenizer)")
+    parser.add_argument("-tp", "--train_path", type=str, default="data/conala-mined-100k_train.json")
+    parser.add_argument("-vp", "--val_path", type=str, default="data/conala-mined-100k_val.json")
+    parser.add_argument("-pcp", "--perturbed_codes_path", type=str, default="CoNaLa_AST_neg_samples_n1.json")
+    parser.add_argument("-d", "--device_id", type=str, default="cuda:0")
+    parser.add_argument("-bs", "--batch_size", type=int, default=32)
+    parser.add_argument("-s", "--steps", type=int, default=50, help="no. of training steps of each run")
+    parser.add_argument("-p", "--precisions", type=str, nargs="+", default=["fp32", "bf16", "fp16"])
+    parser.add_argument("-o", "--output_path", type=str, default=None, help="path to save the report (json)")
+
+    return parser.parse_args()
+
+# python -m models.precision_parity -m codebert -s 50 -d cuda:0
+if __name__ == "__main__":
+    args = get_args()
+    device = args.device_id if torch.cuda.is_available() else "cpu"
+    seed_everything(2022)
+    paths = {"model_path": args.model_path} if args.model_path is not None else {}
+    triplet_net = load_triplet_net(args.model_name, tok_path=args.tok_path, **paths)
+    # every run starts from the same weights & optimizer state.
+    init_state = copy.deepcopy(triplet_net.state_dict())
+    init_optim_state = copy.deepcopy(triplet_net.optimizer.state_dict())
+    perturbed_codes = load_perturbed_codes(args.perturbed_codes_path)
+    trainset = get_disco_trainset(triplet_net, args.model_name, args.train_path, perturbed_codes)
+    valset = ValRetDataset(args.val_path)
+    report = []
+    for precision in args.precisions:
+        triplet_net.load_state_dict(init_state)
+        triplet_net.optimizer.load_state_dict(init_optim_state)
+        report.append(short_run(
+            triplet_net, args.model_name, trainset, valset, precision=precision,
+            steps=args.steps, batch_size=args.batch_size, device=device,
+        ))
+    fp32 = [r for r in report if r["precision"] == "fp32"]
+    print(f"{'precision':<10} {'step time (s)':>14} {'speedup':>8} {'final loss':>11} {'recall@5':>9} {'Δrecall@5':>10}")
+    for r in report:
+        speedup = fp32[0]["step_time"]/r["step_time"] if fp32 else float("nan")
+        delta = r["recall@5"]-fp32[0]["recall@5"] if fp32 else float("nan")
+        r["speedup"], r["delta_recall@5"] = speedup, delta
+        print(f"{r['precision']:<10} {r['step_time']:>14.4f} {speedup:>8.2f} {r['final_loss']:>11.4f} {r['recall@5']:>9.2f} {delta:>+10.2f}")
+    if args.output_path is not None:
+        with open(args.output_path, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"saved report to {args.output_path}")
@@ -11,18 +11,20 @@ from collections import defaultdict
 from models.CodeBERT import CodeBERTripletNet
 from models.UniXcoder import UniXcoderTripletNet
 from models.GraphCodeBERT import GraphCodeBERTripletNet
+from models.serialization import empty_weights, is_fast_checkpoint, load_checkpoint
 
 def load_model(model_type: str, tok_path: str, ckpt_path: str, device_id: str):
     """given model type, tokenizer path and checkpoint path, return 
-    the triplet net instantiation with the correctly loaded checkpoint"""
-    if model_type == "codebert":
-        triplet_net = CodeBERTripletNet(tok_path=tok_path)
-    elif model_type == "unixcoder":
-        triplet_net = UniXcoderTripletNet(tok_path=tok_path)
-    elif model_type == "graphcodebert":
-        triplet_net = GraphCodeBERTripletNet(tok_path=tok_path)
-    state_dict = torch.load(ckpt_path, map_location="cpu")
-    triplet_net.load_state_dict(state_dict)
+    the triplet net instantiation with the correctly loaded checkpoint
+    (fast checkpoints are memory mapped, without loading the pretrained weights)"""
+    with empty_weights(is_fast_checkpoint(ckpt_path)):
+        if model_type == "codebert":
+            triplet_net = CodeBERTripletNet(tok_path=tok_path)
+        elif model_type == "unixcoder":
+            triplet_net = UniXcoderTripletNet(tok_path=tok_path)
+        elif model_type == "graphcodebert":
+            triplet_net = GraphCodeBERTripletNet(tok_path=tok_path)
+    load_checkpoint(triplet_net, ckpt_path)
     triplet_net.to(device_id)
     
     return triplet_net
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik (18CS10067)
+
+# fast checkpoint format: flat tensors in the safetensors layout (8 byte header length, JSON header with the
+# dtype, shape and byte offsets of every tensor plus the training config, then the raw tensor bytes). Loading
+# memory maps the file and builds the model architecture with its parameters on the meta device, so neither the
+# hub-pretrained weights nor a pickled copy of the fine-tuned weights are ever read/allocated.
+# convert existing checkpoints with: python -m models.serialization -i experiments/CodeBERT/model.pt
+import os
+import json
+import torch
+import struct
+import argparse
+import contextlib
+import numpy as np
+import torch.nn as nn
+from typing import *
+from transformers import RobertaModel, RobertaConfig
+
+FAST_CKPT_NAME = "model.safetensors"
+# safetensors dtype codes: (numpy dtype of the raw bytes, torch dtype).
+DTYPES = {
+    "F64": (np.float64, torch.float64), "F32": (np.float32, torch.float32),
+    "F16": (np.float16, torch.float16), "BF16": (np.int16, torch.bfloat16),
+    "I64": (np.int64, torch.int64), "I32": (np.int32, torch.int32), "I16": (np.int16, torch.int16),
+    "I8": (np.int8, torch.int8), "U8": (np.uint8, torch.uint8), "BOOL": (np.bool_, torch.bool),
+}
+DTYPE_CODES = {torch_dtype: code for code, (_, torch_dtype) in DTYPES.items()}
+
+def is_fast_checkpoint(path: str) -> bool:
+    return path.endswith(".safetensors")
+
+def get_ckpt_path(exp_name: str) -> str:
+    """checkpoint of an experiment (the fast format if it was converted)."""
+    fast_ckpt_path = os.path.join(exp_name, FAST_CKPT_NAME)
+    if os.path.exists(fast_ckpt_path): return fast_ckpt_path
+
+    return os.path.join(exp_name, "model.pt")
+
+def save_fast_checkpoint(state_dict: Dict[str, torch.Tensor], path: str, config: Union[dict, None]=None):
+    header, offset, tensors = {}, 0, []
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        nbytes = tensor.numel()*tensor.element_size()
+        header[name] = {
+            "dtype": DTYPE_CODES[tensor.dtype], "shape": list(tensor.shape),
+            "data_offsets": [offset, offset+nbytes],
+        }
+        offset += nbytes
+        tensors.append(tensor)
+    if config is not None: header["__metadata__"] = {"config": json.dumps(config)}
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" "*(-len(header) % 8) # the tensor data starts 8 byte aligned.
+    tmp_path = path+".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for tensor in tensors:
+            if tensor.dtype == torch.bfloat16: tensor = tensor.view(torch.int16) # numpy has no bfloat16.
+            f.write(tensor.numpy().tobytes())
+    os.replace(tmp_path, path)
+
+def read_fast_checkpoint(path: str) -> Tuple[Dict[str, torch.Tensor], dict]:
+    """memory mapped (copy on write) tensors of a fast checkpoint and its config.
+    The tensors are only paged in when they are used (e.g. moved to the GPU)."""
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    metadata = header.pop("__metadata__", {})
+    config = json.loads(metadata["config"]) if "config" in metadata else {}
+    if len(header) == 0: return {}, config
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=8+header_len)
+    state_dict = {}
+    for name, info in header.items():
+        np_dtype, torch_dtype = DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        tensor = torch.from_numpy(data[start:end].view(np_dtype))
+        if torch_dtype == torch.bfloat16: tensor = tensor.view(torch.bfloat16)
+        state_dict[name] = tensor.view(info["shape"])
+
+    return state_dict, config
+
+@contextlib.contextmanager
+def empty_weights(enable: bool=True):
+    """build models without their weights: parameters are created on the meta device (buffers are still
+    materialized, they are tiny) and `RobertaModel.from_pretrained` only builds the architecture from the config."""
+    if not enable:
+        yield
+        return
+    register_parameter = nn.Module.register_parameter
+    from_pretrained = RobertaModel.from_pretrained
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        # (a meta parameter is already registered, e.g. a tied weight: keep it, so the weights stay tied)
+        if param is not None and not param.is_meta:
+            module._parameters[name] = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+    def from_config(cls, model_path, *args, config=None, **kwargs):
+        config = config if config is not None else RobertaConfig.from_pretrained(model_path)
+        return cls(config).eval() # like `from_pretrained`.
+    nn.Module.register_parameter = register_empty_parameter
+    RobertaModel.from_pretrained = classmethod(from_config)
+    try: yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+        RobertaModel.from_pretrained = from_pretrained
+
+def assign_state_dict(net: nn.Module, state_dict: Dict[str, torch.Tensor]):
+    """use the tensors of `state_dict` as the parameters/buffers of `net` (no copy, unlike `load_state_dict`,
+    which can't fill meta parameters) and point the optimizer of the net (if any) at the new parameters.
+    Tied parameters (e.g. the UniXcoder `lm_head` and word embeddings) stay tied: they get the tensor of their first key."""
+    param_names = {id(p): name for name, p in net.named_parameters()}
+    # id of a replaced parameter -> (the parameter, its replacement). (the replaced parameters are kept, so their ids aren't reused)
+    assigned = {}
+    for name, tensor in state_dict.items():
+        module_name, _, attr = name.rpartition(".")
+        module = net.get_submodule(module_name)
+        if attr in module._parameters:
+            param = module._parameters[attr]
+            if id(param) not in assigned:
+                assigned[id(param)] = (param, nn.Parameter(tensor, requires_grad=param.requires_grad))
+            module._parameters[attr] = assigned[id(param)][1]
+        elif attr in module._buffers: module._buffers[attr] = tensor
+        else: raise KeyError(f"unexpected key {name} in state dict")
+    missing = [name for name, p in net.named_parameters() if p.is_meta]
+    assert len(missing) == 0, f"missing keys in state dict: {missing}"
+    optimizer = getattr(net, "optimizer", None)
+    if optimizer is not None:
+        params = dict(net.named_parameters())
+        for group in optimizer.param_groups:
+            group["params"] = [params[param_names[id(p)]] for p in group["params"]]
+
+def load_checkpoint(net: nn.Module, ckpt_path: str):
+    """load a checkpoint of either format into `net` (which may have been built with `empty_weights`)."""
+    if is_fast_checkpoint(ckpt_path):
+        state_dict, _ = read_fast_checkpoint(ckpt_path)
+        assign_state_dict(net, state_dict)
+    else: net.load_state_dict(torch.load(ckpt_path, map_location="cpu"))
+
+def build_triplet_net(model_type: str, **args) -> nn.Module:
+    from models import get_tok_path
+    if model_type == "codebert":
+        from models.CodeBERT import CodeBERTripletNet
+        return CodeBERTripletNet(tok_path=args.pop("tok_path", get_tok_path(model_type)), **args)
+    elif model_type == "graphcodebert":
+        from models.GraphCodeBERT import GraphCodeBERTripletNet
+        return GraphCodeBERTripletNet(tok_path=args.pop("tok_path", get_tok_path(model_type)), **args)
+    elif model_type == "unixcoder":
+        from models.UniXcoder import UniXcoderTripletNet
+        args.pop("tok_path", None)
+        return UniXcoderTripletNet(**args)
+    raise ValueError(f"unknown model type: {model_type}")
+
+def load_model(model_type: str, ckpt_path: str, device: str="cpu", **args) -> nn.Module:
+    """triplet net of type `model_type` with the weights of `ckpt_path`, on `device`. Fast checkpoints are
+    loaded without reading the pretrained weights (the architecture is built on the meta device)."""
+    with empty_weights(is_fast_checkpoint(ckpt_path)):
+        triplet_net = build_triplet_net(model_type, **args)
+    load_checkpoint(triplet_net, ckpt_path)
+
+    return triplet_net.to(device)
+
+def convert_checkpoint(ckpt_path: str, output_path: Union[str, None]=None) -> str:
+    """convert a (pickled state dict) `model.pt` checkpoint to the fast format. The experiment's
+    `config.json` (if it is next to the checkpoint) is stored in the header."""
+    if output_path is None: output_path = os.path.join(os.path.dirname(ckpt_path), FAST_CKPT_NAME)
+    state_dict = torch.load(ckpt_path, map_location="cpu")
+    config_path = os.path.join(os.path.dirname(ckpt_path), "config.json")
+    config = json.load(open(config_path)) if os.path.exists(config_path) else None
+    save_fast_checkpoint(state_dict, output_path, config=config)
+    # check the round trip.
+    loaded, _ = read_fast_checkpoint(output_path)
+    assert loaded.keys() == state_dict.keys()
+    for name, tensor in state_dict.items(): assert torch.equal(loaded[name], tensor), name
+
+    return output_path
+
+def get_args():
+    parser = argparse.ArgumentParser("convert model.pt checkpoints to the fast (memory mappable) format")
+    parser.add_argument("-i", "--input_paths", type=str, nargs="+", required=True, help="model.pt checkpoints to convert")
+    parser.add_argument("-o", "--output_path", type=str, default=None,
+                        help=f"path of the converted checkpoint (only for a single input, defaults to {FAST_CKPT_NAME} next to the input)")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    assert args.output_path is None or len(args.input_paths) == 1, "`output_path` needs a single input"
+    for ckpt_path in args.input_paths:
+        output_path = convert_checkpoint(ckpt_path, args.output_path)
+        print(f"converted {ckpt_path} to {output_path}")
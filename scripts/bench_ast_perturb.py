@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Author: Atharva Naik
+# microbenchmarks of the AST perturbation hot paths over the CoNaLa snippets.
+import os
+import ast
+import json
+import time
+import random
+import argparse
+from typing import *
+from ast_perturb.ast_perturb2 import PerturbAst, CODES, serialize_tree, rand_str
+from ast_perturb.gen_ast_neg_samples import DATASETS_TRAIN_MAP, get_snippets
+from ast_perturb.signature_db import SignatureDB, signature_db_path
+
+def get_args():
+    parser = argparse.ArgumentParser("microbenchmarks of the AST perturbation code")
+    parser.add_argument("-b", "--bench", type=str, default="is_user_defined", choices=list(BENCHMARKS))
+    parser.add_argument("-d", "--dataset", type=str, default="CoNaLa", choices=list(DATASETS_TRAIN_MAP))
+    parser.add_argument("-n", "--num_snippets", type=int, default=None, help="no. of snippets to use (all by default)")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("-w", "--num_workers", type=int, nargs="+", default=[1, 2, 4, 8, 16], 
+                        help="no. of worker processes to compare (engine benchmark)")
+
+    return parser.parse_args()
+
+def timeit(fn: Callable, repeats: int) -> float:
+    """best of `repeats` runs (in seconds)."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter()-start)
+
+    return best
+
+def call_names(perturber: PerturbAst, snippets: List[str]) -> List[str]:
+    """full names of the calls in the snippets (what `visit_Call` checks)."""
+    names = []
+    for code in snippets:
+        try: tree = ast.parse(code)
+        except SyntaxError: continue
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call): continue
+            if isinstance(node.func, ast.Attribute):
+                names.append(perturber.get_full_name(node.func.value, node.func.attr))
+            elif isinstance(node.func, ast.Name): names.append(node.func.id)
+
+    return names
+
+def load_snippets(args) -> List[str]:
+    return get_snippets(DATASETS_TRAIN_MAP[args.dataset])[:args.num_snippets]
+
+def bench_is_user_defined(perturber: PerturbAst, args):
+    names = call_names(perturber, load_snippets(args))
+    repeats = args.repeats
+    # the previous implementation: compare against every library function name.
+    def linear_is_user_defined(fn_name):
+        for lib_fn_name in perturber.lib_fn_names:
+            if perturber.compare_fn_names(fn_name, lib_fn_name):
+                return False
+        return True
+    linear = [linear_is_user_defined(name) for name in names]
+    indexed = [perturber.is_user_defined(name) for name in names]
+    assert linear == indexed, "indexed lookup disagrees with the linear scan"
+    t_linear = timeit(lambda: [linear_is_user_defined(name) for name in names], repeats)
+    t_indexed = timeit(lambda: [perturber.is_user_defined(name) for name in names], repeats)
+    print(f"is_user_defined over {len(names)} calls ({len(perturber.lib_fn_names)} library functions):")
+    print(f"linear scan: {t_linear:.3f}s ({1e6*t_linear/len(names):.1f}µs/call)")
+    print(f"indexed: {t_indexed:.3f}s ({1e6*t_indexed/len(names):.2f}µs/call) -> {t_linear/t_indexed:.0f}x")
+
+def bench_serialize(perturber: PerturbAst, args, rounds: int=1000):
+    # (on the `CODES` examples, the dataset isn't used; the output is checked by tests/test_ast_perturb_golden.py)
+    repeats = args.repeats
+    trees = [ast.parse(code) for code in CODES]
+    # the previous module level implementation: round trip through a temporary file.
+    def file_serialize_tree(tree):
+        from ast_perturb.ast_unparse37 import Unparser
+        fname = f"{rand_str(16)}.py"
+        with open(fname, "w") as f: Unparser(tree, file=f)
+        with open(fname, "r") as f: content = f.read()
+        os.remove(fname)
+        return content.strip("\n")
+    serializers = {"temp file": file_serialize_tree, "in memory": serialize_tree}
+    print(f"serializing the {len(trees)} `CODES` trees {rounds} times:")
+    for name, serialize in serializers.items():
+        n = rounds//10 if name == "temp file" else rounds
+        t = timeit(lambda: [serialize(tree) for _ in range(n) for tree in trees], repeats)
+        print(f"{name}: {1e6*t/(n*len(trees)):.1f}µs/tree ({n*len(trees)/t:.0f} trees/s)")
+
+def bench_signatures(perturber: PerturbAst, args, path: str="module_signatures.json", rounds: int=1000):
+    # (the dataset isn't used)
+    repeats = args.repeats
+    db_path = signature_db_path(path)
+    assert os.path.exists(db_path), f"build the signature db first: python -m ast_perturb.signature_db -i {path}"
+    signatures = json.load(open(path))["signatures"]
+    db = SignatureDB(db_path)
+    assert list(db) == list(signatures) and all(db[k] == v for k, v in signatures.items()), f"{db_path} differs from {path}"
+    t_json = timeit(lambda: json.load(open(path)), repeats)
+    t_db = timeit(lambda: SignatureDB(db_path).get("join"), repeats)
+    print(f"loading the signatures of {len(db)} functions:")
+    print(f"json: {1e3*t_json:.1f}ms, db: {1e3*t_db:.2f}ms -> {t_json/t_db:.0f}x")
+    # the previous implementation: shuffle every function name to pick one.
+    def shuffle_sample_neg_fn(fn):
+        for k in random.sample(list(signatures.keys()), k=len(signatures)):
+            rec = signatures[k][0]
+            if not perturber.compare_fn_names(fn, rec["qualified_name"]): return rec["name"]
+    t_shuffle = timeit(lambda: [shuffle_sample_neg_fn("join") for _ in range(rounds)], repeats)
+    t_sample = timeit(lambda: [perturber.sample_neg_fn("join") for _ in range(rounds)], repeats)
+    print(f"sample_neg_fn: shuffle {1e6*t_shuffle/rounds:.1f}µs/call, random index {1e6*t_sample/rounds:.2f}µs/call -> {t_shuffle/t_sample:.0f}x")
+
+def bench_engine(perturber: PerturbAst, args, chunk_size: int=64):
+    """throughput of the process pool engine for every no. of workers (single runs, incl. the pool startup)."""
+    from ast_perturb.engine import generate_parallel
+    snippets = load_snippets(args)
+    outputs, times = {}, {}
+    for num_workers in args.num_workers:
+        start = time.perf_counter()
+        outputs[num_workers] = list(generate_parallel(snippets, num_workers=num_workers, chunk_size=chunk_size, use_tqdm=False))
+        times[num_workers] = time.perf_counter()-start
+    base = args.num_workers[0]
+    for num_workers in args.num_workers:
+        assert outputs[num_workers] == outputs[base], f"{num_workers} workers generate different candidates than {base}"
+    print(f"generating the AST negatives of {len(snippets)} {args.dataset} snippets (cpu cores: {os.cpu_count()}):")
+    for num_workers in args.num_workers:
+        t = times[num_workers]
+        print(f"{num_workers} workers: {t:.1f}s ({len(snippets)/t:.0f} snippets/s) -> {times[base]/t:.2f}x")
+
+BENCHMARKS = {
+    "is_user_defined": bench_is_user_defined,
+    "serialize": bench_serialize,
+    "signatures": bench_signatures,
+    "engine": bench_engine,
+}
+
+# main function
+if __name__ == "__main__":
+    args = get_args()
+    perturber = PerturbAst()
+    perturber.init()
+    BENCHMARKS[args.bench](perturber, args)
+# python -m scripts.bench_ast_perturb -b is_user_defined -n 10000
+# python -m scripts.bench_ast_perturb -b serialize
+# python -m scripts.bench_ast_perturb -b signatures
+# python -m scripts.bench_ast_perturb -b engine -n 20000 -w 1 2 4 8 16
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik
+
+# golden tests of the AST perturbation rules: the candidates generated for a fixed set of snippets must match the
+# saved ones exactly (rule by rule), and serializing the tree of a candidate must give back the candidate exactly.
+# rule1 (library function substitution) ranks the functions of a small fixture of signatures
+# (fixtures/module_signatures.json), so its goldens don't depend on the full module_signatures.json (nor on
+# whether python-Levenshtein is installed: the names are scored with difflib, see `sub_index.token_sort_ratio`).
+# regenerate the goldens (after an intended change of the rules) with: python -m tests.test_ast_perturb_golden
+import os
+import ast
+import sys
+import json
+import random
+import pytest
+from typing import *
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+GOLDEN_PATH = os.path.join(FIXTURES_DIR, "ast_perturb_golden.json")
+RULES = [f"rule{i+1}" for i in range(18)]
+# snippets covering the rules that the `CODES` examples don't.
+EXTRA_CODES = [
+    "a = -x if not y else x / 2",
+    "flag = z is None or (k in d and d[k] != 0)",
+    "if not os.path.exists(path): os.makedirs(path, exist_ok=False)",
+    "ratio = (a + b) / len(items)",
+]
+pytestmark = pytest.mark.skipif(sys.version_info >= (3, 8), reason="the rules use the python 3.7 ast node types (`_ast.Num` etc.)")
+
+def get_perturber():
+    """`PerturbAst` using the fixture signatures (loaded from the working directory when ast_perturb2 is imported)."""
+    cwd = os.getcwd()
+    os.chdir(FIXTURES_DIR)
+    try:
+        from ast_perturb import ast_perturb2
+        perturber = ast_perturb2.PerturbAst()
+        perturber.init()
+    finally: os.chdir(cwd)
+    fixture = json.load(open(os.path.join(FIXTURES_DIR, "module_signatures.json")))["signatures"]
+    assert list(ast_perturb2.signatures) == list(fixture), "ast_perturb2 was already imported with other signatures"
+
+    return perturber
+
+def golden_candidates(perturber, codes: List[str]) -> Dict[str, List[List[str]]]:
+    from ast_perturb.engine import snippet_seed
+    golden = {}
+    for code in codes:
+        random.seed(snippet_seed(code))
+        golden[code] = [[cand, rule] for cand, rule in perturber.generate(code)]
+
+    return golden
+
+@pytest.fixture(scope="module")
+def golden() -> Dict[str, List[List[str]]]:
+    return json.load(open(GOLDEN_PATH))
+
+@pytest.fixture(scope="module")
+def generated(golden) -> Dict[str, List[List[str]]]:
+    return golden_candidates(get_perturber(), list(golden))
+
+def test_goldens_cover_every_rule(golden):
+    assert {rule for cands in golden.values() for _, rule in cands} == set(RULES)
+
+@pytest.mark.parametrize("rule", RULES)
+def test_rule_golden(rule, golden, generated):
+    for code, cands in golden.items():
+        expected = [cand for cand, r in cands if r == rule]
+        assert [cand for cand, r in generated[code] if r == rule] == expected, f"{rule} candidates of {code!r} differ from the golden ones"
+
+def test_candidate_order(golden, generated):
+    # (the rules are applied in a fixed order, so the candidates of a snippet are too)
+    assert generated == golden
+
+def test_serialize_tree(golden):
+    from ast_perturb.ast_perturb2 import serialize_tree
+    for cands in golden.values():
+        for cand, rule in cands:
+            serialized = serialize_tree(ast.parse(cand))
+            assert serialized == cand, f"serialization of a {rule} candidate differs: {cand!r} -> {serialized!r}"
+
+def test_name_scorer():
+    # the pinned scorer must agree with fuzzywuzzy's own difflib scorer.
+    from fuzzywuzzy import fuzz
+    from difflib import SequenceMatcher
+    from ast_perturb.sub_index import token_sort_ratio
+    if fuzz.SequenceMatcher is not SequenceMatcher: pytest.skip("fuzzywuzzy uses python-Levenshtein's matcher")
+    fixture = json.load(open(os.path.join(FIXTURES_DIR, "module_signatures.json")))["signatures"]
+    names = [rec["name"].replace("_", " ") for recs in fixture.values() for rec in recs]+["", "makedirs", "exists"]
+    for a in names:
+        for b in names: assert token_sort_ratio(a, b) == fuzz.token_sort_ratio(a, b), (a, b)
+
+if __name__ == "__main__":
+    perturber = get_perturber()
+    from ast_perturb.ast_perturb2 import CODES
+    with open(GOLDEN_PATH, "w") as f:
+        json.dump(golden_candidates(perturber, CODES+EXTRA_CODES), f, indent=4)
+    print(f"saved the goldens to {GOLDEN_PATH}")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik
+
+# online AST negatives with DataLoader workers (the `--num_workers` option of the fit loops): the negatives must
+# be generated by the workers (not the main process), while the hard negative is picked with the model in the
+# main process (`DeferredMiningLoader`), for workers started with fork and spawn (which pickles the dataset).
+# Resuming must work with the loader stack of the fit loops (`MiningPrefetcher(DeferredMiningLoader(DataLoader))`).
+import os
+import sys
+import json
+import torch
+import pickle
+import pytest
+import multiprocessing
+from typing import *
+from torch.utils.data import DataLoader
+from datautils.online_negs import OnlineASTNegatives
+from tests.test_ast_perturb_golden import FIXTURES_DIR
+
+TRIPLETS = [
+    ["make the folder if it is missing", "if not os.path.exists(path): os.makedirs(path, exist_ok=False)", "x = 1"],
+    ["average of the items", "ratio = (a + b) / len(items)", "y = 2"],
+    ["negate x unless y", "a = -x if not y else x / 2", "z = 3"],
+    ["check the value of key k", "flag = z is None or (k in d and d[k] != 0)", "w = 4"],
+]
+pytestmark = pytest.mark.skipif(sys.version_info >= (3, 8), reason="the rules use the python 3.7 ast node types (`_ast.Num` etc.)")
+
+class CharTokenizer:
+    """stand-in for the UniXcoder tokenizer (ids of the characters)."""
+    def __call__(self, texts: List[str], max_length: int=32, **kwargs) -> List[List[int]]:
+        return [[ord(c) for c in text[:max_length].ljust(max_length)] for text in texts]
+
+class LengthModel:
+    """stand-in for the triplet net: embeds a text by its length, recording the pids it is called from."""
+    def __init__(self, pids: list):
+        self.pids = pids
+
+    def eval(self): pass
+
+    def encode_emb(self, texts: List[str], mode: str, **kwargs) -> List[torch.Tensor]:
+        self.pids.append(os.getpid())
+        return [torch.tensor([len(text), 1.0]) for text in texts]
+
+class RecordingASTNegatives(OnlineASTNegatives):
+    """records the pids of the processes that generate the negatives (in a list shared with the workers)."""
+    def __init__(self, pids: list, **kwargs):
+        super(RecordingASTNegatives, self).__init__(**kwargs)
+        self.pids = pids
+
+    def _generate(self, snippet: str, ignore: Tuple[str]) -> Tuple[List[str], List[int]]:
+        self.pids.append(os.getpid())
+        return super(RecordingASTNegatives, self)._generate(snippet, ignore)
+
+@pytest.fixture
+def train_path(tmp_path) -> str:
+    path = str(tmp_path / "train.jsonl")
+    with open(path, "w") as f:
+        for triplet in TRIPLETS: f.write(json.dumps(triplet)+"\n")
+
+    return path
+
+def get_trainset(train_path: str, gen_pids: list, mining_pids: list):
+    from datautils import DynamicTriplesDataset
+    # without the curriculum every triplet gets a hard negative.
+    return DynamicTriplesDataset(
+        train_path, "unixcoder", model=LengthModel(mining_pids), tokenizer=CharTokenizer(),
+        use_AST=True, perturbed_codes=RecordingASTNegatives(gen_pids), use_curriculum=False,
+        device="cpu", max_length=32,
+    )
+
+def test_pickle_drops_the_model(train_path):
+    trainset = get_trainset(train_path, [], [])
+    state = pickle.loads(pickle.dumps(trainset))
+    assert state.model is None and state.online_hard_negs._perturber is None
+    assert state.curriculum.weights() == trainset.curriculum.weights()
+
+@pytest.mark.parametrize("start_method", ["fork", "spawn"])
+def test_generation_in_workers(start_method, train_path, monkeypatch):
+    from datautils import DeferredMiningLoader
+    from models.distributed import get_loader_kwargs
+    monkeypatch.chdir(FIXTURES_DIR) # (the signatures used by rule1)
+    manager = multiprocessing.get_context(start_method).Manager()
+    gen_pids, mining_pids = manager.list(), []
+    trainset = get_trainset(train_path, gen_pids, mining_pids)
+    loader = DataLoader(trainset, **get_loader_kwargs(trainset, num_workers=2), batch_size=2,
+                        multiprocessing_context=start_method)
+    trainloader = DeferredMiningLoader(loader, trainset)
+    for epoch in range(2):
+        for anchor, pos, neg, rule in trainloader:
+            assert anchor.shape == pos.shape == neg.shape == (2, 32)
+            assert (rule > 0).all(), "the hard negatives should be AST negatives"
+    main_pid = os.getpid()
+    assert len(gen_pids) >= len(TRIPLETS) and main_pid not in gen_pids
+    assert trainset.online_hard_negs.misses == 0 and trainset.online_hard_negs._perturber is None
+    assert set(mining_pids) == {main_pid}
+    # the workers persist across the epochs, so their caches (and perturbers) are reused.
+    assert len(set(gen_pids)) <= 2
+    manager.shutdown()
+
+def get_trainloader(trainset, model):
+    """the loader stack of the fit loops with `--num_workers` and `--prefetch_depth`."""
+    from models import MiningPrefetcher
+    from datautils import DeferredMiningLoader
+    from models.distributed import get_loader_kwargs
+    loader = DataLoader(trainset, **get_loader_kwargs(trainset, num_workers=2), batch_size=2)
+    return MiningPrefetcher(DeferredMiningLoader(loader, trainset), model=model, model_in_the_loop=True)
+
+def test_resume_with_workers_and_prefetcher(train_path, tmp_path, monkeypatch):
+    from models.checkpointing import training_state, load_training_state
+    monkeypatch.chdir(FIXTURES_DIR)
+    net = torch.nn.Linear(2, 2)
+    optimizer = torch.optim.AdamW(net.parameters())
+    trainset = get_trainset(train_path, [], [])
+    trainloader = get_trainloader(trainset, net)
+    anchors = [anchor for anchor, _, _, _ in trainloader]
+    # interrupted after the first step of the epoch.
+    ckpt_path = str(tmp_path / "checkpoint.pt")
+    torch.save(training_state(net, optimizer, None, trainset, trainloader, epoch=0, step=1), ckpt_path)
+    trainset = get_trainset(train_path, [], [])
+    trainloader = get_trainloader(trainset, net)
+    state = load_training_state(ckpt_path, net, optimizer, None, trainset, trainloader)
+    resumed = [anchor for anchor, _, _, _ in trainloader]
+    assert state["step"] == 1 and len(resumed) == len(anchors)-1
+    assert all(torch.equal(a, b) for a, b in zip(resumed, anchors[1:]))
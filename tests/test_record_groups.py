@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik
+
+# lazy grouping of records (the snippets of every intent, the pairs of every code): lookups must match grouping
+# the records into a dict of lists, and the grouping must be cached next to the data until the data changes.
+import os
+import json
+import pickle
+import pytest
+from typing import *
+from datautils.utils import RecordGroups, open_records
+
+TRIPLETS = [
+    ["sort a list", "l.sort()", "x = 1"],
+    ["reverse a list", "l[::-1]", "y = 2"],
+    ["sort a list", "sorted(l)", "z = 3"],
+    ["open a file", "open(path)", "w = 4"],
+    ["sort a list", "l.sort(reverse=False)", "v = 5"],
+]
+PAIRS = [["l.sort()", "sorted(l)"], ["sorted(l)", "l.sort(reverse=False)"], ["open(path)", "open(path)"]]
+
+def write_json(path: str, records: list) -> str:
+    with open(path, "w") as f:
+        if path.endswith(".jsonl"): f.write("\n".join(json.dumps(rec) for rec in records))
+        else: json.dump(records, f)
+
+    return path
+
+def group(records: list, key_fields: List[int], value_fields: List[int]) -> Dict[str, list]:
+    groups = {}
+    for rec in records:
+        for k, v in zip(key_fields, value_fields): groups.setdefault(rec[k], []).append(rec[v])
+
+    return groups
+
+@pytest.mark.parametrize("records, key_fields, value_fields, name", [
+    (TRIPLETS, [0], [1], "train.jsonl"), (PAIRS, [0, 1], [1, 0], "code_code_pairs.json"),
+])
+def test_groups_match_dict(records, key_fields, value_fields, name, tmp_path):
+    path = write_json(str(tmp_path / name), records)
+    groups = RecordGroups(open_records(path), key_fields, value_fields)
+    expected = group(records, key_fields, value_fields)
+    for key, values in expected.items(): assert groups[key] == values
+    assert "missing" not in groups and groups.get("missing") is None
+    with pytest.raises(KeyError): groups["missing"]
+    assert os.path.exists(groups.path)
+    # the cached grouping is memory mapped (and also survives pickling, for DataLoader workers).
+    cached = pickle.loads(pickle.dumps(RecordGroups(open_records(path), key_fields, value_fields)))
+    assert hasattr(cached, "_buf") and all(cached[key] == values for key, values in expected.items())
+
+def test_stale_groups_are_rebuilt(tmp_path):
+    path = write_json(str(tmp_path / "train.jsonl"), TRIPLETS)
+    assert RecordGroups(open_records(path), [0], [1])["open a file"] == ["open(path)"]
+    write_json(path, TRIPLETS+[["open a file", "open(path, 'w')", "u = 6"]])
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9)) # (in case the rewrite has the same mtime)
+    groups = RecordGroups(open_records(path), [0], [1])
+    assert not hasattr(groups, "_buf") and groups["open a file"] == ["open(path)", "open(path, 'w')"]
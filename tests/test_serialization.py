@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Atharva Naik
+
+# loading fast checkpoints into nets built with `empty_weights`: tied weights (like the UniXcoder `lm_head`,
+# which shares the word embeddings) must stay a single parameter, for the net and for its optimizer.
+import torch
+import pytest
+import torch.nn as nn
+from models.serialization import empty_weights, save_fast_checkpoint, read_fast_checkpoint, assign_state_dict
+
+class TiedNet(nn.Module):
+    """stand-in for UniXcoder: an embedding and an output head sharing its weight."""
+    def __init__(self, vocab_size: int=10, hidden_size: int=4):
+        super(TiedNet, self).__init__()
+        self.embeddings = nn.Embedding(vocab_size, hidden_size)
+        self.dense = nn.Linear(hidden_size, hidden_size)
+        self.lm_head = nn.Linear(hidden_size, vocab_size, bias=False)
+        self.lm_head.weight = self.embeddings.weight
+        self.optimizer = torch.optim.AdamW(self.parameters())
+
+@pytest.fixture
+def ckpt_path(tmp_path) -> str:
+    path = str(tmp_path / "model.safetensors")
+    save_fast_checkpoint(TiedNet().state_dict(), path)
+
+    return path
+
+def test_empty_weights_keep_the_tie():
+    with empty_weights():
+        net = TiedNet()
+    assert net.lm_head.weight.is_meta and net.lm_head.weight is net.embeddings.weight
+    assert len(list(net.parameters())) == 3
+
+def test_assign_state_dict_keeps_the_tie(ckpt_path):
+    with empty_weights():
+        net = TiedNet()
+    state_dict, _ = read_fast_checkpoint(ckpt_path)
+    assign_state_dict(net, state_dict)
+    assert net.lm_head.weight is net.embeddings.weight
+    assert torch.equal(net.embeddings.weight, state_dict["embeddings.weight"])
+    params = list(net.parameters())
+    assert len(params) == 3 and not any(p.is_meta for p in params)
+    opt_params = [p for group in net.optimizer.param_groups for p in group["params"]]
+    assert len(opt_params) == len(params) and all(p is q for p, q in zip(opt_params, params))